@@ -1,29 +1,200 @@
 """Flask App for Flask Cafe."""
 
+import gc
 import os
 
-from flask import Flask, render_template, flash, session, redirect, g, jsonify, request
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from flask import (
+    Flask, Blueprint, render_template, flash, session, redirect, g, jsonify,
+    request, current_app,
+)
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import configure_mappers
+
+from config import CONFIGS
+from models import (
+    db, connect_db, create_missing_indexes, DuplicateKeysError, city_registry,
+    Cafe, User, Like, CitySummary,
+    DEFAULT_USER_IMAGE, DEFAULT_CAFE_IMAGE,
+)
+from forms import CafeForm, CafeImportForm, SignupForm, LoginForm, ProfileEditForm
+import mapquest
+from mapquest import MapQuestError
+from replicas import read_only, pool_stats
+from metrics import init_metrics, query_budget, timer
+from compression import init_compression
+from assets import init_assets
+from images import init_images
+from suggest import init_suggest
+from profiling import init_profiling
+from slow_queries import init_slow_queries
+from caching import init_shared_cache, shared_cache, purge
+from entity_cache import init_entity_cache, cached_get, cached_get_or_404
+from invalidation import init_invalidation_bus
+from streaming import LazyRows, stream_page
+from summaries import refresh_summaries_command
+from recommendations import init_recommendations
+import importer
+
+
+views = Blueprint("views", __name__)
+
+
+def create_app(config=None):
+    """Build the app for `config`: a profile name, a config class, or
+    $FLASK_CAFE_CONFIG (default "development")."""
+
+    if config is None:
+        config = os.environ.get("FLASK_CAFE_CONFIG", "development")
+    if isinstance(config, str):
+        config = CONFIGS[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    cache_dir = app.config["TEMPLATE_CACHE_DIR"]
+    if cache_dir:
+        cache_dir = os.path.join(app.instance_path, cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_options = {
+            **app.jinja_options,
+            "bytecode_cache": FileSystemBytecodeCache(cache_dir),
+        }
+
+    if app.config["DEBUG_TOOLBAR"]:
+        # only dev pays for importing the toolbar
+        from flask_debugtoolbar import DebugToolbarExtension
+
+        if app.debug:
+            app.config['SQLALCHEMY_ECHO'] = True
+        DebugToolbarExtension(app)
+
+    init_shared_cache(app)
+    connect_db(app)
+    init_entity_cache(app)
+    init_invalidation_bus(app)
+    init_metrics(app)
+    init_slow_queries(app)
+    init_assets(app)
+    init_images(app)
+    init_suggest(app)
+    init_recommendations(app)
+    app.register_blueprint(views)
+    init_profiling(app)
+    app.cli.add_command(compile_templates_command)
+    app.cli.add_command(create_indexes_command)
+    app.cli.add_command(refresh_summaries_command)
+    app.cli.add_command(importer.import_cafes_command)
+    init_compression(app)
+
+    if app.config["WARM_UP"]:
+        warm_up(app)
+
+    return app
+
+
+def warm_up(app):
+    """Do first-request work up front: open pool connections, compile
+    every template, configure the ORM mappers, and load the cities and
+    the search suggestions."""
+
+    with app.app_context():
+        open_connections(app)
+        compile_templates(app)
+        configure_mappers()
+        city_registry.load()
+        app.extensions["suggest"].load()
+
+
+def open_connections(app):
+    """Fill the pool with WARM_UP_CONNECTIONS connections."""
+
+    with app.app_context():
+        conns = [db.engine.connect()
+                 for _ in range(app.config["WARM_UP_CONNECTIONS"])]
+        for conn in conns:
+            conn.close()
 
-from models import db, connect_db, Cafe, City, User, DEFAULT_USER_IMAGE, DEFAULT_CAFE_IMAGE
-from forms import CafeForm, SignupForm, LoginForm, ProfileEditForm
+
+#######################################
+# preforking servers
+
+
+def before_fork(app):
+    """In a parent process about to fork workers off a loaded `app`
+    (gunicorn --preload): close its connections, so no worker inherits
+    a socket another process is using, and freeze everything loaded so
+    far out of the garbage collector, whose bookkeeping writes would
+    otherwise copy the shared pages into every worker. The invalidation
+    listener stops too: threads don't survive a fork."""
+
+    bus = app.extensions.get("invalidation_bus")
+    if bus is not None:
+        bus.stop()
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+    gc.freeze()
+
+
+def after_fork(app):
+    """In each forked worker, before it serves: start its own connection
+    pools and invalidation listener, and warm up. Inherited connections
+    are dropped without being closed, since closing them would close the
+    parent's too."""
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    mapquest.client.reset()
+    if "images" in app.extensions:
+        app.extensions["images"].fetcher.reset()
+
+    bus = app.extensions.get("invalidation_bus")
+    if bus is not None:
+        bus.start()
+
+    if app.config["WARM_UP"]:
+        open_connections(app)
 
 
-app = Flask(__name__)
+def compile_templates(app):
+    """Compile every template; with TEMPLATE_CACHE_DIR set this also
+    writes each one's bytecode there for other workers to load."""
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
-    "DATABASE_URL", 'postgresql:///flask_cafe')
-app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY", "shhhh")
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
 
-if app.debug:
-    app.config['SQLALCHEMY_ECHO'] = True
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+@click.command("compile-templates")
+@with_appcontext
+def compile_templates_command():
+    """Precompile all templates into the bytecode cache (a build step)."""
 
-toolbar = DebugToolbarExtension(app)
+    if not current_app.config["TEMPLATE_CACHE_DIR"]:
+        raise click.UsageError("TEMPLATE_CACHE_DIR isn't set for this config.")
+
+    compile_templates(current_app)
+    click.echo(f"Compiled {len(current_app.jinja_env.list_templates())} templates.")
+
+
+@click.command("create-indexes")
+@with_appcontext
+def create_indexes_command():
+    """Create any index declared in models.py that the DB is missing."""
+
+    try:
+        created = create_missing_indexes(db.engine)
+    except DuplicateKeysError as e:
+        raise click.ClickException(
+            "Existing rows break these unique indexes; fix them (say, rename "
+            "all but one of the usernames that differ only in case) and run "
+            f"this again:\n{e}")
+    click.echo(f"Created {', '.join(created)}." if created else "No indexes missing.")
 
-connect_db(app)
 
 #######################################
 # auth & auth routes
@@ -32,12 +203,12 @@ CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = cached_get(User, session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -56,7 +227,8 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
+@query_budget(2)
 def signup():
     """Handle user signup.
 
@@ -99,7 +271,8 @@ def signup():
         return render_template('auth/signup-form.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
+@query_budget(1)
 def login():
     """Handle user login. Redirects on success to cafe list."""
 
@@ -119,7 +292,8 @@ def login():
     return render_template('auth/login-form.html', form=form)
 
 
-@app.post('/logout')
+@views.post('/logout')
+@query_budget(1)
 def logout():
     """Handle logout of user. Redirects to homepage."""
 
@@ -132,36 +306,69 @@ def logout():
 #######################################
 # homepage
 
-@app.get("/")
+@views.get("/")
+@shared_cache
+@query_budget(2)
 def homepage():
-    """render homepage"""
+    """render homepage, with each city's cafe count, likes and most liked
+    cafes (precomputed, see summaries.py)"""
+
+    summaries = (CitySummary.query
+                 .order_by(CitySummary.like_count.desc(), CitySummary.city_code)
+                 .all())
+    # a city added since the registry last loaded waits for the reload
+    cities = [(summary, summary.get_city_info()) for summary in summaries
+              if summary.get_city_info()]
 
-    return render_template("homepage.html")
+    return render_template("homepage.html", cities=cities)
 
 
 #######################################
 # cafes
 
 
-@app.get('/cafes')
+def save_map_or_warn(cafe):
+    """Save the cafe's map; if MapQuest is down, keep the cafe and warn."""
+
+    try:
+        with timer("mapquest"):
+            cafe.save_map()
+    except MapQuestError:
+        flash("Map is unavailable right now.", "warning")
+
+
+@views.get('/cafes')
+@read_only
+@shared_cache
+@query_budget(2)
 def cafe_list():
-    """Render page of all the cafes in abc order"""
+    """Render page of all the cafes in abc order, optionally only those
+    whose name contains ?q=. Streamed, so long lists start arriving
+    right away."""
 
-    cafes = Cafe.query.order_by('name').all()
+    q = request.args.get("q", "").strip()
 
-    return render_template('cafe/list.html', cafes=cafes)
+    return stream_page(
+        'cafe/list.html', q=q,
+        cafes=LazyRows(Cafe.listing(q), current_app.config["STREAM_BATCH_SIZE"]))
 
 
-@app.get('/cafes/<int:cafe_id>')
+@views.get('/cafes/<int:cafe_id>')
+@read_only
+@shared_cache
+@query_budget(3)
 def cafe_detail(cafe_id):
-    """Render page for a given cafe's details"""
+    """Render page for a given cafe's details, with the cafes most liked
+    by the people who liked it"""
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = cached_get_or_404(Cafe, cafe_id)
 
-    return render_template('cafe/detail.html', cafe=cafe)
+    return render_template('cafe/detail.html', cafe=cafe,
+                           related=cafe.get_related_cafes().all())
 
 
-@app.route("/cafes/add", methods=["GET", "POST"])
+@views.route("/cafes/add", methods=["GET", "POST"])
+@query_budget(5)
 def add_Cafe():
     """Renders the form or adds the cafe to the db given form data"""
 
@@ -172,7 +379,7 @@ def add_Cafe():
 
     form = CafeForm()
 
-    form.city_code.choices = City.get_cities()
+    form.city_code.choices = city_registry.choices
 
     if form.validate_on_submit():
         cafe = Cafe(
@@ -187,9 +394,10 @@ def add_Cafe():
         db.session.add(cafe)
 
         db.session.flush()
-        cafe.save_map()
+        save_map_or_warn(cafe)
 
         db.session.commit()
+        purge("/", "/cafes")
 
         flash(f"Added {cafe.name}.", "success")
         return redirect(f"/cafes/{cafe.id}")
@@ -197,7 +405,8 @@ def add_Cafe():
         return render_template("/cafe/add-form.html", form=form)
 
 
-@app.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@views.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@query_budget(7)
 def edit_cafe(cafe_id):
     """Renders form or sends form data for editing a cafe"""
 
@@ -205,10 +414,10 @@ def edit_cafe(cafe_id):
         flash("Access Denied", "danger")
         return redirect("/cafes")
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = cached_get_or_404(Cafe, cafe_id)
 
     form = CafeForm(obj=cafe)
-    form.city_code.choices = City.get_cities()
+    form.city_code.choices = city_registry.choices
 
     if form.validate_on_submit():
         new_map = (cafe.address != form.address.data or \
@@ -223,9 +432,10 @@ def edit_cafe(cafe_id):
 
         if new_map:
             db.session.flush()
-            cafe.save_map()
+            save_map_or_warn(cafe)
 
         db.session.commit()
+        purge("/", "/cafes", f"/cafes/{cafe.id}")
 
         flash(f"Edited {cafe.name}.", "success")
         return redirect(f"/cafes/{cafe.id}")
@@ -234,7 +444,8 @@ def edit_cafe(cafe_id):
         return render_template("cafe/edit-form.html", cafe=cafe, form=form)
 
 
-@app.post("/cafes/<int:cafe_id>/delete")
+@views.post("/cafes/<int:cafe_id>/delete")
+@query_budget(9)
 def delete_cafe(cafe_id):
     """deletes a cafe from the db"""
 
@@ -242,21 +453,51 @@ def delete_cafe(cafe_id):
         flash("Access Denied", "danger")
         return redirect("/cafes")
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    cafe = cached_get_or_404(Cafe, cafe_id)
 
-    for like in cafe.liking_users:
-        db.session.delete(like)
+    Like.query.filter_by(cafe_id=cafe.id).delete()
 
     db.session.delete(cafe)
     db.session.commit()
+    purge("/", "/cafes", f"/cafes/{cafe_id}")
 
     flash(f'{cafe.name} has been deleted.', "danger")
     return redirect("/cafes")
 
+
+# no query budget: statements grow with the file, a batch at a time
+@views.route("/cafes/import", methods=["GET", "POST"])
+def import_cafes():
+    """Admin only. Renders the upload form, or imports the uploaded CSV
+    or JSONL of cafes and shows what was imported and any bad rows.
+    Maps are fetched in the background afterwards."""
+
+    if not g.user or not g.user.admin:
+        flash("Access Denied", "danger")
+        return redirect("/cafes")
+
+    form = CafeImportForm()
+
+    if not form.validate_on_submit():
+        return render_template("cafe/import.html", form=form)
+
+    upload = form.file.data
+    result = importer.import_cafes(
+        upload.stream, importer.detect_format(upload.filename),
+        maps=importer.background_maps(current_app))
+
+    if result.imported:
+        purge("/", "/cafes")
+
+    flash(result.summary(), "success" if not result.errors else "warning")
+    return render_template("cafe/import.html", form=form, result=result)
+
 #########################################################
 # users
 
-@app.get('/profile')
+@views.get('/profile')
+@read_only
+@query_budget(2)
 def profile():
     """Render Page for user profile information"""
 
@@ -264,10 +505,15 @@ def profile():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/login")
 
-    return render_template("profile/detail.html", user=g.user)
+    liked_cafes = LazyRows(g.user.get_liked_cafes(),
+                           current_app.config["STREAM_BATCH_SIZE"])
+
+    return stream_page("profile/detail.html", user=g.user,
+                       liked_cafes=liked_cafes)
 
 
-@app.route('/profile/edit', methods=["GET", "POST"])
+@views.route('/profile/edit', methods=["GET", "POST"])
+@query_budget(3)
 def profile_edit():
     """Renders form or sends form data for editing a user profile"""
 
@@ -295,7 +541,9 @@ def profile_edit():
         return render_template('profile/edit-form.html', form=form)
 
 
-@app.get("/api/likes")
+@views.get("/api/likes")
+@read_only
+@query_budget(3)
 def check_like_cafe():
     """Given a query string of cafe id, checks if a user likes a cafe
     If logged in, returns JSON:
@@ -308,14 +556,15 @@ def check_like_cafe():
         return jsonify({"error": "Not logged in"})
 
     cafe_id = int(request.args['cafe_id'])
-    current_cafe = Cafe.query.get_or_404(cafe_id)
+    current_cafe = cached_get_or_404(Cafe, cafe_id)
 
     like = current_cafe in g.user.liked_cafes
 
     return jsonify({"likes": like})
 
 
-@app.post("/api/like")
+@views.post("/api/like")
+@query_budget(8)
 def like_cafe():
     """Passing a cafe id as JSON:
     {
@@ -331,7 +580,7 @@ def like_cafe():
         return jsonify({"error": "Not logged in"})
 
     cafe_id = int(request.json['cafe_id'])
-    current_cafe = Cafe.query.get_or_404(cafe_id)
+    current_cafe = cached_get_or_404(Cafe, cafe_id)
 
     g.user.liked_cafes.append(current_cafe)
     db.session.commit()
@@ -340,7 +589,8 @@ def like_cafe():
     return jsonify(response)
 
 
-@app.post("/api/unlike")
+@views.post("/api/unlike")
+@query_budget(8)
 def unlike_cafe():
     """Passing a cafe id as JSON:
     {
@@ -356,7 +606,7 @@ def unlike_cafe():
         return jsonify({"error": "Not logged in"})
 
     cafe_id = int(request.json['cafe_id'])
-    current_cafe = Cafe.query.get_or_404(cafe_id)
+    current_cafe = cached_get_or_404(Cafe, cafe_id)
 
     g.user.liked_cafes.remove(current_cafe)
     db.session.commit()
@@ -365,8 +615,25 @@ def unlike_cafe():
     return jsonify(response)
 
 
+@views.get("/api/pools")
+@query_budget(1)
+def show_pool_stats():
+    """Admin only. Returns JSON of connection pool usage (and replica lag)
+    per database bind:
+    {
+        "primary": {"status": "...", "checked_out": 1, "size": 5},
+        "replica0": {..., "lag": 0.2}
+    }
+    """
+
+    if not g.user or not g.user.admin:
+        return jsonify({"error": "Access Denied"})
+
+    return jsonify(pool_stats())
+
+
 ##########################################################
 #404
-@app.errorhandler(404)
+@views.app_errorhandler(404)
 def not_found(e):
     return render_template("404.html")
\ No newline at end of file
@@ -0,0 +1,248 @@
+"""ASGI entry point: the JSON like API runs as coroutines.
+
+    uvicorn asgi:app --workers 4
+
+GET /api/likes, POST /api/like and POST /api/unlike are served here by
+coroutines on SQLAlchemy's asyncio engine (asyncpg for Postgres,
+aiosqlite for SQLite), so a request waiting on the database holds no
+thread. Every other path goes to the regular Flask app, which asgiref's
+WsgiToAsgi runs in a thread pool.
+
+Likes are written through an AsyncSession whose session class is
+db.session's, so the same session hooks run as for the Flask views:
+city summaries, related cafes, the suggest index and the invalidation
+bus all see them.
+
+Needs the async extras: asgiref, asyncpg (or aiosqlite) and an ASGI
+server such as uvicorn. Compare with the sync workers using
+`python -m benchmarks.concurrency`.
+
+Requests served here aren't counted in /metrics and don't go to read
+replicas.
+
+FLASK_CAFE_CONFIG picks the profile (default "production", as in wsgi.py).
+"""
+
+import json
+import os
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from sqlalchemy import exists, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import create_app, CURR_USER_KEY
+from models import db, Cafe, Like
+
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url):
+    """Return the same database URL with an asyncio driver."""
+
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+class AsyncBoundSession(db.session.session_factory.class_):
+    """db.session's class (the one its sessionmaker made, which the
+    hooks listen on), but bound to the async engine the AsyncSession
+    was given rather than db's sync ones."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        return bind or self.bind
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.args = {k: v[0] for k, v in
+                     parse_qs(scope["query_string"].decode("latin-1")).items()}
+
+        headers = {k.decode("latin-1"): v.decode("latin-1")
+                   for k, v in scope["headers"]}
+        self.cookies = SimpleCookie(headers.get("cookie", ""))
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400, "Bad Request")
+
+
+class AsyncAPI:
+    """The like API as an ASGI app; other requests go to `fallback`."""
+
+    def __init__(self, flask_app, fallback):
+        self.flask_app = flask_app
+        self.fallback = fallback
+        self.engine = None
+        self.sessions = None
+
+        self.routes = {
+            ("GET", "/api/likes"): self.check_like_cafe,
+            ("POST", "/api/like"): self.like_cafe,
+            ("POST", "/api/unlike"): self.unlike_cafe,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        handler = self.routes.get((scope.get("method"), scope.get("path")))
+        if handler is None:
+            return await self.fallback(scope, receive, send)
+
+        request = Request(scope, await read_body(receive))
+        try:
+            status, data = 200, await handler(request)
+        except HTTPError as e:
+            status, data = e.status, {"error": e.message}
+
+        await send_json(send, status, data)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message["type"] == "lifespan.startup":
+                self.engine = create_async_engine(async_url(
+                    self.flask_app.config["SQLALCHEMY_DATABASE_URI"]))
+                self.sessions = async_sessionmaker(
+                    self.engine, sync_session_class=AsyncBoundSession,
+                    expire_on_commit=False, db=db)
+                await send({"type": "lifespan.startup.complete"})
+
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def current_user_id(self, request):
+        """The logged-in user's id, read from Flask's session cookie."""
+
+        app = self.flask_app
+        cookie = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+        if cookie is None:
+            return None
+
+        serializer = app.session_interface.get_signing_serializer(app)
+        try:
+            session = serializer.loads(
+                cookie.value,
+                max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+
+        return session.get(CURR_USER_KEY)
+
+    def cafe_id(self, data):
+        try:
+            return int(data["cafe_id"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPError(400, "Bad Request")
+
+    async def check_like_cafe(self, request):
+        """GET /api/likes?cafe_id=3 -> {"likes": true (or false)}"""
+
+        user_id = self.current_user_id(request)
+        if user_id is None:
+            return {"error": "Not logged in"}
+
+        cafe_id = self.cafe_id(request.args)
+        likes = exists().where(Like.user_id == user_id,
+                               Like.cafe_id == Cafe.id)
+
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(
+                select(likes.label("likes")).where(Cafe.id == cafe_id))).first()
+
+        if row is None:
+            raise HTTPError(404, "Not Found")
+        return {"likes": bool(row.likes)}
+
+    async def like_cafe(self, request):
+        """POST /api/like {"cafe_id": 3} -> {"liked": 3}"""
+
+        user_id = self.current_user_id(request)
+        if user_id is None:
+            return {"error": "Not logged in"}
+
+        cafe_id = self.cafe_id(request.json())
+
+        # the session hooks look for the app in the context
+        with self.flask_app.app_context():
+            async with self.sessions() as session:
+                await self.get_cafe_or_404(session, cafe_id)
+                if await session.get(Like, (user_id, cafe_id)) is None:
+                    session.add(Like(user_id=user_id, cafe_id=cafe_id))
+                    try:
+                        await session.commit()
+                    except IntegrityError:
+                        pass  # liked meanwhile, by another request
+
+        return {"liked": cafe_id}
+
+    async def unlike_cafe(self, request):
+        """POST /api/unlike {"cafe_id": 3} -> {"unliked": 3}"""
+
+        user_id = self.current_user_id(request)
+        if user_id is None:
+            return {"error": "Not logged in"}
+
+        cafe_id = self.cafe_id(request.json())
+
+        with self.flask_app.app_context():
+            async with self.sessions() as session:
+                await self.get_cafe_or_404(session, cafe_id)
+                like = await session.get(Like, (user_id, cafe_id))
+                if like is not None:
+                    await session.delete(like)
+                    await session.commit()
+
+        return {"unliked": cafe_id}
+
+    async def get_cafe_or_404(self, session, cafe_id):
+        if (await session.execute(
+                select(Cafe.id).where(Cafe.id == cafe_id))).first() is None:
+            raise HTTPError(404, "Not Found")
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_json(send, status, data):
+    body = json.dumps(data).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+flask_app = create_app(os.environ.get("FLASK_CAFE_CONFIG", "production"))
+app = AsyncAPI(flask_app, WsgiToAsgi(flask_app))
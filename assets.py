@@ -0,0 +1,361 @@
+"""Static asset pipeline for Flask Cafe.
+
+Third-party CSS/JS (Bootswatch, Bootstrap, jQuery, Bootstrap Icons) is
+vendored under static/vendor at pinned versions, then bundled with our
+own files into content-hashed files under static/dist:
+
+    flask assets vendor     # download the pinned third-party files
+    flask assets build      # bundle, minify and fingerprint them
+
+Every vendored file must match the digest pinned for it in
+VENDOR_INTEGRITY (in the format of an HTML `integrity` attribute), or
+it isn't written: a CDN serving something else fails the download.
+
+The build bundles whatever sources are there. A vendored file that
+isn't (unpinned, or `vendor` never ran) is reported and linked from its
+CDN in its place, splitting the bundle around it, so the order of the
+CSS and JS is kept.
+
+Templates link a bundle with `asset_urls("app.css")`. Once built (and
+with ASSETS_BUNDLED on) that's its fingerprinted file(s), served with
+an immutable Cache-Control and announced in a preload Link header on
+HTML pages. Unbuilt, or in development, it's each source file, served
+locally if vendored and from its CDN otherwise.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import posixpath
+import re
+import shutil
+
+import click
+import requests
+from flask import current_app, request, url_for
+from flask.cli import AppGroup
+
+try:
+    import rjsmin
+except ImportError:  # pragma: no cover - optional
+    rjsmin = None
+
+
+# path under static/ -> where `flask assets vendor` downloads it from
+VENDOR = {
+    "vendor/bootswatch-lux.min.css":
+        "https://unpkg.com/bootswatch@4.6.2/dist/lux/bootstrap.min.css",
+    "vendor/bootstrap-icons/bootstrap-icons.min.css":
+        "https://unpkg.com/bootstrap-icons@1.11.3/font/bootstrap-icons.min.css",
+    "vendor/bootstrap-icons/fonts/bootstrap-icons.woff2":
+        "https://unpkg.com/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff2",
+    "vendor/bootstrap-icons/fonts/bootstrap-icons.woff":
+        "https://unpkg.com/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff",
+    "vendor/jquery.min.js":
+        "https://unpkg.com/jquery@3.7.1/dist/jquery.min.js",
+    "vendor/bootstrap.bundle.min.js":
+        "https://unpkg.com/bootstrap@4.6.2/dist/js/bootstrap.bundle.min.js",
+}
+
+# path under static/ -> "<algorithm>-<base64 digest>" its download must
+# match. To pin a file:
+#     curl -s <url> | openssl dgst -sha256 -binary | openssl base64 -A
+# Files without a pin here are refused (and the build links them from
+# their CDN).
+VENDOR_INTEGRITY = {
+    "vendor/jquery.min.js":
+        "sha256-/JqT3SQfawRcv/BIHPThkBvs0OEvtFFmqPF/lYI/Cxo=",
+    # as published in Bootstrap's own docs
+    "vendor/bootstrap.bundle.min.js":
+        "sha384-Fy6S3B9q64WdZWQUiU+q4/2Lc9npb8tCaSX9FK7E8HnRr0Jz8D6OP9dO5Vg3Q9ct",
+}
+
+# bundle name -> its sources under static/, in order
+BUNDLES = {
+    "app.css": [
+        "vendor/bootswatch-lux.min.css",
+        "vendor/bootstrap-icons/bootstrap-icons.min.css",
+        "style.css",
+    ],
+    "app.js": [
+        "vendor/jquery.min.js",
+        "vendor/bootstrap.bundle.min.js",
+        "likes.js",
+        "suggest.js",
+    ],
+}
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+PRELOAD_AS = {".css": "style", ".js": "script"}
+
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+CSS_IMPORT_RE = re.compile(
+    r"""@import\s+(?:url\([^)]*\)|"[^"]*"|'[^']*')[^;]*;""")
+CSS_TOKEN_RE = re.compile(
+    r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(/\*.*?\*/)""", re.S)
+
+
+#######################################
+# building
+
+
+def fingerprint(name, content):
+    """'app.css' -> 'app.<hash of content>.css'"""
+
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def minify_css(css):
+    """Drop comments (but not /*! license */ ones) and needless
+    whitespace, leaving strings alone."""
+
+    out = []
+    pos = 0
+    for match in CSS_TOKEN_RE.finditer(css):
+        out.append(_squeeze_css(css[pos:match.start()]))
+        if match.group(1) or match.group(2).startswith("/*!"):
+            out.append(match.group(0))
+        pos = match.end()
+    out.append(_squeeze_css(css[pos:]))
+    return "".join(out).strip()
+
+
+def _squeeze_css(css):
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r" ?([{};,]) ?", r"\1", css)
+
+
+def minify_js(js):
+    return rjsmin.jsmin(js) if rjsmin else js
+
+
+def build_css(static_folder, dist, sources):
+    """Concatenate CSS, copying the files it references (fonts, images)
+    into `dist` under fingerprinted names and pointing url()s at them."""
+
+    imports, parts = [], []
+
+    for source in sources:
+        with open(os.path.join(static_folder, source), encoding="utf8") as file:
+            css = file.read()
+
+        base = posixpath.dirname(source)
+
+        def rewrite(match):
+            url = match.group(2)
+            if url.startswith(("data:", "http:", "https:", "//", "/", "#")):
+                return match.group(0)
+            url = re.split(r"[?#]", url)[0]
+            path = posixpath.normpath(posixpath.join(base, url))
+            with open(os.path.join(static_folder, path), "rb") as file:
+                content = file.read()
+            name = fingerprint(posixpath.basename(path), content)
+            with open(os.path.join(dist, name), "wb") as file:
+                file.write(content)
+            return f'url("{name}")'
+
+        css = CSS_URL_RE.sub(rewrite, css)
+        # @import is only valid before any rule, so hoist them all
+        imports.extend(CSS_IMPORT_RE.findall(css))
+        parts.append(CSS_IMPORT_RE.sub("", css))
+
+    return minify_css("\n".join(imports + parts))
+
+
+def build_js(static_folder, sources):
+    parts = []
+    for source in sources:
+        with open(os.path.join(static_folder, source), encoding="utf8") as file:
+            js = file.read()
+        parts.append(js if source.endswith(".min.js") else minify_js(js))
+    # a ; between files in case one doesn't end its last statement
+    return "\n;\n".join(parts)
+
+
+def build_bundle(static_folder, dist, name, sources):
+    """Write `sources` as one fingerprinted file of bundle `name`; return
+    (file name, size)."""
+
+    if name.endswith(".css"):
+        content = build_css(static_folder, dist, sources)
+    else:
+        content = build_js(static_folder, sources)
+
+    content = content.encode("utf8")
+    filename = fingerprint(name, content)
+    with open(os.path.join(dist, filename), "wb") as file:
+        file.write(content)
+    return filename, len(content)
+
+
+def build(static_folder, bundles=BUNDLES, log=print):
+    """Write every bundle into static/dist and return the manifest:
+    bundle name -> its parts in order, each a file in static/dist or
+    the CDN URL of a vendored source that isn't there."""
+
+    dist = os.path.join(static_folder, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+    os.makedirs(dist)
+
+    manifest = {}
+    for name, sources in bundles.items():
+        parts, run = [], []
+        # (None flushes the last run)
+        for source in [*sources, None]:
+            if source is not None and not (
+                    source in VENDOR and
+                    not os.path.exists(os.path.join(static_folder, source))):
+                run.append(source)
+                continue
+
+            if run:
+                filename, size = build_bundle(static_folder, dist, name, run)
+                parts.append(filename)
+                log(f"{name}: {len(run)} files -> {DIST}/{filename} ({size:,} bytes)")
+                run = []
+            if source is not None:
+                parts.append(VENDOR[source])
+                log(f"{name}: {source} is missing; linked from {VENDOR[source]}")
+
+        manifest[name] = parts
+
+    with open(os.path.join(dist, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    return manifest
+
+
+class IntegrityError(Exception):
+    """Raised when a downloaded file doesn't match its pinned digest."""
+
+
+def check_integrity(path, content, pins=VENDOR_INTEGRITY):
+    """Raise IntegrityError unless `content` matches the digest pinned
+    for `path`."""
+
+    pinned = pins.get(path)
+    if pinned is None:
+        raise IntegrityError(f"{path}: no digest pinned in VENDOR_INTEGRITY")
+
+    algorithm, _, expected = pinned.partition("-")
+    actual = base64.b64encode(hashlib.new(algorithm, content).digest()).decode()
+    if not hmac.compare_digest(actual, expected):
+        raise IntegrityError(f"{path}: expected {pinned}, got {algorithm}-{actual}")
+
+
+def vendor(static_folder, files=VENDOR, pins=VENDOR_INTEGRITY, log=print):
+    """Download the pinned third-party files into static/vendor. Files
+    that don't match their pin are left out; raise IntegrityError
+    listing them at the end."""
+
+    failed = []
+    for path, url in files.items():
+        response = requests.get(url, timeout=30)
+        response.raise_for_status()
+        try:
+            check_integrity(path, response.content, pins)
+        except IntegrityError as e:
+            failed.append(str(e))
+            continue
+
+        target = os.path.join(static_folder, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as file:
+            file.write(response.content)
+        log(f"{path}: {len(response.content):,} bytes")
+
+    if failed:
+        raise IntegrityError("\n".join(failed))
+
+
+assets_command = AppGroup("assets", help="Vendor and build static assets.")
+
+
+@assets_command.command("vendor")
+def vendor_command():
+    """Download pinned third-party CSS/JS into static/vendor."""
+
+    try:
+        vendor(current_app.static_folder, log=click.echo)
+    except IntegrityError as e:
+        raise click.ClickException(f"Not vendored:\n{e}")
+
+
+@assets_command.command("build")
+def build_command():
+    """Bundle, minify and fingerprint static assets into static/dist."""
+
+    # vendored files can come from their CDN instead; our own can't
+    missing = [source for sources in BUNDLES.values() for source in sources
+               if source not in VENDOR and
+               not os.path.exists(os.path.join(current_app.static_folder, source))]
+    if missing:
+        raise click.UsageError(f"Missing {', '.join(missing)}.")
+
+    build(current_app.static_folder, log=click.echo)
+
+
+#######################################
+# serving
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_urls(name):
+    """URLs to link for bundle `name`: its built parts if built, else
+    each of its sources."""
+
+    app = current_app
+    manifest = app.extensions["assets"]
+    if name in manifest:
+        return [part if "://" in part else url_for("static", filename=f"{DIST}/{part}")
+                for part in manifest[name]]
+
+    urls = []
+    for source in BUNDLES[name]:
+        if source in VENDOR and not os.path.exists(
+                os.path.join(app.static_folder, source)):
+            urls.append(VENDOR[source])
+        else:
+            urls.append(url_for("static", filename=source))
+    return urls
+
+
+def _asset_headers(response):
+    if request.endpoint == "static":
+        if (request.view_args["filename"].startswith(f"{DIST}/") and
+                response.status_code == 200):
+            response.headers["Cache-Control"] = IMMUTABLE
+
+    elif response.mimetype == "text/html":
+        # lets the browser (or a proxy, as 103 Early Hints) start on the
+        # bundles before it has parsed <head>
+        links = [
+            f"<{url}>; rel=preload; as={PRELOAD_AS[os.path.splitext(name)[1]]}"
+            for name in current_app.extensions["assets"]
+            for url in asset_urls(name)
+        ]
+        if links:
+            response.headers.add("Link", ", ".join(links))
+
+    return response
+
+
+def init_assets(app):
+    app.extensions["assets"] = (load_manifest(app.static_folder)
+                                if app.config["ASSETS_BUNDLED"] else {})
+    app.add_template_global(asset_urls)
+    app.after_request(_asset_headers)
+    app.cli.add_command(assets_command)
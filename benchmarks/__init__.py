@@ -0,0 +1 @@
+"""Benchmarks for Flask Cafe. Run each with `python -m benchmarks.<name>`."""
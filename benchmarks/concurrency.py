@@ -0,0 +1,176 @@
+"""Compare how many concurrent connections the sync (WSGI) and async
+(ASGI, asgi.py) deployments handle on the JSON like API.
+
+Seeds a benchmark database, then for each mode starts the server and,
+at each `--levels` concurrency, keeps that many logged-in connections
+busy for `--duration` seconds checking and toggling likes. Reports
+requests/sec, p50/p99 latency and errors per mode and level; capacity
+is where throughput stops growing and latency or errors take off.
+
+    python -m benchmarks.concurrency --database-url postgresql:///flask_cafe_bench \\
+        --levels 10,50,200,500 [--out results.json]
+
+The server commands are templates; `{port}` is filled in. Defaults need
+gunicorn (sync) and uvicorn plus asgi.py's async extras (async).
+Seeding DROPS AND RECREATES every table in that database.
+"""
+
+import argparse
+import json
+import os
+import random
+import shlex
+import subprocess
+import threading
+import time
+
+import requests
+
+from benchmarks.loadtest import CSRF_RE, percentile, seed
+
+
+MODES = {
+    "sync": "gunicorn -c gunicorn.conf.py --workers 4 --threads 8 "
+            "--bind 127.0.0.1:{port} wsgi:app",
+    "async": "uvicorn asgi:app --workers 4 --port {port} --no-access-log",
+}
+
+
+def start_server(command, database_url, port):
+    env = dict(os.environ, DATABASE_URL=database_url,
+               FLASK_CAFE_CONFIG="production")
+    server = subprocess.Popen(shlex.split(command.format(port=port)), env=env)
+
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{base}/login", timeout=1)
+            return server, base
+        # a worker still loading the app can hold the first request
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError(f"server didn't start: {command}")
+
+
+def login(base, username):
+    http = requests.Session()
+    token = CSRF_RE.search(http.get(f"{base}/login").text).group(1)
+    http.post(f"{base}/login", allow_redirects=False, data={
+        "csrf_token": token, "username": username, "password": "secret",
+    })
+    return http.cookies
+
+
+def client(base, cookies, cafes, rng, until, record):
+    """One connection checking likes, and toggling one in five."""
+
+    http = requests.Session()
+    http.cookies.update(cookies)
+
+    while time.monotonic() < until:
+        cafe_id = rng.randint(1, cafes)
+        start = time.perf_counter()
+        try:
+            resp = http.get(f"{base}/api/likes", params={"cafe_id": cafe_id},
+                            timeout=30)
+            ok = resp.status_code == 200
+            if ok and rng.random() < 0.2:
+                path = "/api/unlike" if resp.json()["likes"] else "/api/like"
+                ok = http.post(base + path, json={"cafe_id": cafe_id},
+                               timeout=30).status_code == 200
+        except requests.RequestException:
+            ok = False
+        record(time.perf_counter() - start, ok)
+
+
+def run_level(base, users, cafes, connections, duration, seed_value):
+    samples = []
+    lock = threading.Lock()
+
+    def record(latency, ok):
+        with lock:
+            samples.append((latency, ok))
+
+    # a handful of logins shared between the connections
+    cookies = [login(base, f"user{i}") for i in range(min(users, 20))]
+
+    until = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=client, args=(
+            base, cookies[i % len(cookies)], cafes,
+            random.Random(seed_value * 1000 + i), until, record))
+        for i in range(connections)
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(latency for latency, _ in samples) or [0.0]
+    return {
+        "requests": len(samples),
+        "errors": sum(not ok for _, ok in samples),
+        "rps": round(len(samples) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="postgresql:///flask_cafe_bench")
+    parser.add_argument("--levels", default="10,50,100,200,500",
+                        help="comma-separated concurrent connection counts")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per level")
+    parser.add_argument("--port", type=int, default=5056)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cafes", type=int, default=500)
+    parser.add_argument("--bench-users", type=int, default=200)
+    parser.add_argument("--sync-cmd", default=MODES["sync"])
+    parser.add_argument("--async-cmd", default=MODES["async"])
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--no-seed", action="store_true",
+                        help="reuse the data already in the database")
+    parser.add_argument("--out", help="write results JSON here")
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        seed(args.database_url, 10, args.cafes, args.bench_users, 20, args.seed)
+
+    commands = {"sync": args.sync_cmd, "async": args.async_cmd}
+    levels = [int(level) for level in args.levels.split(",")]
+    results = {}
+
+    for mode in args.modes.split(","):
+        server, base = start_server(commands[mode], args.database_url, args.port)
+        try:
+            results[mode] = {
+                level: run_level(base, args.bench_users, args.cafes, level,
+                                 args.duration, args.seed)
+                for level in levels
+            }
+        finally:
+            server.terminate()
+            server.wait()
+
+    header = f"{'mode':<6} {'conns':>6} {'rps':>8} {'p50':>8} {'p99':>9} {'errors':>7}"
+    print(header)
+    print("-" * len(header))
+    for mode, by_level in results.items():
+        for level, stats in by_level.items():
+            print(f"{mode:<6} {level:>6} {stats['rps']:>8} {stats['p50_ms']:>8} "
+                  f"{stats['p99_ms']:>9} {stats['errors']:>7}")
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Load test the main user flows and report throughput and latency.
+
+Seeds a benchmark database, starts the app (production profile) in a
+separate process and runs `--users` virtual users against it for
+`--duration` seconds. Each virtual user logs in, then loops over a mix
+of browsing /cafes, viewing cafe details, checking and toggling likes
+and viewing their profile.
+
+    python -m benchmarks.loadtest --database-url postgresql:///flask_cafe_bench \\
+        --out results.json [--compare previous.json]
+
+Seeding DROPS AND RECREATES every table in that database.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+
+# relative weight of each action in a virtual user's loop
+MIX = (
+    ("list", 30),
+    ("detail", 35),
+    ("check_like", 15),
+    ("toggle_like", 10),
+    ("profile", 10),
+)
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+#######################################
+# database & server
+
+
+def seed(database_url, cities, cafes, users, likes_per_user, seed_value):
+    """Drop everything and load a deterministic dataset."""
+
+    os.environ["DATABASE_URL"] = database_url
+
+    from generate_data import generate
+
+    # generate_data's first two users are admin & test; ours are user0...
+    generate(cities, cafes, users + 2, likes_per_user, seed=seed_value)
+
+
+def start_server(database_url, port):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.loadtest", "--serve", str(port)],
+        env=env,
+    )
+
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{base}/", timeout=1)
+            return server, base
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("server didn't start")
+
+
+def serve(port):
+    import logging
+    from werkzeug.serving import run_simple
+    from app import create_app
+
+    # a log line per request would skew the numbers
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    run_simple("127.0.0.1", port, create_app("production"), threaded=True)
+
+
+#######################################
+# virtual users
+
+
+class VirtualUser:
+    """One logged-in client working through the traffic mix."""
+
+    def __init__(self, base, user_number, cafes, rng, record):
+        self.base = base
+        self.username = f"user{user_number}"
+        self.cafes = cafes
+        self.rng = rng
+        self.record = record
+        self.http = requests.Session()
+
+    def request(self, label, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            resp = self.http.request(method, self.base + path,
+                                     allow_redirects=False, timeout=30, **kwargs)
+            ok = resp.status_code < 400
+        except requests.RequestException:
+            resp, ok = None, False
+        self.record(label, time.perf_counter() - start, ok)
+        return resp
+
+    def login(self):
+        resp = self.request("GET /login", "GET", "/login")
+        token = CSRF_RE.search(resp.text).group(1)
+        self.request("POST /login", "POST", "/login", data={
+            "csrf_token": token, "username": self.username, "password": "secret",
+        })
+
+    def run(self, until):
+        self.login()
+        actions, weights = zip(*MIX)
+
+        while time.monotonic() < until:
+            action = self.rng.choices(actions, weights)[0]
+            getattr(self, action)()
+
+    def list(self):
+        self.request("GET /cafes", "GET", "/cafes")
+
+    def detail(self):
+        cafe_id = self.rng.randint(1, self.cafes)
+        self.request("GET /cafes/<id>", "GET", f"/cafes/{cafe_id}")
+
+    def check_like(self):
+        cafe_id = self.rng.randint(1, self.cafes)
+        self.request("GET /api/likes", "GET", f"/api/likes?cafe_id={cafe_id}")
+
+    def toggle_like(self):
+        cafe_id = self.rng.randint(1, self.cafes)
+        resp = self.request("GET /api/likes", "GET", f"/api/likes?cafe_id={cafe_id}")
+        if resp is None or resp.status_code != 200:
+            return
+
+        if resp.json().get("likes"):
+            self.request("POST /api/unlike", "POST", "/api/unlike", json={"cafe_id": cafe_id})
+        else:
+            self.request("POST /api/like", "POST", "/api/like", json={"cafe_id": cafe_id})
+
+    def profile(self):
+        self.request("GET /profile", "GET", "/profile")
+
+
+#######################################
+# reporting
+
+
+def percentile(sorted_values, q):
+    return sorted_values[round(q * (len(sorted_values) - 1))]
+
+
+def summarize(samples, elapsed):
+    """Per-route and total requests/sec, error count and p50/p95/p99 (ms)."""
+
+    def stats(rows):
+        latencies = sorted(latency for latency, _ in rows)
+        return {
+            "requests": len(rows),
+            "errors": sum(not ok for _, ok in rows),
+            "rps": round(len(rows) / elapsed, 1),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        }
+
+    return {
+        "total": stats([row for rows in samples.values() for row in rows]),
+        "routes": {label: stats(rows) for label, rows in sorted(samples.items())},
+    }
+
+
+def print_report(results, previous=None):
+    header = f"{'route':<20} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>7}"
+    print(header)
+    print("-" * len(header))
+
+    rows = dict(results["routes"], TOTAL=results["total"])
+    for label, stats in rows.items():
+        line = (f"{label:<20} {stats['rps']:>8} {stats['p50_ms']:>8} "
+                f"{stats['p95_ms']:>8} {stats['p99_ms']:>8} {stats['errors']:>7}")
+
+        old = None
+        if previous:
+            old = (previous["total"] if label == "TOTAL"
+                   else previous["routes"].get(label))
+        if old:
+            rps = (stats["rps"] - old["rps"]) / old["rps"] * 100 if old["rps"] else 0
+            p95 = (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0
+            line += f"   rps {rps:+.1f}%  p95 {p95:+.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="postgresql:///flask_cafe_bench")
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--cities", type=int, default=10)
+    parser.add_argument("--cafes", type=int, default=500)
+    parser.add_argument("--bench-users", type=int, default=200,
+                        help="users in the dataset (>= --users)")
+    parser.add_argument("--likes-per-user", type=int, default=20)
+    parser.add_argument("--no-seed", action="store_true",
+                        help="reuse the data already in the database")
+    parser.add_argument("--out", help="write results JSON here")
+    parser.add_argument("--compare", help="previous results JSON to diff against")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve)
+
+    if not args.no_seed:
+        seed(args.database_url, args.cities, args.cafes, args.bench_users,
+             args.likes_per_user, args.seed)
+
+    server, base = start_server(args.database_url, args.port)
+    samples = {}
+    lock = threading.Lock()
+
+    def record(label, latency, ok):
+        with lock:
+            samples.setdefault(label, []).append((latency, ok))
+
+    try:
+        start = time.monotonic()
+        until = start + args.duration
+        threads = [
+            threading.Thread(target=VirtualUser(
+                base, i % args.bench_users, args.cafes,
+                random.Random(args.seed * 1000 + i), record).run, args=(until,))
+            for i in range(args.users)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = summarize(samples, elapsed)
+    results["config"] = {
+        key: getattr(args, key)
+        for key in ("users", "duration", "seed", "cities", "cafes",
+                    "bench_users", "likes_per_user")
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+
+    print_report(results, previous)
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
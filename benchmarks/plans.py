@@ -0,0 +1,143 @@
+"""Check that every hot query is planned with an index, not a full scan.
+
+Seeds a large dataset (or reuses one with --no-seed), runs EXPLAIN on
+each query in `hot_queries` and exits non-zero if any plan has a
+sequential scan of a table, printing the offending plan.
+
+    python -m benchmarks.plans --database-url postgresql:///flask_cafe_bench
+
+Works on Postgres (EXPLAIN (FORMAT JSON)) and SQLite (EXPLAIN QUERY
+PLAN). Keep `hot_queries` in step with the views it stands in for,
+ideally by building them the same way. A statement with `yield_per`
+set streams, which on Postgres is a server-side cursor: the planner
+plans those for the first rows (cursor_tuple_fraction), so its plan is
+checked as a cursor's.
+Seeding DROPS AND RECREATES every table in that database.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+from sqlalchemy import delete, func, select, text
+
+
+def hot_queries(conn):
+    """(description, statement) for each query that must use an index,
+    with parameters taken from the data."""
+
+    from config import Config
+    from models import Cafe, CafeNeighbor, Like, User
+
+    cafe_id, city_code = conn.execute(
+        select(Cafe.id, Cafe.city_code).order_by(Cafe.id).limit(1)).one()
+    user_id, username = conn.execute(
+        select(User.id, User.username).order_by(User.id).limit(1)).one()
+
+    return [
+        # the whole table, streamed in batches as cafe_list does
+        ("cafe list",
+         Cafe.listing().statement.execution_options(
+             yield_per=Config.STREAM_BATCH_SIZE)),
+        ("cafes in a city",
+         select(Cafe).where(Cafe.city_code == city_code)),
+        ("cafe detail",
+         select(Cafe).where(Cafe.id == cafe_id)),
+        ("login (User.authenticate)",
+         select(User).where(func.lower(User.username) == username.lower())),
+        ("liked cafes (profile, check_like_cafe)",
+         select(Cafe).join(Like, Like.cafe_id == Cafe.id)
+         .where(Like.user_id == user_id).order_by(Cafe.name)),
+        ("liking users",
+         select(User).join(Like, Like.user_id == User.id)
+         .where(Like.cafe_id == cafe_id)),
+        ("related cafes (cafe detail)",
+         select(Cafe).join(CafeNeighbor, CafeNeighbor.neighbor_id == Cafe.id)
+         .where(CafeNeighbor.cafe_id == cafe_id)),
+        ("delete a cafe's likes",
+         delete(Like).where(Like.cafe_id == cafe_id)),
+    ]
+
+
+def explain(conn, statement):
+    """Return (plan text, [tables read by a sequential scan])."""
+
+    sql = str(statement.compile(dialect=conn.dialect,
+                                compile_kwargs={"literal_binds": True}))
+
+    if conn.dialect.name == "postgresql":
+        if statement.get_execution_options().get("yield_per"):
+            sql = f"DECLARE plans_check NO SCROLL CURSOR FOR {sql}"
+        plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return json.dumps(plan, indent=2), list(_pg_seq_scans(plan[0]["Plan"]))
+
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+    details = [row[-1] for row in rows]
+    scans = []
+    for detail in details:
+        # "SCAN cafes" reads the table; "SCAN cafes USING INDEX ..." and
+        # "SEARCH cafes ..." don't
+        match = re.match(r"SCAN (?:TABLE )?(\w+)(.*)", detail)
+        if match and "USING" not in match.group(2):
+            scans.append(match.group(1))
+    return "\n".join(details), scans
+
+
+def _pg_seq_scans(node):
+    if node["Node Type"] == "Seq Scan":
+        yield node["Relation Name"]
+    for child in node.get("Plans", []):
+        yield from _pg_seq_scans(child)
+
+
+def check(conn, queries, log=print):
+    """EXPLAIN each query; return the descriptions of those that scan."""
+
+    failures = []
+    for description, statement in queries:
+        plan, scans = explain(conn, statement)
+        if scans:
+            failures.append(description)
+            log(f"FAIL {description}: sequential scan of {', '.join(scans)}\n{plan}\n")
+        else:
+            log(f"ok   {description}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="postgresql:///flask_cafe_bench")
+    parser.add_argument("--cities", type=int, default=50)
+    parser.add_argument("--cafes", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--likes-per-user", type=int, default=10)
+    parser.add_argument("--no-seed", action="store_true",
+                        help="reuse the data already in the database")
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = args.database_url
+
+    from generate_data import generate
+    from app import create_app
+    from models import db
+
+    if not args.no_seed:
+        generate(args.cities, args.cafes, args.users, args.likes_per_user)
+
+    app = create_app("testing")
+    with app.app_context():
+        with db.engine.connect() as conn:
+            # plans depend on up-to-date statistics
+            conn.execute(text("ANALYZE"))
+            failures = check(conn, hot_queries(conn))
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
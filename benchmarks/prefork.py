@@ -0,0 +1,112 @@
+"""Per-worker memory under gunicorn, with and without preloading.
+
+For each mode, starts `gunicorn -c gunicorn.conf.py wsgi:app` with
+`--workers` workers, sends every page a share of `--requests` requests
+so each worker has loaded what it serves, then reads each worker's
+/proc/<pid>/smaps_rollup (Linux only):
+
+- RSS: resident pages, shared ones counted in full
+- PSS: shared pages split between the processes sharing them
+- USS: pages only this worker has (what it would free on exit)
+
+    python -m benchmarks.prefork --database-url postgresql:///flask_cafe_bench \\
+        [--workers 4] [--out results.json]
+
+Reuses the data already in the database; seed it with loadtest or
+generate_data first.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+import requests
+
+from benchmarks.concurrency import start_server
+
+COMMAND = ("gunicorn -c gunicorn.conf.py --workers {workers} "
+           "--bind 127.0.0.1:{{port}} wsgi:app")
+PATHS = ["/", "/cafes", "/cafes/1", "/login", "/signup"]
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as file:
+        return [int(child) for child in file.read().split()]
+
+
+def memory(pid):
+    """{"rss": MB, "pss": MB, "uss": MB} for process `pid`."""
+
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+
+    return {
+        "rss": round(fields["Rss"], 1),
+        "pss": round(fields["Pss"], 1),
+        "uss": round(fields["Private_Clean"] + fields["Private_Dirty"], 1),
+    }
+
+
+def measure(database_url, port, workers, preload, requests_count):
+    os.environ["GUNICORN_PRELOAD"] = "1" if preload else "0"
+    server, base = start_server(COMMAND.format(workers=workers), database_url, port)
+    try:
+        http = requests.Session()
+        for i in range(requests_count):
+            http.get(base + PATHS[i % len(PATHS)], timeout=30)
+        # let the workers settle after the last response
+        time.sleep(1)
+
+        parent = memory(server.pid)
+        per_worker = [memory(pid) for pid in children(server.pid)]
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        "parent": parent,
+        "workers": per_worker,
+        **{f"mean_{key}": round(statistics.mean(w[key] for w in per_worker), 1)
+           for key in ("rss", "pss", "uss")},
+        # what the whole server costs: PSS adds up without double counting
+        "total_pss": round(parent["pss"] + sum(w["pss"] for w in per_worker), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="postgresql:///flask_cafe_bench")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--port", type=int, default=5057)
+    parser.add_argument("--out", help="write results JSON here")
+    args = parser.parse_args()
+
+    results = {
+        mode: measure(args.database_url, args.port, args.workers,
+                      mode == "preload", args.requests)
+        for mode in ("no-preload", "preload")
+    }
+
+    header = (f"{'mode':<11} {'rss MB':>8} {'pss MB':>8} {'uss MB':>8} "
+              f"{'total pss MB':>13}")
+    print(header)
+    print("-" * len(header))
+    for mode, stats in results.items():
+        print(f"{mode:<11} {stats['mean_rss']:>8} {stats['mean_pss']:>8} "
+              f"{stats['mean_uss']:>8} {stats['total_pss']:>13}")
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
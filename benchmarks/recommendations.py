@@ -0,0 +1,101 @@
+"""Time and measure building every cafe's related cafes.
+
+Generates a synthetic likes matrix in memory (Zipf popularity and
+activity, as generate_data.py does), then runs the same computation as
+`flask build-recommendations` over it, without a database, and reports
+build time, pairs kept and peak memory.
+
+    python -m benchmarks.recommendations --users 1000000 --cafes 100000 \\
+        [--block-size 2000] [--out results.json]
+
+Needs NumPy and SciPy for realistic sizes; without them it runs the pure
+Python fallback, which is only meant for development data.
+"""
+
+import argparse
+import json
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+from generate_data import like_rows
+import recommendations
+
+
+def generate_likes(users, cafes, likes_per_user, skew, seed):
+    rows = like_rows(users, cafes, likes_per_user, skew, random.Random(seed))
+    pairs = ((row["user_id"], row["cafe_id"]) for row in rows)
+
+    if recommendations.np is None:
+        user_ids, cafe_ids = [], []
+        for user_id, cafe_id in pairs:
+            user_ids.append(user_id)
+            cafe_ids.append(cafe_id)
+        return user_ids, cafe_ids
+
+    np = recommendations.np
+    flat = np.fromiter((n for pair in pairs for n in pair), dtype=np.int64)
+    likes = flat.reshape(-1, 2)
+    return likes[:, 0].copy(), likes[:, 1].copy()
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--cafes", type=int, default=100_000)
+    parser.add_argument("--likes-per-user", type=int, default=10)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-k", type=int, default=recommendations.KEEP_NEIGHBORS,
+                        help="neighbours kept per cafe")
+    parser.add_argument("--block-size", type=int, default=recommendations.BLOCK_SIZE)
+    parser.add_argument("--out", help="write results JSON here")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    user_ids, cafe_ids = generate_likes(args.users, args.cafes,
+                                        args.likes_per_user, args.skew, args.seed)
+    generated = time.perf_counter() - start
+    print(f"likes: {len(cafe_ids):,} generated in {generated:.1f}s")
+
+    rss_before = max_rss_mb()
+    tracemalloc.start()
+    start = time.perf_counter()
+    pairs = sum(1 for _ in recommendations.compute_neighbors(
+        user_ids, cafe_ids, args.k, args.block_size))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results = {
+        "users": args.users,
+        "cafes": args.cafes,
+        "likes": len(cafe_ids),
+        "engine": "scipy" if recommendations.sparse is not None else "python",
+        "block_size": args.block_size,
+        "pairs": pairs,
+        "build_s": round(elapsed, 2),
+        # allocations made while building (NumPy reports its arrays here)
+        "peak_traced_mb": round(peak / 2 ** 20, 1),
+        "max_rss_mb": round(max_rss_mb(), 1),
+        "max_rss_before_mb": round(rss_before, 1),
+    }
+    for key, value in results.items():
+        print(f"{key:>18}: {value}")
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Measure worker cold start: import time, create_app time and the
+latency of the first request to each route.
+
+Every measurement runs in a fresh interpreter so nothing is already
+imported, compiled or connected. Each route is measured:
+
+- development (no warm-up, no template cache)
+- production with an empty template bytecode cache
+- production with a cache filled by `flask compile-templates`
+
+    python -m benchmarks.startup [--runs 5] [--path /cafes --path /login]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROBE = r'''
+import json, sys, time
+t0 = time.perf_counter()
+import app as app_module
+t1 = time.perf_counter()
+app = app_module.create_app(sys.argv[1])
+t2 = time.perf_counter()
+resp = app.test_client().get(sys.argv[2])
+t3 = time.perf_counter()
+print(json.dumps({
+    "import": t1 - t0,
+    "create_app": t2 - t1,
+    "first_request": t3 - t2,
+    "status": resp.status_code,
+}))
+'''
+
+PATHS = ["/", "/cafes", "/cafes/1", "/login", "/signup"]
+
+
+def clear(directory):
+    for file in os.listdir(directory):
+        os.remove(os.path.join(directory, file))
+
+
+def measure(profile, path, cache_dir):
+    env = dict(os.environ, TEMPLATE_CACHE_DIR=cache_dir or "")
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE, profile, path],
+        check=True, capture_output=True, text=True, env=env,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def median_ms(runs, key):
+    return round(statistics.median(r[key] for r in runs) * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", action="append", dest="paths",
+                        help=f"route to request (default: {' '.join(PATHS)})")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as empty, \
+            tempfile.TemporaryDirectory() as primed:
+        subprocess.run(
+            [sys.executable, "-m", "flask", "--app", "app", "compile-templates"],
+            check=True, capture_output=True,
+            env=dict(os.environ, TEMPLATE_CACHE_DIR=primed,
+                     FLASK_CAFE_CONFIG="production"),
+        )
+
+        variants = {
+            "development": ("development", None),
+            "production, empty cache": ("production", empty),
+            "production, compiled cache": ("production", primed),
+        }
+
+        results = {}
+        for name, (profile, cache_dir) in variants.items():
+            results[name] = {}
+            for path in args.paths or PATHS:
+                runs = []
+                for _ in range(args.runs):
+                    # an empty cache has to stay empty between runs
+                    clear(empty)
+                    runs.append(measure(profile, path, cache_dir))
+                results[name][path] = {
+                    key: median_ms(runs, key)
+                    for key in ("import", "create_app", "first_request")
+                }
+                results[name][path]["ready"] = round(
+                    results[name][path]["create_app"] +
+                    results[name][path]["first_request"], 2)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
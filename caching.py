@@ -0,0 +1,97 @@
+"""Shared (reverse proxy / CDN) caching of anonymous pages.
+
+With SHARED_CACHE on, views marked `@shared_cache` answer anonymous
+visitors with
+
+    Cache-Control: public, max-age=0, s-maxage=60, stale-while-revalidate=300
+    Vary: Cookie
+
+and no Set-Cookie, so a proxy can serve the same HTML to every visitor
+without a session. Logged-in users get `private` instead, as does any
+response that would change the session (say, by showing a flash), since
+that one has to set a cookie.
+
+Vary: Cookie keys the cache on the whole Cookie header; have the proxy
+drop every cookie except the session cookie first, so anonymous
+visitors (with no session cookie) share one entry.
+
+After an admin changes a cafe, `purge(...)` sends the `cache_purged`
+signal with the paths that changed (the cafe's pages, and the homepage
+for its city summary) and, if SHARED_CACHE_PURGE_URL is set, an HTTP
+PURGE for each path to that proxy. Likes change the homepage too, but
+purging it for each one would leave little to cache; those show up
+within SHARED_CACHE_MAX_AGE.
+"""
+
+import logging
+
+import requests
+from blinker import Namespace
+from flask import current_app, g, request, session
+
+logger = logging.getLogger(__name__)
+
+signals = Namespace()
+
+# sent with `paths` after a write changes what those pages show
+cache_purged = signals.signal("cache-purged")
+
+
+def shared_cache(view):
+    """Let shared caches store this view's anonymous responses."""
+
+    view.shared_cache = True
+    return view
+
+
+def purge(*paths):
+    """Tell shared caches that `paths` have changed."""
+
+    app = current_app._get_current_object()
+    if not app.config["SHARED_CACHE"]:
+        return
+
+    cache_purged.send(app, paths=paths)
+
+    base = app.config["SHARED_CACHE_PURGE_URL"]
+    if not base:
+        return
+
+    for path in paths:
+        try:
+            requests.request("PURGE", base.rstrip("/") + path,
+                             timeout=app.config["SHARED_CACHE_PURGE_TIMEOUT"])
+        except requests.RequestException as e:
+            # the page just goes stale until s-maxage runs out
+            logger.warning("couldn't purge %s: %s", path, e)
+
+
+def _cache_headers(response):
+    app = current_app
+    view = app.view_functions.get(request.endpoint)
+    if not getattr(view, "shared_cache", False) or request.method != "GET":
+        return response
+
+    anonymous = (g.get("user") is None and
+                 not session.modified and
+                 "Set-Cookie" not in response.headers)
+
+    if anonymous and response.status_code == 200:
+        response.headers["Cache-Control"] = (
+            f"public, max-age=0, "
+            f"s-maxage={app.config['SHARED_CACHE_MAX_AGE']}, "
+            f"stale-while-revalidate={app.config['SHARED_CACHE_STALE']}")
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+
+    response.vary.add("Cookie")
+    return response
+
+
+def init_shared_cache(app):
+    if not app.config["SHARED_CACHE"]:
+        return
+
+    # register before the other hooks: after_request runs in reverse, so
+    # this sees the session once everything else is done with it
+    app.after_request(_cache_headers)
@@ -0,0 +1,187 @@
+"""Response compression for Flask Cafe.
+
+A WSGI middleware that gzips (or Brotli-compresses, if the `brotli`
+package from requirements-extras.txt is installed) responses for
+clients that accept it, in the encoding they rate highest. Each chunk
+is compressed and flushed as it's produced, so streamed responses
+stream compressed rather than being buffered whole.
+
+Responses are sent as-is when they're smaller than `min_size`, already
+encoded, partial (Range), of an already-compressed type (images, video,
+archives) or at a path matching one of `exclude_paths`.
+"""
+
+import itertools
+import zlib
+from fnmatch import fnmatch
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional
+    brotli = None
+
+
+# content types that don't shrink when compressed again
+INCOMPRESSIBLE_TYPES = ("image/", "video/", "audio/", "font/woff",
+                        "application/zip", "application/gzip",
+                        "application/octet-stream")
+COMPRESSIBLE_IMAGES = ("image/svg+xml",)
+
+
+class GzipStream:
+    def __init__(self, level):
+        # wbits 16+ writes a gzip header and trailer
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        return self._z.compress(chunk) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush()
+
+
+class BrotliStream:
+    def __init__(self, level):
+        # brotli quality runs 0-11; map gzip's 1-9 onto it
+        self._c = brotli.Compressor(quality=min(11, round(level * 11 / 9)))
+
+    def compress(self, chunk):
+        return self._c.process(chunk) + self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+# ours, best first
+PREFERENCE = ("br", "gzip")
+
+ENCODERS = {"gzip": GzipStream}
+if brotli is not None:
+    ENCODERS["br"] = BrotliStream
+
+
+class CompressionMiddleware:
+    """Compress responses according to the request's Accept-Encoding."""
+
+    def __init__(self, app, min_size=500, level=6, exclude_paths=()):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.exclude_paths = tuple(exclude_paths)
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+        if encoding is None:
+            return self.app(environ, start_response)
+
+        stream = None
+        started = False
+
+        def compressing_start_response(status, headers, exc_info=None):
+            nonlocal stream, started
+            started = True
+
+            if self.should_compress(status, headers):
+                stream = ENCODERS[encoding](self.level)
+                headers = [(k, v) for k, v in headers
+                           if k.lower() != "content-length"]
+                headers.append(("Content-Encoding", encoding))
+                headers = _weaken_etag(headers)
+
+            headers = _add_vary(headers)
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, compressing_start_response)
+
+        if not started:
+            # a generator app only starts the response on first iteration
+            return _compressed_once_started(app_iter, lambda: stream)
+        if stream is None:
+            return app_iter
+        return _compressed(app_iter, stream)
+
+    def choose_encoding(self, environ):
+        path = environ.get("PATH_INFO", "")
+        if any(fnmatch(path, pattern) for pattern in self.exclude_paths):
+            return None
+
+        accept = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        # the client's highest q wins; ties go to the first in PREFERENCE
+        quality, _, encoding = max(
+            (accept.quality(encoding), -rank, encoding)
+            for rank, encoding in enumerate(PREFERENCE) if encoding in ENCODERS)
+        return encoding if quality > 0 else None
+
+    def should_compress(self, status, headers):
+        if not status.startswith("200"):
+            return False
+
+        headers = {k.lower(): v for k, v in headers}
+        if "content-encoding" in headers or "content-range" in headers:
+            return False
+
+        content_type = headers.get("content-type", "").split(";")[0].strip()
+        if (content_type.startswith(INCOMPRESSIBLE_TYPES) and
+                content_type not in COMPRESSIBLE_IMAGES):
+            return False
+
+        # streamed responses have no length; compress those as they go
+        length = headers.get("content-length")
+        return length is None or int(length) >= self.min_size
+
+
+def _compressed(app_iter, stream):
+    try:
+        for chunk in app_iter:
+            # pass empty chunks on; a streamed page starts with one
+            yield stream.compress(chunk) if chunk else b""
+        yield stream.finish()
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+
+
+def _compressed_once_started(app_iter, get_stream):
+    chunks = iter(app_iter)
+    try:
+        first = next(chunks, b"")
+        stream = get_stream()
+        rest = itertools.chain([first], chunks)
+        if stream is None:
+            yield from rest
+        else:
+            yield from _compressed(rest, stream)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+
+
+def _add_vary(headers):
+    for i, (key, value) in enumerate(headers):
+        if key.lower() == "vary":
+            if "accept-encoding" not in value.lower():
+                headers[i] = (key, f"{value}, Accept-Encoding")
+            return headers
+    return [*headers, ("Vary", "Accept-Encoding")]
+
+
+def _weaken_etag(headers):
+    """The compressed body differs byte-for-byte, so its ETag can't be
+    strong."""
+
+    return [(k, f"W/{v}" if k.lower() == "etag" and not v.startswith("W/") else v)
+            for k, v in headers]
+
+
+def init_compression(app):
+    if not app.config["COMPRESSION"]:
+        return
+
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config["COMPRESSION_MIN_SIZE"],
+        level=app.config["COMPRESSION_LEVEL"],
+        exclude_paths=app.config["COMPRESSION_EXCLUDE_PATHS"],
+    )
@@ -0,0 +1,141 @@
+"""Configuration profiles for Flask Cafe."""
+
+import os
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "DATABASE_URL", 'postgresql:///flask_cafe')
+    SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "shhhh")
+
+    # comma-separated read replica urls; read-only views use these
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+        if uri
+    ]
+    REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", 5))
+    REPLICA_STICKY_SECONDS = 5
+
+    DEBUG_TOOLBAR = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # per-endpoint latency/SQL metrics at /metrics; with several worker
+    # processes, set METRICS_DIR to a directory they all share
+    METRICS = True
+    METRICS_DIR = os.environ.get("METRICS_DIR")
+    SERVER_TIMING = True
+
+    # max SQL statements per endpoint, overriding @query_budget; over
+    # budget raises when QUERY_BUDGET_RAISE, else logs a warning
+    QUERY_BUDGETS = {}
+    QUERY_BUDGET_RAISE = False
+
+    # gzip/brotli responses for clients that accept it
+    COMPRESSION = True
+    COMPRESSION_MIN_SIZE = 500
+    COMPRESSION_LEVEL = int(os.environ.get("COMPRESSION_LEVEL", 6))
+    COMPRESSION_EXCLUDE_PATHS = ["/static/maps/*.jpg", "/images/*"]
+
+    # streamed listing pages: template pieces sent per chunk, and rows
+    # fetched from the DB per batch
+    STREAM_BUFFER_SIZE = 40
+    STREAM_BATCH_SIZE = 100
+
+    # let a reverse proxy cache anonymous pages; admin writes purge them
+    SHARED_CACHE = os.environ.get("SHARED_CACHE", "") == "1"
+    SHARED_CACHE_MAX_AGE = 60
+    SHARED_CACHE_STALE = 300
+    SHARED_CACHE_PURGE_URL = os.environ.get("SHARED_CACHE_PURGE_URL")
+    SHARED_CACHE_PURGE_TIMEOUT = 1
+
+    # link the fingerprinted bundles from `flask assets build`, if built,
+    # rather than each source file
+    ASSETS_BUNDLED = True
+
+    # cache Cafe/City/User rows by primary key (see entity_cache.py): an
+    # in-process LRU, plus memcached at ENTITY_CACHE_SHARED ("host:port")
+    ENTITY_CACHE = True
+    ENTITY_CACHE_SIZE = 10_000
+    ENTITY_CACHE_TTL = 30
+    ENTITY_CACHE_SHARED = os.environ.get("ENTITY_CACHE_SHARED")
+    ENTITY_CACHE_SHARED_TTL = 3600
+    ENTITY_CACHE_SHARED_TIMEOUT = 0.25
+
+    # tell other processes what a commit changed, over Postgres
+    # LISTEN/NOTIFY, so they evict it from their caches (invalidation.py)
+    INVALIDATION_BUS = os.environ.get("INVALIDATION_BUS", "1") == "1"
+    INVALIDATION_HEARTBEAT = 30
+    INVALIDATION_RECONNECT_DELAY = 30
+
+    # serve cafe/user images through /images: fetched once, shrunk to
+    # one of IMAGE_PROXY_WIDTHS and kept on disk (relative to the instance
+    # folder) up to IMAGE_CACHE_BYTES (see images.py)
+    IMAGE_PROXY = os.environ.get("IMAGE_PROXY", "1") == "1"
+    IMAGE_PROXY_WIDTHS = (400, 800)
+    IMAGE_PROXY_MAX_BYTES = 10 * 2 ** 20
+    IMAGE_PROXY_TIMEOUT = (3.05, 10)
+    IMAGE_PROXY_ALLOW_PRIVATE = False
+    IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "image-cache")
+    IMAGE_CACHE_BYTES = int(os.environ.get("IMAGE_CACHE_BYTES", 512 * 2 ** 20))
+
+    # record statements slower than SLOW_QUERY_THRESHOLD seconds, with an
+    # EXPLAIN, for admins at /admin/slow-queries (see slow_queries.py)
+    SLOW_QUERIES = True
+    SLOW_QUERY_THRESHOLD = float(os.environ.get("SLOW_QUERY_THRESHOLD", 0.1))
+    SLOW_QUERY_BUFFER = 200
+    SLOW_QUERY_EXPLAIN = True
+    SLOW_QUERY_EXPLAIN_INTERVAL = 60
+    SLOW_QUERY_EXPLAIN_TIMEOUT = 5
+
+    # admins can profile one request with ?_profile=cpu|memory; kept in
+    # PROFILE_DIR (relative to the instance folder), see profiling.py
+    PROFILING = True
+    PROFILE_INTERVAL = 0.005
+    PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+    PROFILE_KEEP = 50
+
+    # bulk cafe imports: rows per INSERT, and threads fetching their maps
+    IMPORT_BATCH_SIZE = 500
+    IMPORT_MAP_WORKERS = int(os.environ.get("IMPORT_MAP_WORKERS", 8))
+
+    # warm up pools, templates and mappers before the first request
+    WARM_UP = False
+    WARM_UP_CONNECTIONS = 2
+
+    # compiled templates are cached here (relative to the instance folder)
+    # and shared by every worker; `flask compile-templates` fills it
+    TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR") or None
+
+
+class DevelopmentConfig(Config):
+    """Local development: debug toolbar, SQL echo when debugging, and
+    unbundled assets so edits show up without a build."""
+
+    DEBUG_TOOLBAR = True
+    ASSETS_BUNDLED = False
+
+
+class ProductionConfig(Config):
+    """Production: no debug tooling, warm before serving."""
+
+    WARM_UP = True
+    WARM_UP_CONNECTIONS = int(os.environ.get("WARM_UP_CONNECTIONS", 2))
+    TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", "jinja-cache") or None
+
+
+class TestingConfig(Config):
+    """Test suite: real errors, no CSRF and no invalidation listener."""
+
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    QUERY_BUDGET_RAISE = True
+    INVALIDATION_BUS = False
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig,
+    "testing": TestingConfig,
+}
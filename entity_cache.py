@@ -0,0 +1,445 @@
+"""Second-level cache of Cafe, City and User rows by primary key.
+
+`cached_get(Cafe, 3)` works like `db.session.get(Cafe, 3)`, but first
+looks in
+
+1. a per-process LRU (ENTITY_CACHE_SIZE rows, each trusted for
+   ENTITY_CACHE_TTL seconds), then
+2. if ENTITY_CACHE_SHARED is set ("host:port"), a memcached shared by
+   every process, kept for ENTITY_CACHE_SHARED_TTL seconds,
+
+and only then the database, filling both on the way back (with every
+column but the UNCACHED_COLUMNS). Hits come
+back attached to the session, as if loaded there, so they lazy-load
+relationships and can be changed and committed as usual.
+
+Invalidation. Committing a change to a cached model bumps the version
+of its rows (or, for a bulk INSERT/UPDATE/DELETE, of the whole model)
+in both tiers. New rows count as changed too, for the invalidation
+bus to tell other processes' caches about them. Every entry is stamped with the version current when its row
+was about to be read, and only counts as a hit while that's still the
+current version. So an entry filled from a read that raced with a
+commit is rejected, not served until it expires. Shared-tier versions
+start from the clock when missing, so one evicted by memcached can't
+come back matching an old entry.
+
+Other processes' local tiers hear of a commit over the invalidation
+bus (invalidation.py); without it, or while it's reconnecting, only
+when the TTL runs out, hence the short TTL. Writes made outside the ORM session
+(raw SQL, generate_data) must call `invalidate_models`. The shared
+tier is best-effort: if memcached is unreachable or slow, lookups go
+to the database. Its entries are JSON (see `_to_json`), never pickles:
+memcached has no authentication, and unpickling what anyone could have
+written there would run their code.
+"""
+
+import datetime
+import decimal
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import abort, current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from models import db, Cafe, City, User
+
+logger = logging.getLogger(__name__)
+
+CACHED_MODELS = (Cafe, City, User)
+
+# credentials stay out of both tiers (anyone who can reach memcached can
+# read the shared one); a hit leaves them unloaded, so reading one goes
+# to the database
+UNCACHED_COLUMNS = {User: {"hashed_password"}}
+
+# python type of a column -> (to JSON, from JSON), for the shared tier;
+# str, int, float, bool and None go as they are
+JSON_CONVERTERS = {
+    datetime.datetime: (datetime.datetime.isoformat, datetime.datetime.fromisoformat),
+    datetime.date: (datetime.date.isoformat, datetime.date.fromisoformat),
+    datetime.time: (datetime.time.isoformat, datetime.time.fromisoformat),
+    decimal.Decimal: (str, decimal.Decimal),
+    uuid.UUID: (str, uuid.UUID),
+}
+JSON_TYPES = (str, int, float, bool)
+
+PREFIX = "flask_cafe"
+
+
+class SharedTierError(Exception):
+    pass
+
+
+#######################################
+# tiers
+
+
+class LocalTier:
+    """Thread-safe LRU of (stamp, expiry, row data) with in-process
+    versions."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.generations = {}
+        self._lock = threading.Lock()
+
+    def stamp(self, table, key):
+        with self._lock:
+            return (self.generations.get(table, 0), self.versions.get(key, 0))
+
+    def get(self, key, stamp):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry_stamp, expires, data = entry
+            if entry_stamp != stamp or expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return data
+
+    def set(self, key, stamp, data):
+        with self._lock:
+            self.entries[key] = (stamp, time.monotonic() + self.ttl, data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, keys, tables):
+        with self._lock:
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+                self.entries.pop(key, None)
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+            if tables:
+                prefixes = tuple(f"{table}:" for table in tables)
+                for key in [key for key in self.entries if key.startswith(prefixes)]:
+                    del self.entries[key]
+
+
+class MemcacheTier:
+    """The few memcached text-protocol commands the shared tier needs,
+    over one connection per thread (and per process, after a fork)."""
+
+    def __init__(self, address, ttl, timeout):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port))
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def stamp_and_get(self, table, key):
+        """Return (current stamp, row data if the entry matches it)."""
+
+        gen_key, version_key, entry_key = (
+            f"{PREFIX}:g:{table}", f"{PREFIX}:v:{key}", f"{PREFIX}:e:{key}")
+        found = self._get_many([gen_key, version_key, entry_key])
+
+        stamp = (self._version(gen_key, found), self._version(version_key, found))
+        if entry_key in found:
+            try:
+                entry_stamp, data = json.loads(found[entry_key])
+            except ValueError:
+                logger.warning("entity cache: unreadable shared entry %s", key)
+                return stamp, None
+            if tuple(entry_stamp) == stamp:
+                return stamp, data
+        return stamp, None
+
+    def set(self, key, stamp, data):
+        """Store `data`, a dict of JSON values, stamped with `stamp`."""
+
+        self._store("set", f"{PREFIX}:e:{key}",
+                    json.dumps([stamp, data], separators=(",", ":")).encode())
+
+    def invalidate(self, keys, tables):
+        for key in keys:
+            self._incr(f"{PREFIX}:v:{key}")
+        for table in tables:
+            self._incr(f"{PREFIX}:g:{table}")
+
+    def _version(self, version_key, found):
+        if version_key in found:
+            return int(found[version_key])
+        # start from the clock, so a version that was evicted can't come
+        # back as one an old entry was stamped with
+        self._store("add", version_key, str(time.time_ns()).encode())
+        return int(self._get_many([version_key])[version_key])
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+            conn = self._local.conn = (sock, sock.makefile("rb"))
+            self._local.pid = os.getpid()
+        return conn
+
+    def _command(self, line, data=None):
+        try:
+            sock, reader = self._connection()
+            sock.sendall(line + b"\r\n" + (data + b"\r\n" if data is not None else b""))
+            return reader
+        except OSError as e:
+            self._disconnect()
+            raise SharedTierError(e) from e
+
+    def _readline(self, reader):
+        try:
+            line = reader.readline()
+        except OSError as e:
+            self._disconnect()
+            raise SharedTierError(e) from e
+        if not line.endswith(b"\r\n"):
+            self._disconnect()
+            raise SharedTierError("connection closed")
+        return line[:-2]
+
+    def _disconnect(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn:
+            conn[0].close()
+
+    def _get_many(self, keys):
+        reader = self._command(b"get " + " ".join(keys).encode())
+        found = {}
+        while (line := self._readline(reader)) != b"END":
+            parts = line.split()
+            if parts[0] != b"VALUE":
+                raise SharedTierError(line.decode(errors="replace"))
+            length = int(parts[3])
+            try:
+                found[parts[1].decode()] = reader.read(length + 2)[:-2]
+            except OSError as e:
+                self._disconnect()
+                raise SharedTierError(e) from e
+        return found
+
+    def _store(self, command, key, data):
+        reader = self._command(
+            f"{command} {key} 0 {self.ttl} {len(data)}".encode(), data)
+        reply = self._readline(reader)
+        if reply not in (b"STORED", b"NOT_STORED"):
+            raise SharedTierError(reply.decode(errors="replace"))
+
+    def _incr(self, key):
+        reader = self._command(f"incr {key} 1".encode())
+        reply = self._readline(reader)
+        # NOT_FOUND: nothing is stamped with it, and it restarts from the
+        # clock when next read
+        if reply != b"NOT_FOUND" and not reply.isdigit():
+            raise SharedTierError(reply.decode(errors="replace"))
+
+
+#######################################
+# the cache
+
+
+class EntityCache:
+    """Read-through cache of rows of CACHED_MODELS by primary key."""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.hits = {"local": 0, "shared": 0}
+        self.misses = 0
+
+    def get(self, session, model, ident):
+        """The `model` row with primary key `ident` in `session`, or None."""
+
+        key = identity_key(model, ident)
+        obj = session.identity_map.get(key)
+        if obj is not None:
+            return obj
+
+        table = model.__tablename__
+        cache_key = f"{table}:{ident}"
+
+        local_stamp = self.local.stamp(table, cache_key)
+        data = self.local.get(cache_key, local_stamp)
+        if data is not None:
+            self.hits["local"] += 1
+            return _attach(session, model, data)
+
+        shared_stamp = None
+        if self.shared:
+            try:
+                shared_stamp, data = self.shared.stamp_and_get(table, cache_key)
+            except SharedTierError as e:
+                logger.warning("entity cache: shared tier unavailable: %s", e)
+            if data is not None:
+                self.hits["shared"] += 1
+                data = _from_json(model, data)
+                self.local.set(cache_key, local_stamp, data)
+                return _attach(session, model, data)
+
+        self.misses += 1
+        obj = session.get(model, ident)
+        if obj is None:
+            return None
+
+        data = _columns(obj)
+        self.local.set(cache_key, local_stamp, data)
+        # a replica may not have the latest commit yet; only the local
+        # tier (briefly) keeps what came from one
+        if shared_stamp is not None and not _read_replica(session):
+            try:
+                self.shared.set(cache_key, shared_stamp, _to_json(model, data))
+            except SharedTierError as e:
+                logger.warning("entity cache: shared tier unavailable: %s", e)
+        return obj
+
+    def invalidate(self, keys=(), tables=()):
+        """Reject cached rows `keys` ("table:id") and every row of
+        `tables`, from now on."""
+
+        self.local.invalidate(keys, tables)
+        if self.shared:
+            try:
+                self.shared.invalidate(keys, tables)
+            except SharedTierError as e:
+                # entries outlive this by at most ENTITY_CACHE_SHARED_TTL
+                logger.error("entity cache: couldn't invalidate %s %s: %s",
+                             keys, tables, e)
+
+    def invalidate_models(self, models=CACHED_MODELS):
+        self.invalidate(tables=[model.__tablename__ for model in models])
+
+
+def _columns(obj):
+    mapper = inspect(obj).mapper
+    uncached = UNCACHED_COLUMNS.get(mapper.class_, ())
+    return {attr.key: getattr(obj, attr.key) for attr in mapper.column_attrs
+            if attr.key not in uncached}
+
+
+def _converters(model):
+    for attr in inspect(model).column_attrs:
+        python_type = attr.columns[0].type.python_type
+        if python_type in JSON_CONVERTERS:
+            yield attr.key, JSON_CONVERTERS[python_type]
+        elif not issubclass(python_type, JSON_TYPES):
+            raise TypeError(f"{model.__name__}.{attr.key}: no JSON_CONVERTERS "
+                            f"entry for {python_type.__name__}")
+
+
+def _to_json(model, data):
+    """`_columns` output with every value converted to JSON's types."""
+
+    data = dict(data)
+    for key, (to_json, _) in _converters(model):
+        if data.get(key) is not None:
+            data[key] = to_json(data[key])
+    return data
+
+
+def _from_json(model, data):
+    for key, (_, from_json) in _converters(model):
+        if data.get(key) is not None:
+            data[key] = from_json(data[key])
+    return data
+
+
+def _attach(session, model, data):
+    obj = model(**data)
+    make_transient_to_detached(obj)
+    return session.merge(obj, load=False)
+
+
+def _read_replica(session):
+    return ("replicas" in current_app.extensions and
+            session._reads_from_replica())
+
+
+def cached_get(model, ident):
+    """`db.session.get(model, ident)`, through the entity cache."""
+
+    cache = current_app.extensions.get("entity_cache")
+    if cache is None:
+        return db.session.get(model, ident)
+    return cache.get(db.session, model, ident)
+
+
+def cached_get_or_404(model, ident):
+    obj = cached_get(model, ident)
+    if obj is None:
+        abort(404)
+    return obj
+
+
+#######################################
+# invalidation on commit
+
+
+def _cache_key(obj):
+    # (new rows have their id by after_flush, but not yet an identity)
+    return f"{obj.__tablename__}:{inspect(obj).mapper.primary_key_from_instance(obj)[0]}"
+
+
+@event.listens_for(db.session, "after_flush")
+def _note_changed_entities(session, flush_context):
+    keys = session.info.setdefault("entity_cache_keys", set())
+    # only columns are cached, so a change to just a collection (say, a
+    # user's liked_cafes) leaves the entry good
+    keys.update(_cache_key(obj) for obj in session.dirty
+                if isinstance(obj, CACHED_MODELS) and
+                session.is_modified(obj, include_collections=False))
+    keys.update(_cache_key(obj) for obj in (*session.new, *session.deleted)
+                if isinstance(obj, CACHED_MODELS))
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _note_bulk_changes(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or
+            orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ in CACHED_MODELS:
+        orm_execute_state.session.info.setdefault(
+            "entity_cache_tables", set()).add(mapper.class_.__tablename__)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_committed(session):
+    keys = session.info.pop("entity_cache_keys", None)
+    tables = session.info.pop("entity_cache_tables", None)
+    if not (keys or tables) or not has_app_context():
+        return
+
+    cache = current_app.extensions.get("entity_cache")
+    if cache is not None:
+        cache.invalidate(keys or (), tables or ())
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_changed_entities(session):
+    session.info.pop("entity_cache_keys", None)
+    session.info.pop("entity_cache_tables", None)
+
+
+def init_entity_cache(app):
+    if not app.config["ENTITY_CACHE"]:
+        return
+
+    shared = None
+    if app.config["ENTITY_CACHE_SHARED"]:
+        shared = MemcacheTier(app.config["ENTITY_CACHE_SHARED"],
+                              app.config["ENTITY_CACHE_SHARED_TTL"],
+                              app.config["ENTITY_CACHE_SHARED_TIMEOUT"])
+
+    app.extensions["entity_cache"] = EntityCache(
+        LocalTier(app.config["ENTITY_CACHE_SIZE"], app.config["ENTITY_CACHE_TTL"]),
+        shared)
@@ -1,5 +1,6 @@
 """Forms for Flask Cafe."""
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms import StringField, TextAreaField, URLField, SelectField, PasswordField
 from wtforms.validators import InputRequired, URL, Optional, Email, Length
 
@@ -36,6 +37,15 @@ class CafeForm(FlaskForm):
     )
 
 
+class CafeImportForm(FlaskForm):
+    """Form for uploading a CSV or JSONL file of cafes"""
+
+    file = FileField(
+        "CSV or JSONL file",
+        validators=[FileRequired(), FileAllowed(["csv", "jsonl", "ndjson"])]
+    )
+
+
 class SignupForm(FlaskForm):
     """Form for adding users on signup."""
 
@@ -0,0 +1,300 @@
+"""Generate a synthetic Flask Cafe dataset of any size.
+
+    python generate_data.py --cafes 1000000 --users 1000000 --seed 1
+
+DROPS AND RECREATES every table in $DATABASE_URL, then bulk loads
+cities, cafes, users and likes. The same arguments always produce the
+same data, so benchmark runs are comparable.
+
+Likes are skewed: cafe popularity follows a Zipf distribution
+(`--skew`), and so does how many likes each user has. Rows go in with
+COPY on Postgres and batched executemany elsewhere; nothing is added
+through the ORM one object at a time.
+
+Every user's password is "secret". The first two users are "admin"
+(an admin) and "test".
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import os
+import random
+import time
+
+from sqlalchemy import text
+
+
+CITY_NAMES = [
+    ("San Francisco", "CA"), ("Oakland", "CA"), ("Berkeley", "CA"),
+    ("Los Angeles", "CA"), ("San Diego", "CA"), ("Portland", "OR"),
+    ("Seattle", "WA"), ("Denver", "CO"), ("Austin", "TX"),
+    ("Chicago", "IL"), ("Boston", "MA"), ("New York", "NY"),
+    ("Philadelphia", "PA"), ("Atlanta", "GA"), ("Miami", "FL"),
+    ("Minneapolis", "MN"), ("Nashville", "TN"), ("Phoenix", "AZ"),
+]
+
+NAME_WORDS = [
+    "Blue", "Perch", "Copper", "Morning", "Golden", "Little", "Velvet",
+    "Corner", "Harbor", "Sparrow", "Ember", "Maple", "Juniper", "Anchor",
+    "Lantern", "Orchard", "Raven", "Sunday", "Cedar", "Fig",
+]
+NAME_KINDS = ["Cafe", "Coffee", "Roasters", "Espresso", "Coffee House", "Bakery"]
+STREETS = ["Main St", "Grand Ave", "Market St", "Valencia St", "Oak St",
+           "24th St", "Broadway", "Mission St", "Pine St", "Shattuck Ave"]
+
+MAP_STUB = "static/images/map-stub.jpg"
+
+BATCH_SIZE = 50_000
+
+
+#######################################
+# rows
+
+
+def city_rows(count):
+    for i in range(count):
+        name, state = CITY_NAMES[i % len(CITY_NAMES)]
+        if i >= len(CITY_NAMES):
+            name = f"{name} {i // len(CITY_NAMES) + 1}"
+        yield {"code": f"city{i}", "name": name, "state": state}
+
+
+def cafe_rows(count, cities, rng):
+    for i in range(1, count + 1):
+        name = f"{rng.choice(NAME_WORDS)} {rng.choice(NAME_KINDS)}"
+        yield {
+            "id": i,
+            "name": f"{name} #{i}",
+            "description": f"{name} serves coffee and pastries.",
+            "url": f"https://example.com/cafes/{i}",
+            "address": f"{rng.randint(1, 9999)} {rng.choice(STREETS)}",
+            "city_code": f"city{rng.randrange(cities)}",
+            "image_url": f"https://example.com/cafes/{i}.jpg",
+        }
+
+
+def user_rows(count, hashed_password):
+    for i in range(1, count + 1):
+        if i == 1:
+            username, admin = "admin", True
+        elif i == 2:
+            username, admin = "test", False
+        else:
+            username, admin = f"user{i - 3}", False
+
+        yield {
+            "id": i,
+            "username": username,
+            "admin": admin,
+            "email": f"{username}@example.com",
+            "first_name": username.capitalize(),
+            "last_name": "Example",
+            "description": "",
+            "image_url": f"https://example.com/users/{i}.jpg",
+            "hashed_password": hashed_password,
+        }
+
+
+def like_rows(users, cafes, likes_per_user, skew, rng):
+    """Yield (user, cafe) likes; both popularity and activity are Zipf."""
+
+    # popularity rank -> cafe id, so popular cafes aren't just low ids
+    by_rank = list(range(1, cafes + 1))
+    rng.shuffle(by_rank)
+    cafe_weights = list(itertools.accumulate(
+        1 / rank ** skew for rank in range(1, cafes + 1)))
+
+    max_likes = min(cafes, likes_per_user * 10)
+    count_weights = list(itertools.accumulate(
+        1 / n ** skew for n in range(1, max_likes + 1)))
+    # scale so the average user has about `likes_per_user` likes
+    mean = sum((n + 1) * (w - (count_weights[n - 1] if n else 0))
+               for n, w in enumerate(count_weights)) / count_weights[-1]
+    scale = likes_per_user / mean
+
+    for user_id in range(1, users + 1):
+        n = rng.choices(range(1, max_likes + 1), cum_weights=count_weights)[0]
+        n = min(cafes, max(0, round(n * scale)))
+        picked = set()
+        while len(picked) < n:
+            ranks = rng.choices(range(cafes), cum_weights=cafe_weights, k=n - len(picked))
+            picked.update(by_rank[rank] for rank in ranks)
+        for cafe_id in sorted(picked):
+            yield {"user_id": user_id, "cafe_id": cafe_id}
+
+
+#######################################
+# loading
+
+
+def batches(rows, size=BATCH_SIZE):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+def bulk_load(conn, table, rows):
+    """Insert `rows` (dicts) into `table` in batches; return row count."""
+
+    total = 0
+    postgres = conn.dialect.name == "postgresql"
+
+    for batch in batches(rows):
+        if postgres:
+            copy_batch(conn, table, batch)
+        else:
+            conn.execute(table.insert(), batch)
+        total += len(batch)
+
+    return total
+
+
+def copy_batch(conn, table, batch):
+    columns = list(batch[0])
+    buffer = io.StringIO()
+    # quote strings so "" stays an empty string rather than NULL
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for row in batch:
+        writer.writerow(
+            "t" if row[c] is True else "f" if row[c] is False else row[c]
+            for c in columns)
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+    cursor.close()
+
+
+def reset_sequences(conn, tables):
+    """Move Postgres id sequences past the ids we inserted ourselves."""
+
+    if conn.dialect.name != "postgresql":
+        return
+
+    for table in tables:
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"COALESCE(MAX(id), 1)) FROM {table.name}"))
+
+
+def link_maps(cafes, path):
+    """Point every cafe's static map at the local stub image. Maps that
+    are already there (fetched ones, or the sample maps in the repo) are
+    kept."""
+
+    stub = os.path.join(path, MAP_STUB)
+    maps = os.path.join(path, "static/maps")
+
+    for cafe_id in range(1, cafes + 1):
+        target = os.path.join(maps, f"{cafe_id}.jpg")
+        if os.path.lexists(target):
+            continue
+        try:
+            os.link(stub, target)
+        except OSError:
+            with open(stub, "rb") as src, open(target, "wb") as dst:
+                dst.write(src.read())
+
+
+def generate(cities=3, cafes=20, users=10, likes_per_user=5, skew=1.1, seed=1,
+             maps=False, log=print):
+    """Drop all tables and load a deterministic synthetic dataset."""
+
+    from app import create_app
+    from config import ProductionConfig
+    from models import db, bcrypt, create_missing_indexes, City, Cafe, User, Like
+    from summaries import refresh_city_summaries
+    from recommendations import build_neighbors
+    from invalidation import publish, ALL_TABLES
+
+    class GenerateConfig(ProductionConfig):
+        # warm-up expects the tables we're about to drop
+        WARM_UP = False
+        METRICS = False
+
+    app = create_app(GenerateConfig)
+    rng = random.Random(seed)
+
+    # bcrypt is deliberately slow; every generated user shares one hash
+    hashed = bcrypt.generate_password_hash("secret").decode("utf8")
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        # one index build after the load beats updating them row by row
+        with db.engine.begin() as conn:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.drop(conn)
+
+        steps = [
+            (City.__table__, city_rows(cities)),
+            (Cafe.__table__, cafe_rows(cafes, cities, rng)),
+            (User.__table__, user_rows(users, hashed)),
+            (Like.__table__, like_rows(users, cafes, likes_per_user, skew, rng)),
+        ]
+
+        with db.engine.begin() as conn:
+            for table, rows in steps:
+                start = time.perf_counter()
+                count = bulk_load(conn, table, rows)
+                elapsed = time.perf_counter() - start
+                log(f"{table.name}: {count} rows in {elapsed:.1f}s "
+                    f"({count / elapsed if elapsed else 0:,.0f} rows/sec)")
+
+            reset_sequences(conn, [Cafe.__table__, User.__table__])
+
+        start = time.perf_counter()
+        indexes = create_missing_indexes(db.engine)
+        log(f"indexes: {len(indexes)} in {time.perf_counter() - start:.1f}s")
+
+        # the bulk load went around the ORM, so nothing kept these current
+        start = time.perf_counter()
+        with db.engine.begin() as conn:
+            refresh_city_summaries(conn)
+        log(f"city summaries: {time.perf_counter() - start:.1f}s")
+
+        # and around the entity cache, whose entries may be for old rows
+        # with the same ids, here and in every running process
+        if "entity_cache" in app.extensions:
+            app.extensions["entity_cache"].invalidate_models()
+        with db.engine.begin() as conn:
+            publish(conn, tables=ALL_TABLES)
+
+        start = time.perf_counter()
+        with db.engine.begin() as conn:
+            pairs = build_neighbors(conn)
+        log(f"related cafes: {pairs} pairs in {time.perf_counter() - start:.1f}s")
+
+    if maps:
+        start = time.perf_counter()
+        link_maps(cafes, os.path.abspath(os.path.dirname(__file__)))
+        log(f"maps: {cafes} in {time.perf_counter() - start:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cities", type=int, default=50)
+    parser.add_argument("--cafes", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--likes-per-user", type=int, default=10,
+                        help="average likes per user")
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="Zipf exponent for cafe popularity and user activity")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--maps", action="store_true",
+                        help="link a local stub map image for every cafe")
+    args = parser.parse_args()
+
+    generate(args.cities, args.cafes, args.users, args.likes_per_user,
+             args.skew, args.seed, args.maps)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""gunicorn settings for Flask Cafe: `gunicorn -c gunicorn.conf.py wsgi:app`.
+
+The app is preloaded in the parent process and forked into the workers
+(see wsgi.py), with the hooks below keeping connections per worker.
+
+Memory: `python -m benchmarks.prefork` starts gunicorn with and without
+preloading, sends each worker some traffic and reports every worker's
+RSS, PSS (its fair share of shared pages) and USS (pages only it has).
+RSS counts shared pages in full for every worker, so it barely moves
+with preloading; PSS and USS are what drop. Run it on the production
+box before and after changing worker counts or preload, and keep the
+numbers with the change; benchmarks/results/prefork.json is the last run.
+"""
+
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 1))
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# recycle workers now and then in case of leaks; the jitter keeps them
+# from all restarting (and reloading) at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 5000))
+max_requests_jitter = max_requests // 10
+
+# while the app loads, collections in the parent only leave holes in
+# pages the workers are about to share; when_ready turns GC back on once
+# before_fork has frozen what's loaded
+if preload_app:
+    gc.disable()
+
+
+def when_ready(server):
+    # with preload_app the app is loaded by now and the workers not yet
+    # forked; without it the parent has no app to prepare
+    if server.cfg.preload_app:
+        from app import before_fork
+        from wsgi import app
+        before_fork(app)
+        # the master lives on (reloading, respawning workers); frozen
+        # objects stay out of its collections and its children's
+        gc.enable()
+
+
+def post_fork(server, worker):
+    gc.enable()
+    if server.cfg.preload_app:
+        from app import after_fork
+        from wsgi import app
+        after_fork(app)
+
+
+def child_exit(server, worker):
+    # its metrics snapshot would otherwise be added into /metrics forever
+    metrics_dir = os.environ.get("METRICS_DIR")
+    if metrics_dir:
+        from metrics import mark_process_dead
+        mark_process_dead(metrics_dir, worker.pid)
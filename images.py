@@ -0,0 +1,378 @@
+"""Local caching proxy for externally hosted cafe and user images.
+
+Cafe and user images (and the defaults) are URLs on other people's
+hosts. Templates link `thumbnail_url(url, width)` instead, which with
+IMAGE_PROXY on is
+
+    /images/<width>/<signature>?url=<the image's url>
+
+The first request for it fetches the image, shrinks it to `width` pixels
+wide, and stores it under IMAGE_CACHE_DIR. From then on it's served from disk, with
+an immutable Cache-Control: a changed image URL makes a new proxy URL.
+
+- Only URLs we signed (with SECRET_KEY) are fetched, at one of
+  IMAGE_PROXY_WIDTHS, so the proxy can't be pointed anywhere else.
+  Since users pick their own image URLs, hosts that resolve to private,
+  loopback or link-local addresses are refused too: up front, and again
+  on every connection's actual peer, so a name that resolves somewhere
+  public for the check and private for the connection (DNS rebinding)
+  gets nowhere.
+- Downloads are capped at IMAGE_PROXY_MAX_BYTES and must be images.
+- The cache is an LRU on disk: a hit refreshes the file's mtime (at most
+  hourly), and when the directory grows past IMAGE_CACHE_BYTES the
+  oldest files are removed.
+- If the image can't be fetched the proxy redirects to the original, so
+  the page looks as it did before, and tries again a few minutes later.
+
+Resizing needs Pillow (requirements-extras.txt). Without it the proxy
+runs degraded: images are cached and served at their original size,
+only checked to be jpg, png, gif or webp by their first bytes. A warning
+says so at startup.
+"""
+
+import hashlib
+import hmac
+import io
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from flask import abort, current_app, redirect, request, send_file, url_for
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - optional
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# how long a browser holds on to the redirect to an image we couldn't fetch
+RETRY_AFTER = 300
+
+# a cache hit only rewrites the file's mtime when it's older than this
+TOUCH_INTERVAL = 3600
+
+TYPES = {"JPEG": ("jpg", "image/jpeg"), "PNG": ("png", "image/png"),
+         "GIF": ("gif", "image/gif"), "WEBP": ("webp", "image/webp")}
+MIMETYPES = {ext: mimetype for ext, mimetype in TYPES.values()}
+
+
+class ImageError(Exception):
+    """Raised when an image could not be fetched or read."""
+
+
+def sign(url, width):
+    key = current_app.config["SECRET_KEY"].encode()
+    return hmac.new(key, f"{width}:{url}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def thumbnail_url(url, width=400):
+    """Where templates link image `url`, `width` pixels wide: through the
+    proxy if it's on, else `url` itself."""
+
+    if not (url and current_app.config["IMAGE_PROXY"]):
+        return url
+    return url_for("image_proxy", width=width, signature=sign(url, width), url=url)
+
+
+#######################################
+# fetching and resizing
+
+
+def check_public(url):
+    """Raise ImageError unless `url` is http(s) on a public address."""
+
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ImageError(f"not an http(s) url: {url}")
+    if current_app.config["IMAGE_PROXY_ALLOW_PRIVATE"]:
+        return
+
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or 443,
+                                       proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise ImageError(f"can't resolve {parts.hostname}: {e}") from e
+    for *_, sockaddr in addresses:
+        if not _is_public(sockaddr[0]):
+            raise ImageError(f"{parts.hostname} isn't a public host")
+
+
+def _is_public(address):
+    address = ipaddress.ip_address(address)
+    if getattr(address, "ipv4_mapped", None):
+        address = address.ipv4_mapped
+    return address.is_global
+
+
+def _check_peer(sock, host):
+    """Close `sock` and raise ImageError unless it's connected to a
+    public address."""
+
+    if current_app.config["IMAGE_PROXY_ALLOW_PRIVATE"]:
+        return
+    address = sock.getpeername()[0]
+    if not _is_public(address):
+        sock.close()
+        raise ImageError(f"{host} connected to {address}, which isn't public")
+
+
+class PublicHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        sock = super()._new_conn()
+        _check_peer(sock, self.host)
+        return sock
+
+
+class PublicHTTPSConnection(HTTPSConnection):
+    # the check comes before TLS, which still verifies (and sends as SNI)
+    # the URL's hostname
+    def _new_conn(self):
+        sock = super()._new_conn()
+        _check_peer(sock, self.host)
+        return sock
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicAdapter(HTTPAdapter):
+    """An HTTPAdapter whose connections are checked with `_check_peer`."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": PublicHTTPConnectionPool, "https": PublicHTTPSConnectionPool}
+
+
+class ImageFetcher:
+    """Downloads images over a pooled, keep-alive session."""
+
+    def __init__(self, timeout, max_bytes, pool_size=10):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.pool_size = pool_size
+        self.session = self._make_session()
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = PublicAdapter(pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def reset(self):
+        """Start a fresh connection pool (in a forked worker)."""
+
+        self.session = self._make_session()
+
+    def fetch(self, url):
+        """Return the bytes of image `url`."""
+
+        check_public(url)
+        try:
+            # no redirects: they could lead anywhere, past check_public
+            with self.session.get(url, timeout=self.timeout, stream=True,
+                                  allow_redirects=False) as response:
+                if response.status_code != 200:
+                    raise ImageError(f"{url} returned {response.status_code}")
+                if not response.headers.get("Content-Type", "").startswith("image/"):
+                    raise ImageError(f"{url} isn't an image")
+
+                content = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    content += chunk
+                    if len(content) > self.max_bytes:
+                        raise ImageError(f"{url} is over {self.max_bytes} bytes")
+                return bytes(content)
+        except requests.RequestException as e:
+            raise ImageError(f"fetching {url} failed: {e}") from e
+
+
+def resize(content, width):
+    """Return (bytes, extension) of image `content` at most `width`
+    pixels wide. Without Pillow, the original."""
+
+    if Image is None:
+        return content, None
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            if image.format not in TYPES:
+                raise ImageError(f"unsupported image format {image.format}")
+            if image.width <= width:
+                return content, TYPES[image.format][0]
+
+            # (keeps the aspect ratio; only the width is a limit)
+            image.thumbnail((width, image.height))
+            if image.mode in ("RGBA", "LA", "P"):
+                out_format = "PNG"
+            else:
+                out_format = "JPEG"
+                image = image.convert("RGB")
+
+            out = io.BytesIO()
+            image.save(out, out_format, optimize=True,
+                       **({"quality": 85, "progressive": True}
+                          if out_format == "JPEG" else {}))
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageError(f"can't read image: {e}") from e
+
+    return out.getvalue(), TYPES[out_format][0]
+
+
+def sniff(content):
+    """The extension for image `content`, from its first bytes."""
+
+    if content.startswith(b"\xff\xd8"):
+        return "jpg"
+    if content.startswith(b"\x89PNG"):
+        return "png"
+    if content.startswith(b"GIF8"):
+        return "gif"
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return "webp"
+    raise ImageError("not a jpg, png, gif or webp image")
+
+
+#######################################
+# the disk cache
+
+
+class DiskCache:
+    """Thumbnails as files in `directory`, oldest-used removed once they
+    add up to more than `max_bytes`."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # this process's idea of the total; every eviction rescans, so
+        # other processes' writes are counted then
+        self.size = sum(entry.stat().st_size for entry in self._files())
+
+    def _files(self):
+        return [entry for entry in os.scandir(self.directory)
+                if entry.is_file() and not entry.name.startswith(".")]
+
+    def key(self, url, width):
+        return f"{hashlib.sha256(url.encode()).hexdigest()}-{width}"
+
+    def get(self, key):
+        """The path of the file stored for `key`, or None."""
+
+        for ext in MIMETYPES:
+            path = os.path.join(self.directory, f"{key}.{ext}")
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if time.time() - mtime > TOUCH_INTERVAL:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    continue
+            return path
+        return None
+
+    def put(self, key, content, ext):
+        """Store `content` for `key`; return its path."""
+
+        path = os.path.join(self.directory, f"{key}.{ext}")
+        # written aside and renamed in, so readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(fd, "wb") as file:
+            file.write(content)
+        os.replace(tmp, path)
+
+        with self._lock:
+            self.size += len(content)
+            if self.size > self.max_bytes:
+                self._evict()
+        return path
+
+    def _evict(self):
+        files = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                        for entry in self._files()))
+        self.size = sum(size for _, size, _ in files)
+        # down to 90%, so we aren't back here on the next write
+        target = self.max_bytes * 0.9
+        for _, size, path in files:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+#######################################
+# serving
+
+
+def image_proxy(width, signature):
+    url = request.args.get("url", "")
+    if (width not in current_app.config["IMAGE_PROXY_WIDTHS"] or
+            not hmac.compare_digest(signature, sign(url, width))):
+        abort(404)
+
+    proxy = current_app.extensions["images"]
+    key = proxy.cache.key(url, width)
+
+    path = proxy.cache.get(key)
+    if path is None:
+        try:
+            content, ext = resize(proxy.fetcher.fetch(url), width)
+            path = proxy.cache.put(key, content, ext or sniff(content))
+        except ImageError as e:
+            logger.warning("image proxy: %s", e)
+            response = redirect(url)
+            response.headers["Cache-Control"] = f"public, max-age={RETRY_AFTER}"
+            return response
+
+    response = send_file(path, mimetype=MIMETYPES[path.rsplit(".", 1)[1]],
+                         conditional=True, etag=True)
+    response.headers["Cache-Control"] = IMMUTABLE
+    return response
+
+
+class ImageProxy:
+    """One app's image cache and fetcher."""
+
+    def __init__(self, cache, fetcher):
+        self.cache = cache
+        self.fetcher = fetcher
+
+
+def init_images(app):
+    app.add_template_global(thumbnail_url)
+    if not app.config["IMAGE_PROXY"]:
+        return
+    if Image is None:
+        logger.warning("image proxy: Pillow isn't installed; images are "
+                       "served at their original size")
+
+    directory = os.path.join(app.instance_path, app.config["IMAGE_CACHE_DIR"])
+    app.extensions["images"] = ImageProxy(
+        DiskCache(directory, app.config["IMAGE_CACHE_BYTES"]),
+        ImageFetcher(app.config["IMAGE_PROXY_TIMEOUT"],
+                     app.config["IMAGE_PROXY_MAX_BYTES"]))
+    app.add_url_rule("/images/<int:width>/<signature>", "image_proxy", image_proxy)
@@ -0,0 +1,265 @@
+"""Bulk cafe import from CSV or JSONL.
+
+    flask import-cafes cafes.csv [--batch-size 500] [--no-maps]
+
+or an admin upload at /cafes/import. Either way the file is read a row
+at a time, each row is checked with the CafeForm rules (the same as
+adding a cafe by hand), and valid rows are inserted IMPORT_BATCH_SIZE
+at a time in multi-row INSERTs, each batch committed on its own. A bad
+row is reported with its line number and skipped; it doesn't stop the
+import. If a batch fails in the database, its rows are retried one at
+a time so only the offending ones are dropped.
+
+Columns (CSV header or JSON keys): name, description, url, address,
+city_code, image_url; others are ignored.
+
+Maps aren't fetched inline: each inserted cafe's map is queued on a
+MapPool of IMPORT_MAP_WORKERS threads. The CLI waits for them and
+reports how many failed; an upload returns straight away and leaves
+them fetching in the background (failures are logged, and the cafe is
+there either way, as with add_Cafe when MapQuest is down).
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError
+from werkzeug.datastructures import MultiDict
+
+from forms import CafeForm
+from mapquest import MapQuestError, save_map
+from models import db, city_registry, Cafe, DEFAULT_CAFE_IMAGE
+from summaries import refresh_city_summaries
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("name", "description", "url", "address", "city_code", "image_url")
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+
+def detect_format(filename):
+    """'cafes.csv' -> 'csv'; None if the extension isn't one we read."""
+
+    return FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def read_rows(file, format):
+    """Yield (line number, row dict) from a binary file, streaming."""
+
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+
+    if format == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_num, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except ValueError as e:
+            # reported by validate(), like any other bad row
+            yield line_num, e
+
+
+def validate(row, choices):
+    """Return (cafe column values, None), or (None, error message)."""
+
+    if isinstance(row, ValueError):
+        return None, f"invalid JSON: {row}"
+    if not isinstance(row, dict):
+        return None, "not a JSON object"
+
+    form = CafeForm(
+        formdata=MultiDict({field: "" if row.get(field) is None else str(row[field])
+                            for field in FIELDS}),
+        meta={"csrf": False},
+    )
+    form.city_code.choices = choices
+
+    if not form.validate():
+        return None, "; ".join(f"{field}: {' '.join(errors)}"
+                               for field, errors in form.errors.items())
+
+    return {
+        "name": form.name.data,
+        "description": form.description.data or "",
+        "url": form.url.data or "",
+        "address": form.address.data,
+        "city_code": form.city_code.data,
+        "image_url": form.image_url.data or DEFAULT_CAFE_IMAGE,
+    }, None
+
+
+class MapPool:
+    """Fetches and saves cafes' maps on worker threads."""
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="import-maps")
+        self._lock = threading.Lock()
+        self.saved = 0
+        self.failed = 0
+
+    def submit(self, cafe_id, address, city_code):
+        city = city_registry.get(city_code)
+        future = self.executor.submit(save_map, cafe_id, address,
+                                      city.name, city.state)
+        future.add_done_callback(
+            lambda future: self._done(cafe_id, future.exception()))
+
+    def _done(self, cafe_id, error):
+        with self._lock:
+            if error is None:
+                self.saved += 1
+            else:
+                self.failed += 1
+        if error is not None:
+            level = logging.WARNING if isinstance(error, MapQuestError) else logging.ERROR
+            logger.log(level, "no map for cafe %s: %s", cafe_id, error)
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
+
+
+# shared by uploads, so they don't each start (and leak) threads
+_background_maps = None
+_background_lock = threading.Lock()
+
+
+def background_maps(app):
+    global _background_maps
+
+    with _background_lock:
+        if _background_maps is None:
+            _background_maps = MapPool(app.config["IMPORT_MAP_WORKERS"])
+        return _background_maps
+
+
+class ImportResult:
+    """What an import did: counts, per-row errors and throughput."""
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        # (line number, message)
+        self.errors = []
+        self.city_codes = set()
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (f"Imported {self.imported} of {self.rows} cafes "
+                f"({len(self.errors)} errors) in {self.elapsed:.1f}s, "
+                f"{self.rows_per_sec:,.0f} rows/sec.")
+
+
+def import_cafes(file, format, batch_size=None, maps=None):
+    """Import cafes from binary `file` in `format` ('csv' or 'jsonl').
+
+    Inserted cafes' maps are queued on MapPool `maps`, if given.
+    Returns an ImportResult.
+    """
+
+    batch_size = batch_size or current_app.config["IMPORT_BATCH_SIZE"]
+    choices = city_registry.choices
+    result = ImportResult()
+    start = time.perf_counter()
+
+    batch = []
+    for line_num, row in read_rows(file, format):
+        result.rows += 1
+        values, error = validate(row, choices)
+        if error:
+            result.errors.append((line_num, error))
+            continue
+
+        batch.append((line_num, values))
+        if len(batch) == batch_size:
+            _insert_batch(batch, result, maps)
+            batch = []
+
+    if batch:
+        _insert_batch(batch, result, maps)
+
+    # a bulk INSERT goes around the summaries' session hooks
+    if result.city_codes:
+        with db.engine.begin() as conn:
+            refresh_city_summaries(conn, sorted(result.city_codes))
+
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _insert_batch(batch, result, maps):
+    try:
+        inserted = list(zip(batch, _insert([values for _, values in batch])))
+    except DBAPIError:
+        db.session.rollback()
+        # find the rows at fault
+        inserted = []
+        for line_num, values in batch:
+            try:
+                inserted.append(((line_num, values), _insert([values])[0]))
+            except DBAPIError as e:
+                db.session.rollback()
+                result.errors.append((line_num, str(e.orig).strip()))
+
+    result.imported += len(inserted)
+    for (_, values), cafe_id in inserted:
+        result.city_codes.add(values["city_code"])
+        if maps is not None:
+            maps.submit(cafe_id, values["address"], values["city_code"])
+
+
+def _insert(rows):
+    """INSERT and commit `rows`; return their new ids, in order."""
+
+    ids = db.session.execute(
+        insert(Cafe).returning(Cafe.id, sort_by_parameter_order=True), rows
+    ).scalars().all()
+    db.session.commit()
+    return ids
+
+
+@click.command("import-cafes")
+@click.argument("file", type=click.File("rb"))
+@click.option("--format", "format_", type=click.Choice(["csv", "jsonl"]),
+              help="default: from the file's extension")
+@click.option("--batch-size", type=int, help="rows per INSERT")
+@click.option("--maps/--no-maps", default=True, help="fetch each cafe's map")
+@with_appcontext
+def import_cafes_command(file, format_, batch_size, maps):
+    """Import cafes from a CSV or JSONL file."""
+
+    format_ = format_ or detect_format(file.name)
+    if format_ is None:
+        raise click.UsageError("Can't tell the format; pass --format.")
+
+    pool = MapPool(current_app.config["IMPORT_MAP_WORKERS"]) if maps else None
+    result = import_cafes(file, format_, batch_size, pool)
+
+    for line_num, error in result.errors:
+        click.echo(f"line {line_num}: {error}", err=True)
+    click.echo(result.summary())
+
+    if pool:
+        start = time.perf_counter()
+        pool.wait()
+        click.echo(f"Maps: {pool.saved} saved, {pool.failed} failed "
+                   f"in {time.perf_counter() - start:.1f}s more.")
@@ -0,0 +1,236 @@
+"""Cross-process invalidation of per-process caches, over Postgres
+LISTEN/NOTIFY.
+
+Each process keeps things in memory that a commit elsewhere makes
+stale: the city registry, and the entity cache's local tier. On its own
+a process only notices a change it committed itself. With
+INVALIDATION_BUS on:
+
+- Publishing. When a session commits changes to cafes, cities or users,
+  it first sends a NOTIFY on CHANNEL listing what changed: "table:id"
+  keys of rows added, changed or deleted, and whole tables for bulk
+  INSERT/UPDATE/DELETE or a changed city. The
+  NOTIFY is part of the transaction, so it goes out exactly when the
+  commit succeeds, never for a rollback.
+- Listening. Every process has a thread with its own connection
+  LISTENing on CHANNEL. For each message from another process it evicts
+  the entries from the entity cache's local tier, reloads the city
+  registry if a city changed, and sends the `invalidated` signal for any
+  other cache to act on.
+- Resync. Postgres delivers every notification committed while a
+  connection is listening, in commit order; messages are only missed
+  while not connected. So each time the listener (re)connects, it first
+  LISTENs and then throws away everything it might have missed:
+  the whole local tier, and the registry, reloaded. A connection that
+  dies quietly is found by a `SELECT 1` every INVALIDATION_HEARTBEAT
+  seconds of silence.
+
+Writes that go around the session (generate_data, raw SQL) can call
+`publish` themselves. Only Postgres (psycopg2) has LISTEN/NOTIFY; on
+anything else the bus stays off, as the entity cache's short local TTL
+still bounds staleness.
+"""
+
+import json
+import logging
+import os
+import select
+import socket
+import threading
+
+from blinker import Namespace
+from flask import current_app, has_app_context
+from sqlalchemy import event, text
+
+from entity_cache import CACHED_MODELS
+from models import db, city_registry
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "flask_cafe_invalidate"
+
+# Postgres refuses payloads of 8000 bytes or more
+MAX_PAYLOAD = 7900
+
+ALL_TABLES = tuple(model.__tablename__ for model in CACHED_MODELS)
+
+signals = Namespace()
+
+# sent with `keys` and `tables` when another process commits changes to
+# them, or with every table after a resync
+invalidated = signals.signal("invalidated")
+
+
+def origin():
+    """This process, as named in the messages it publishes."""
+
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def message(keys=(), tables=()):
+    """The NOTIFY payload for `keys` and `tables`. Too many keys to fit
+    are widened to their whole tables."""
+
+    tables = set(tables)
+    keys = sorted(key for key in keys if key.split(":", 1)[0] not in tables)
+    payload = json.dumps({"origin": origin(), "keys": keys,
+                          "tables": sorted(tables)})
+    if len(payload.encode()) < MAX_PAYLOAD:
+        return payload
+
+    tables.update(key.split(":", 1)[0] for key in keys)
+    return json.dumps({"origin": origin(), "keys": [], "tables": sorted(tables)})
+
+
+def publish(conn, keys=(), tables=()):
+    """NOTIFY other processes, when the transaction on `conn` commits,
+    that `keys` and `tables` changed."""
+
+    if conn.dialect.name != "postgresql" or not (keys or tables):
+        return
+    conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                 {"channel": CHANNEL, "payload": message(keys, tables)})
+
+
+#######################################
+# publishing commits
+
+
+@event.listens_for(db.session, "before_commit")
+def _publish_changes(session):
+    if not (has_app_context() and current_app.config["INVALIDATION_BUS"]):
+        return
+
+    # what's still pending flushes now, so the hooks below have seen it all
+    session.flush()
+
+    # noted by the entity cache's and city registry's session hooks
+    keys = session.info.get("entity_cache_keys", ())
+    tables = set(session.info.get("entity_cache_tables", ()))
+    if session.info.get("cities_changed"):
+        tables.add("cities")
+
+    if keys or tables:
+        publish(session.connection(), keys, tables)
+
+
+#######################################
+# listening
+
+
+class Listener:
+    """The thread applying other processes' invalidations to this one."""
+
+    def __init__(self, app):
+        self.app = app
+        self.heartbeat = app.config["INVALIDATION_HEARTBEAT"]
+        self.max_delay = app.config["INVALIDATION_RECONNECT_DELAY"]
+        self.resyncs = 0
+        self._thread = None
+
+    def start(self):
+        self._stopped = threading.Event()
+        self._delay = 1
+        # written to by stop(), to wake the thread out of select()
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(target=self._run, name="invalidation",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread and close its connection."""
+
+        if self._thread is None:
+            return
+        self._stopped.set()
+        os.write(self._wake_w, b"x")
+        self._thread.join()
+        self._thread = None
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def handle(self, payload):
+        """Apply one message from CHANNEL."""
+
+        try:
+            data = json.loads(payload)
+            keys, tables = data["keys"], data["tables"]
+        except (ValueError, KeyError, TypeError):
+            logger.error("invalidation: bad message %r", payload)
+            return
+        if data.get("origin") == origin():
+            # already done when we committed it
+            return
+        self.invalidate(keys, tables)
+
+    def resync(self):
+        """Drop everything a missed message could have been about."""
+
+        self.resyncs += 1
+        self.invalidate((), ALL_TABLES)
+
+    def invalidate(self, keys, tables):
+        cache = self.app.extensions.get("entity_cache")
+        if cache is not None:
+            cache.local.invalidate(keys, tables)
+
+        if "cities" in tables or any(key.startswith("cities:") for key in keys):
+            with self.app.app_context():
+                city_registry.load()
+
+        invalidated.send(self.app, keys=keys, tables=tables)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                logger.warning("invalidation: listener disconnected (%s); "
+                               "reconnecting in %ss", e, self._delay)
+                self._stopped.wait(self._delay)
+                self._delay = min(self._delay * 2, self.max_delay)
+
+    def _listen(self):
+        with self.app.app_context():
+            proxy = db.engine.raw_connection()
+        # ours for good; it never goes back to the pool
+        proxy.detach()
+        conn = proxy.driver_connection
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {CHANNEL}")
+            self._delay = 1
+            # anything committed from here on reaches us; make up for
+            # what came before
+            self.resync()
+
+            while not self._stopped.is_set():
+                ready, _, _ = select.select([conn, self._wake_r], [], [],
+                                            self.heartbeat)
+                if self._wake_r in ready:
+                    return
+                if not ready:
+                    cursor.execute("SELECT 1")
+                conn.poll()
+                while conn.notifies:
+                    self.handle(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+
+def init_invalidation_bus(app):
+    if not app.config["INVALIDATION_BUS"]:
+        return
+
+    with app.app_context():
+        driver = db.engine.dialect.driver
+    if driver != "psycopg2":
+        logger.info("invalidation bus needs Postgres via psycopg2; off")
+        app.config["INVALIDATION_BUS"] = False
+        return
+
+    listener = app.extensions["invalidation_bus"] = Listener(app)
+    listener.start()
@@ -1,6 +1,11 @@
 """Handles api request for mapquest static maps"""
-import requests
 import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 #holy cow this took forever to get working
@@ -8,27 +13,249 @@ env = load_dotenv()
 
 
 API_KEY = os.environ.get("MAPQUEST_API_KEY")
-BASE_URL = "https://www.mapquestapi.com/staticmap/v5/map"
+BASE_URL = os.environ.get(
+    "MAPQUEST_BASE_URL", "https://www.mapquestapi.com/staticmap/v5/map")
+
+CONNECT_TIMEOUT = float(os.environ.get("MAPQUEST_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.environ.get("MAPQUEST_READ_TIMEOUT", 10))
+MAX_RETRIES = int(os.environ.get("MAPQUEST_MAX_RETRIES", 2))
+POOL_SIZE = int(os.environ.get("MAPQUEST_POOL_SIZE", 10))
+
+# statuses worth another try; anything else 4xx is our fault, not theirs
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class MapQuestError(Exception):
+    """Raised when a static map could not be fetched."""
+
+
+class MapQuestRejected(MapQuestError):
+    """Raised when MapQuest refuses the request itself (a 4xx other than
+    429). MapQuest is up, so this doesn't count against the breaker."""
+
+
+class CircuitOpenError(MapQuestError):
+    """Raised without calling MapQuest while the breaker is open."""
+
+
+class CircuitBreaker:
+    """Fail fast after repeated failures until `reset_timeout` passes.
+
+    closed: calls go through. open: calls are refused. half-open: one
+    trial call is let through, and the rest refused until it ends;
+    success closes, failure re-opens.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._state = self.CLOSED
+        # whether the half-open trial call has been handed out
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _current_state(self):
+        # call with self._lock held
+        if (self._state == self.OPEN and
+                self.clock() - self.opened_at >= self.reset_timeout):
+            self._state = self.HALF_OPEN
+            self._trial = False
+        return self._state
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def allow(self):
+        """Return True if a call may be attempted right now. Every caller
+        that gets True must then call record_success or record_failure."""
+
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._state = self.CLOSED
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._trial = False
+            self.failures += 1
+            if (self._state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self._state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class MapQuestClient:
+    """Pooled, keep-alive client for the static map api.
+
+    Every call has connect/read timeouts, retries transient failures with
+    jittered exponential backoff and goes through a circuit breaker.
+    """
+
+    def __init__(self, base_url=BASE_URL, api_key=API_KEY,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=0.25, pool_size=POOL_SIZE,
+                 breaker=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.pool_size = pool_size
+        self.session = self._make_session(pool_size)
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _make_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def reset(self):
+        """Start a fresh connection pool, e.g. in a forked worker whose
+        inherited sockets are still the parent's."""
+
+        self.session = self._make_session(self.pool_size)
+
+    def _params(self, address, city, state):
+        where = f"{address},{city},{state}"
+        return {
+            "key": self.api_key,
+            "center": where,
+            "size": "@2x",
+            "zoom": 15,
+            "locations": where,
+        }
+
+    def _retry_delay(self, attempt):
+        with self._lock:
+            self.retries += 1
+        # full jitter so a fleet of workers doesn't retry in lockstep
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+
+    def get_map(self, address, city, state):
+        """Return the jpg bytes of a static map for this location."""
+
+        if not self.breaker.allow():
+            raise CircuitOpenError("MapQuest circuit is open")
+
+        params = self._params(address, city, state)
+
+        start = time.perf_counter()
+        try:
+            content = self._get_with_retries(params)
+        except MapQuestRejected:
+            # MapQuest answered; the request was bad, not the service
+            self.breaker.record_success()
+            self._record(time.perf_counter() - start, error=True)
+            raise
+        except MapQuestError:
+            self.breaker.record_failure()
+            self._record(time.perf_counter() - start, error=True)
+            raise
+
+        self.breaker.record_success()
+        self._record(time.perf_counter() - start, error=False)
+        return content
+
+    def _get_with_retries(self, params):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self._retry_delay(attempt))
+
+            try:
+                response = self.session.get(
+                    self.base_url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = MapQuestError(f"MapQuest request failed: {e}")
+                continue
+
+            if response.status_code in RETRY_STATUSES:
+                error = MapQuestError(f"MapQuest returned {response.status_code}")
+                continue
+
+            if 400 <= response.status_code < 500:
+                raise MapQuestRejected(f"MapQuest returned {response.status_code}")
+
+            if not response.ok:
+                raise MapQuestError(f"MapQuest returned {response.status_code}")
+
+            return response.content
+
+        raise error
+
+    def _record(self, elapsed, error):
+        with self._lock:
+            self.calls += 1
+            self.errors += error
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+
+    def stats(self):
+        """Return latency, error rate and breaker state for this client."""
+
+        with self._lock:
+            calls = self.calls
+            return {
+                "calls": calls,
+                "errors": self.errors,
+                "retries": self.retries,
+                "error_rate": self.errors / calls if calls else 0.0,
+                "latency_total": self.latency_total,
+                "latency_avg": self.latency_total / calls if calls else 0.0,
+                "latency_max": self.latency_max,
+                "breaker_state": self.breaker.state,
+            }
+
+
+client = MapQuestClient()
+
 
 def get_map_url(address, city, state):
     """Get MapQuest URL for a static map for this location."""
 
-    base = f"https://www.mapquestapi.com/staticmap/v5/map?key={API_KEY}"
+    base = f"{BASE_URL}?key={API_KEY}"
     where = f"{address},{city},{state}"
     return f"{base}&center={where}&size=@2x&zoom=15&locations={where}"
 
 
 def save_map(id, address, city, state):
-    """Get static map and save in static/maps directory of this app."""
+    """Get static map and save in static/maps directory of this app.
+
+    Raises MapQuestError if the map couldn't be fetched.
+    """
 
     path = os.path.abspath(os.path.dirname(__file__))
 
-    url = get_map_url(address, city, state)
-    response = requests.get(url)
+    content = client.get_map(address, city, state)
 
     #wb for opening images
-    file = open(f"{path}/static/maps/{id}.jpg", "wb")
-
-    file.write(response.content)
+    with open(f"{path}/static/maps/{id}.jpg", "wb") as file:
+        file.write(content)
 
-    file.close
@@ -0,0 +1,403 @@
+"""Per-request latency and SQL instrumentation for Flask Cafe.
+
+For every request we count SQL statements and time spent in SQL,
+template rendering and MapQuest. Each response gets a `Server-Timing`
+header, and totals per endpoint are served in Prometheus text format at
+`/metrics`, along with MapQuest's calls, errors, retries, latency and
+circuit breaker state (from `mapquest.client.stats()`).
+
+Under several worker processes, set `METRICS_DIR`: each worker then
+writes a snapshot of its own totals there (at most every
+`METRICS_FLUSH_INTERVAL` seconds) and `/metrics` adds up every worker's
+snapshot, so it doesn't matter which worker the scrape lands on. Each
+worker has its own MapQuest breaker, so the breaker gauge counts the
+workers in each state. A worker's file goes when the worker does
+(`mark_process_dead`, from gunicorn's child_exit): totals then drop by
+what it had counted, which Prometheus reads as a counter reset.
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, current_app, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import mapquest
+from mapquest import CircuitBreaker
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# per-request timings, by Server-Timing name
+TIMINGS = ("sql", "tpl", "mapquest")
+
+STATS_KEY = "flask_cafe.request_stats"
+
+BREAKER_STATES = (CircuitBreaker.CLOSED, CircuitBreaker.OPEN,
+                  CircuitBreaker.HALF_OPEN)
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    """A view ran more SQL statements than its budget allows."""
+
+
+class Metrics:
+    """Totals per endpoint for this process."""
+
+    def __init__(self, metrics_dir=None, flush_interval=1.0):
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self.endpoints = {}
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, duration, sql_count, timings):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = _empty_stats()
+
+            stats["count"] += 1
+            stats["duration"] += duration
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats["buckets"][i] += 1
+            stats["sql_count"] += sql_count
+            for name in TIMINGS:
+                stats[name] += timings[name]
+
+        if self.metrics_dir:
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        now = time.monotonic()
+        if now - self._flushed_at < self.flush_interval:
+            return
+        self._flushed_at = now
+        self.flush()
+
+    def snapshot(self):
+        """This process's totals: {"endpoints": ..., "mapquest": ...}."""
+
+        with self._lock:
+            endpoints = json.loads(json.dumps(self.endpoints))
+        return {"endpoints": endpoints, "mapquest": _mapquest_stats()}
+
+    def flush(self):
+        """Write this process's totals to `metrics_dir/<pid>.json`."""
+
+        data = json.dumps(self.snapshot())
+
+        path = os.path.join(self.metrics_dir, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def collect(self):
+        """Totals across every worker: {"endpoints": {endpoint: totals},
+        "mapquest": totals}."""
+
+        if not self.metrics_dir:
+            return self.snapshot()
+
+        self.flush()
+        totals = {"endpoints": {}, "mapquest": dict.fromkeys(_mapquest_stats(), 0)}
+        for path in glob.glob(os.path.join(self.metrics_dir, "*.json")):
+            with open(path) as file:
+                try:
+                    snapshot = json.load(file)
+                except ValueError:
+                    continue
+            for endpoint, stats in snapshot["endpoints"].items():
+                _add_stats(totals["endpoints"].setdefault(endpoint, _empty_stats()),
+                           stats)
+            _add_stats(totals["mapquest"], snapshot["mapquest"])
+
+        return totals
+
+
+def mark_process_dead(metrics_dir, pid):
+    """Remove the snapshot of worker `pid`, which has exited."""
+
+    try:
+        os.remove(os.path.join(metrics_dir, f"{pid}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def _empty_stats():
+    stats = {"count": 0, "duration": 0.0, "buckets": [0] * len(BUCKETS),
+             "sql_count": 0}
+    stats.update((name, 0.0) for name in TIMINGS)
+    return stats
+
+
+def _mapquest_stats():
+    stats = mapquest.client.stats()
+    totals = {key: stats[key] for key in ("calls", "errors", "retries",
+                                          "latency_total")}
+    # one-hot, so adding up workers counts them per state
+    totals.update((f"breaker_{state}", int(stats["breaker_state"] == state))
+                  for state in BREAKER_STATES)
+    return totals
+
+
+def _add_stats(total, stats):
+    for key, value in stats.items():
+        if key == "buckets":
+            total[key] = [a + b for a, b in zip(total[key], value)]
+        else:
+            total[key] += value
+
+
+def render_prometheus(collected):
+    """Prometheus text exposition of `collect()` output."""
+
+    totals = collected["endpoints"]
+    lines = [
+        "# HELP flask_cafe_request_duration_seconds Request latency.",
+        "# TYPE flask_cafe_request_duration_seconds histogram",
+    ]
+    for endpoint, stats in sorted(totals.items()):
+        label = f'endpoint="{endpoint}"'
+        for bound, count in zip(BUCKETS, stats["buckets"]):
+            lines.append(
+                f'flask_cafe_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+        lines.append(
+            f'flask_cafe_request_duration_seconds_bucket{{{label},le="+Inf"}} {stats["count"]}')
+        lines.append(f'flask_cafe_request_duration_seconds_sum{{{label}}} {stats["duration"]}')
+        lines.append(f'flask_cafe_request_duration_seconds_count{{{label}}} {stats["count"]}')
+
+    counters = [
+        ("sql_statements_total", "sql_count", "SQL statements executed."),
+        ("sql_seconds_total", "sql", "Time spent in SQL."),
+        ("template_seconds_total", "tpl", "Time spent rendering templates."),
+        ("mapquest_seconds_total", "mapquest", "Time spent calling MapQuest."),
+    ]
+    for name, key, help in counters:
+        lines.append(f"# HELP flask_cafe_{name} {help}")
+        lines.append(f"# TYPE flask_cafe_{name} counter")
+        for endpoint, stats in sorted(totals.items()):
+            lines.append(f'flask_cafe_{name}{{endpoint="{endpoint}"}} {stats[key]}')
+
+    upstream = collected["mapquest"]
+    upstream_counters = [
+        ("mapquest_calls_total", "calls", "MapQuest map requests (each with its retries)."),
+        ("mapquest_errors_total", "errors", "MapQuest calls that failed."),
+        ("mapquest_retries_total", "retries", "MapQuest retries."),
+        ("mapquest_call_seconds_total", "latency_total",
+         "Time spent in MapQuest calls, retries and backoff included."),
+    ]
+    for name, key, help in upstream_counters:
+        lines.append(f"# HELP flask_cafe_{name} {help}")
+        lines.append(f"# TYPE flask_cafe_{name} counter")
+        lines.append(f"flask_cafe_{name} {upstream[key]}")
+
+    lines.append("# HELP flask_cafe_mapquest_breaker Processes whose MapQuest "
+                 "circuit breaker is in each state.")
+    lines.append("# TYPE flask_cafe_mapquest_breaker gauge")
+    for state in BREAKER_STATES:
+        lines.append(f'flask_cafe_mapquest_breaker{{state="{state}"}} '
+                     f'{upstream[f"breaker_{state}"]}')
+
+    return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    """SQL count and timings for one request.
+
+    Kept on the request rather than in `g`: a streamed response renders
+    under a fresh app context (with a fresh `g`) but the same request.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.timings = dict.fromkeys(TIMINGS, 0.0)
+        self.template_start = None
+
+
+def current_stats():
+    """This request's RequestStats, or None outside a timed request."""
+
+    if has_request_context():
+        return request.environ.get(STATS_KEY)
+    return None
+
+
+def add_time(name, seconds):
+    """Add `seconds` to this request's `name` timing (no-op outside one)."""
+
+    stats = current_stats()
+    if stats is not None:
+        stats.timings[name] += seconds
+
+
+@contextmanager
+def timer(name):
+    """Time the enclosed block as part of this request's `name` timing."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+#######################################
+# query budgets
+
+
+def query_budget(max_statements):
+    """Declare the most SQL statements this view may run per request.
+
+    `QUERY_BUDGETS` in config ({endpoint: max}) overrides this. Going
+    over raises QueryBudgetExceeded if `QUERY_BUDGET_RAISE`, else logs.
+    """
+
+    def decorator(view):
+        view.query_budget = max_statements
+        return view
+
+    return decorator
+
+
+def check_query_budget(app, endpoint, sql_count):
+    budget = app.config["QUERY_BUDGETS"].get(endpoint)
+    if budget is None:
+        view = app.view_functions.get(endpoint)
+        budget = getattr(view, "query_budget", None)
+
+    if budget is None or sql_count <= budget:
+        return
+
+    msg = f"{endpoint} ran {sql_count} SQL statements (budget {budget})"
+    if app.config["QUERY_BUDGET_RAISE"]:
+        raise QueryBudgetExceeded(msg)
+    logger.warning(msg)
+
+
+#######################################
+# hooks
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+
+    stats = current_stats()
+    if stats is not None:
+        stats.sql_count += 1
+        stats.timings["sql"] += elapsed
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # a statement that fails never gets to after_cursor_execute
+    if (context.connection is not None and
+            context.execution_context is not None and
+            context.statement is not None):
+        starts = context.connection.info.get("query_start")
+        if starts:
+            starts.pop()
+
+
+def _start_request():
+    request.environ[STATS_KEY] = RequestStats()
+
+
+def _before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.template_start = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.template_start is not None:
+        stats.timings["tpl"] += time.perf_counter() - stats.template_start
+        stats.template_start = None
+
+
+def _finish_request(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+
+    app = current_app._get_current_object()
+    endpoint = request.endpoint
+
+    def finish():
+        duration = time.perf_counter() - stats.start
+        app.extensions["metrics"].observe(
+            endpoint or "unknown", duration, stats.sql_count, stats.timings)
+        if endpoint:
+            check_query_budget(app, endpoint, stats.sql_count)
+
+    if app.config["SERVER_TIMING"]:
+        # headers go before a streamed body, so this only covers the view
+        timings = stats.timings
+        response.headers["Server-Timing"] = ", ".join([
+            f'sql;dur={timings["sql"] * 1000:.2f};desc="{stats.sql_count} queries"',
+            f'tpl;dur={timings["tpl"] * 1000:.2f}',
+            f'mapquest;dur={timings["mapquest"] * 1000:.2f}',
+            f'total;dur={(time.perf_counter() - stats.start) * 1000:.2f}',
+        ])
+
+    if response.is_streamed and not response.direct_passthrough:
+        # the body (and its queries) is still to come; finish after it
+        response.response = _finish_after(response.response, finish)
+    else:
+        finish()
+
+    return response
+
+
+def _finish_after(body, finish):
+    try:
+        yield from body
+    finally:
+        finish()
+
+
+def show_metrics():
+    """Prometheus scrape endpoint."""
+
+    totals = current_app.extensions["metrics"].collect()
+    return Response(render_prometheus(totals),
+                    mimetype="text/plain; version=0.0.4")
+
+
+def init_metrics(app):
+    """Install the hooks and `/metrics`. Call before registering views so
+    their before-request work is timed too."""
+
+    if not app.config["METRICS"]:
+        return
+
+    metrics_dir = app.config.get("METRICS_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+
+    app.extensions["metrics"] = Metrics(
+        metrics_dir, app.config.get("METRICS_FLUSH_INTERVAL", 1.0))
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.add_url_rule("/metrics", "metrics", show_metrics)
@@ -1,13 +1,20 @@
 """Data models for Flask Cafe"""
 
+import threading
+from collections import namedtuple
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, event, func, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql import visitors
 from mapquest import save_map
+from replicas import RoutingSession, configure_replicas
 
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 DEFAULT_USER_IMAGE = "https://cdn.pixabay.com/photo/2012/04/26/19/43/profile-42914_640.png"
 DEFAULT_CAFE_IMAGE = "https://cafenapoleon.com/cdn/shop/files/collection-bio-equitable_1000x1000.jpg?v=1622054058"
 
@@ -32,9 +39,58 @@ class City(db.Model):
         nullable=False,
     )
 
-    @classmethod
-    def get_cities(cls):
-        return [(c.code, c.name) for c in cls.query.order_by('name').all()]
+
+CityInfo = namedtuple("CityInfo", ["code", "name", "state"])
+
+
+class CityRegistry:
+    """In-process, read-only copy of every City.
+
+    Cities almost never change, so views and templates look them up here
+    by code (and get form choices, already sorted) without touching the
+    DB. Committing a change to any City reloads the registry.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._by_code = {}
+        self._choices = ()
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """(Re)load every City. Needs an app context."""
+
+        with db.engine.connect() as conn:
+            rows = conn.execute(
+                select(City.code, City.name, City.state).order_by(City.name)
+            ).all()
+
+        cities = [CityInfo(*row) for row in rows]
+        with self._lock:
+            # swap in whole new objects; readers never see a half-built one
+            self._by_code = {city.code: city for city in cities}
+            self._choices = tuple((city.code, city.name) for city in cities)
+            self.version += 1
+            self._loaded = True
+
+    def get(self, code):
+        """Return the CityInfo for `code`, or None."""
+
+        if not self._loaded:
+            self.load()
+        return self._by_code.get(code)
+
+    @property
+    def choices(self):
+        """[(code, name), ...] sorted by name, for CafeForm.city_code."""
+
+        if not self._loaded:
+            self.load()
+        return list(self._choices)
+
+
+city_registry = CityRegistry()
 
 
 class Cafe(db.Model):
@@ -50,6 +106,8 @@ class Cafe(db.Model):
     name = db.Column(
         db.Text,
         nullable=False,
+        # ORDER BY name in every listing
+        index=True,
     )
 
     description = db.Column(
@@ -71,6 +129,7 @@ class Cafe(db.Model):
         db.Text,
         db.ForeignKey('cities.code'),
         nullable=False,
+        index=True,
     )
 
     image_url = db.Column(
@@ -81,16 +140,46 @@ class Cafe(db.Model):
 
     city = db.relationship("City", backref='cafes')
 
+    @classmethod
+    def listing(cls, q=""):
+        """Return a query of all cafes in abc order, only those whose name
+        contains `q` if given (the /cafes page)."""
+
+        query = cls.query.order_by('name')
+        if q:
+            query = query.filter(cls.name.icontains(q, autoescape=True))
+        return query
+
+    def get_city_info(self):
+        """Return this cafe's CityInfo, from the registry if possible."""
+
+        city = city_registry.get(self.city_code)
+        if city is None:
+            # added since the last reload, e.g. by another process
+            city = CityInfo(self.city.code, self.city.name, self.city.state)
+        return city
+
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
+        city = self.get_city_info()
         return f'{city.name}, {city.state}'
 
     def save_map(self):
         """Save map for this cafe."""
 
-        save_map(self.id, self.address, self.city.name, self.city.state)
+        city = self.get_city_info()
+        save_map(self.id, self.address, city.name, city.state)
+
+    def get_related_cafes(self, limit=5):
+        """Return a query of the cafes most liked by the people who liked
+        this one (precomputed, see recommendations.py)."""
+
+        return (Cafe.query
+                .join(CafeNeighbor, CafeNeighbor.neighbor_id == Cafe.id)
+                .filter(CafeNeighbor.cafe_id == self.id)
+                .order_by(CafeNeighbor.score.desc(), CafeNeighbor.neighbor_id)
+                .limit(limit))
 
 
 class User(db.Model):
@@ -146,6 +235,12 @@ class User(db.Model):
         nullable=False,
     )
 
+    __table_args__ = (
+        # logins match usernames case-insensitively, so "Bob" and "bob"
+        # have to be one user
+        db.Index("ix_users_username_lower", db.func.lower(username), unique=True),
+    )
+
     liked_cafes = db.relationship(
         "Cafe",
         secondary = "likes",
@@ -155,6 +250,14 @@ class User(db.Model):
     def get_full_name(self):
         return f"{self.first_name} {self.last_name}"
 
+    def get_liked_cafes(self):
+        """Return a query of liked cafes in abc order."""
+
+        return (Cafe.query
+                .join(Like, Like.cafe_id == Cafe.id)
+                .filter(Like.user_id == self.id)
+                .order_by(Cafe.name))
+
 
     @classmethod
     def register(cls, username, email, first_name, last_name, description, password, admin=False, image_url=DEFAULT_USER_IMAGE):
@@ -182,7 +285,7 @@ class User(db.Model):
 
     @classmethod
     def authenticate(cls, username, password):
-        """Find user with `username` and `password`.
+        """Find user with `username` (in any case) and `password`.
 
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
@@ -191,7 +294,12 @@ class User(db.Model):
         False.
         """
 
-        user = cls.query.filter_by(username=username).one_or_none()
+        users = cls.query.filter(
+            db.func.lower(cls.username) == username.lower()).all()
+        # until ix_users_username_lower exists, old usernames may differ
+        # only in case; then only the exact one will do
+        user = next((user for user in users if user.username == username),
+                    users[0] if len(users) == 1 else None)
 
         if user:
             is_auth = bcrypt.check_password_hash(user.hashed_password, password)
@@ -216,14 +324,233 @@ class Like(db.Model):
         db.Integer,
         db.ForeignKey('cafes.id', ondelete="CASCADE"),
         primary_key=True,
+        # the primary key only covers lookups by user_id first
+        index=True,
+    )
+
+
+class CitySummary(db.Model):
+    """Precomputed homepage stats for a city, kept up to date by
+    summaries.py."""
+
+    __tablename__ = "city_summaries"
+
+    city_code = db.Column(
+        db.Text,
+        db.ForeignKey('cities.code', ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    cafe_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # [{"id": 1, "name": "...", "likes": 12}, ...], most liked first
+    top_cafes = db.Column(
+        db.JSON,
+        nullable=False,
+        default=list,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    def get_city_info(self):
+        return city_registry.get(self.city_code)
+
+
+class CafeNeighbor(db.Model):
+    """One of a cafe's most similar cafes by who liked them, kept up to
+    date by recommendations.py."""
+
+    __tablename__ = "cafe_neighbors"
+
+    cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    neighbor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cafes.id', ondelete="CASCADE"),
+        primary_key=True,
+        # a like rescales every pair with the liked cafe on either side
+        index=True,
+    )
+
+    # users who liked both
+    together = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # cosine similarity: together / sqrt(likes of one * likes of the other)
+    score = db.Column(
+        db.Float,
+        nullable=False,
     )
 
+
+def upsert(conn, model, rows):
+    """INSERT `rows` (dicts) into `model`'s table, updating the other
+    columns of any whose primary key already exists."""
+
+    table = model.__table__
+    dialect = postgresql if conn.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(table).values(rows)
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=list(table.primary_key),
+        set_={column.name: stmt.excluded[column.name]
+              for column in table.columns if not column.primary_key},
+    ))
+
+
+def changed_likes(session):
+    """In an after_flush hook: (user_id, cafe_id, +1 or -1, the Cafe or
+    None) for each like being added or removed, through a user's
+    liked_cafes or as a Like row. Likes that go with a deleted user or
+    cafe (by cascade) aren't included."""
+
+    changes = []
+
+    for obj in (*session.new, *session.deleted):
+        if isinstance(obj, Like):
+            changes.append((obj.user_id, obj.cafe_id,
+                            1 if obj in session.new else -1, None))
+
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, User):
+            history = inspect(obj).attrs.liked_cafes.history
+            changes.extend((obj.id, cafe.id, 1, cafe) for cafe in history.added)
+            changes.extend((obj.id, cafe.id, -1, cafe) for cafe in history.deleted)
+
+    return changes
+
+
+@event.listens_for(db.session, "after_flush")
+def _note_city_changes(session, flush_context):
+    if any(isinstance(obj, City)
+           for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info["cities_changed"] = True
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _note_city_bulk_changes(orm_execute_state):
+    if ((orm_execute_state.is_update or orm_execute_state.is_delete) and
+            orm_execute_state.bind_mapper is City.__mapper__):
+        orm_execute_state.session.info["cities_changed"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def _reload_cities(session):
+    if session.info.pop("cities_changed", False):
+        city_registry.load()
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_city_changes(session):
+    session.info.pop("cities_changed", None)
+
+
+class DuplicateKeysError(Exception):
+    """Raised when rows already in a table would break a unique index
+    that's about to be built."""
+
+    def __init__(self, duplicates):
+        # index name -> [rows (of the indexed columns) sharing a key]
+        self.duplicates = duplicates
+        super().__init__("; ".join(
+            f"{name}: {', '.join(map(str, rows))}"
+            for name, rows in duplicates.items()))
+
+
+def create_missing_indexes(engine):
+    """Create every declared index the database doesn't have yet, and
+    return their names.
+
+    On Postgres they're built CONCURRENTLY, so a big live table isn't
+    locked against writes meanwhile. A CONCURRENTLY build that failed
+    leaves an invalid index behind, which Postgres doesn't use (nor
+    enforce, if unique); those are dropped and built again.
+
+    Raises DuplicateKeysError, before building anything, if existing
+    rows would break a unique index.
+    """
+
+    created = []
+    postgres = engine.dialect.name == "postgresql"
+
+    # CONCURRENTLY can't run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        existing = _index_names(conn)
+        missing = [index for table in db.metadata.sorted_tables
+                   for index in table.indexes if not existing.get(index.name)]
+
+        duplicates = {index.name: rows for index in missing if index.unique
+                      for rows in [find_duplicate_keys(conn, index)] if rows}
+        if duplicates:
+            raise DuplicateKeysError(duplicates)
+
+        for index in missing:
+            if index.name in existing:
+                conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY {index.name}")
+
+            ddl = str(CreateIndex(index).compile(dialect=conn.dialect))
+            if postgres:
+                ddl = ddl.replace(" INDEX ", " INDEX CONCURRENTLY ", 1)
+            conn.exec_driver_sql(ddl)
+            created.append(index.name)
+
+    return created
+
+
+def find_duplicate_keys(conn, index):
+    """The rows that share a key of unique `index`, as tuples of the
+    columns it's on, grouped by key."""
+
+    keys = list(index.expressions)
+    columns = list({column.key: column for key in keys
+                    for column in visitors.iterate(key)
+                    if isinstance(column, Column)}.values())
+
+    ranked = select(*columns, func.count().over(partition_by=keys).label("n"),
+                    *[key.label(f"key{i}") for i, key in enumerate(keys)]).subquery()
+    return [tuple(row[:len(columns)]) for row in conn.execute(
+        select(ranked).where(ranked.c.n > 1)
+        .order_by(*[ranked.c[f"key{i}"] for i in range(len(keys))]))]
+
+
+def _index_names(conn):
+    """{index name: whether it's valid} for every index in the database."""
+
+    # the inspector skips expression indexes like lower(username)
+    if conn.dialect.name == "postgresql":
+        sql = ("SELECT c.relname, i.indisvalid FROM pg_index i "
+               "JOIN pg_class c ON c.oid = i.indexrelid "
+               "JOIN pg_namespace n ON n.oid = c.relnamespace "
+               "WHERE n.nspname = current_schema()")
+    else:
+        sql = "SELECT name, 1 FROM sqlite_master WHERE type = 'index'"
+    return {name: bool(valid) for name, valid in conn.exec_driver_sql(sql)}
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. It doesn't push an app
+    context; callers outside a request push their own.
     """
 
-    app.app_context().push()
-    db.app = app
+    configure_replicas(app)
     db.init_app(app)
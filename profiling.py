@@ -0,0 +1,254 @@
+"""On-demand profiling of single requests, for admins.
+
+An admin adds `?_profile=cpu` (or `memory`) to any URL, or sends the
+same in an `X-Profile` header, and that one request is profiled:
+
+- cpu: a thread samples the request thread's stack every
+  PROFILE_INTERVAL seconds and counts identical stacks. The result is in
+  the "folded" format (`outer;inner;leaf count` per line) that
+  flamegraph.pl, speedscope and most flamegraph tools read.
+- memory: tracemalloc traces the request, and the report lists the
+  lines whose allocations are still alive at the end, largest first,
+  with the peak. tracemalloc is process-wide, so other requests served
+  meanwhile show up too; only one memory profile runs at a time.
+
+The profile is written under PROFILE_DIR (in the instance folder, the
+latest PROFILE_KEEP kept) and the response names it in an X-Profile
+header; download it from /admin/profiles/<name>, or list them at
+/admin/profiles. Profiling lasts until the response is closed, so a
+streamed page is profiled as it renders.
+
+Requests that don't ask pay one dict lookup; anyone who isn't an admin
+is ignored.
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+from flask import (
+    abort, current_app, g, jsonify, request, send_from_directory,
+)
+
+KINDS = ("cpu", "memory")
+PARAM = "_profile"
+HEADER = "X-Profile"
+
+# frames per traceback tracemalloc records
+MEMORY_FRAMES = 25
+MEMORY_TOP = 50
+
+_memory_lock = threading.Lock()
+
+
+class Sampler:
+    """Samples one thread's stack until stopped."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler",
+                                        daemon=True)
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self._started
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({_short_path(code.co_filename)}"
+                             f":{code.co_firstlineno})".replace(";", ":"))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self.stacks.most_common())
+
+
+@lru_cache(maxsize=None)
+def _short_path(filename):
+    """The path from the nearest sys.path entry, as in a module name."""
+
+    for entry in sorted(sys.path, key=len, reverse=True):
+        if entry and filename.startswith(entry + os.sep):
+            return filename[len(entry) + 1:]
+    return filename
+
+
+def memory_report(request_line, snapshot, peak, elapsed):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    stats = snapshot.statistics("lineno")
+    total = sum(stat.size for stat in stats)
+
+    lines = [
+        request_line,
+        f"elapsed {elapsed * 1000:.1f}ms; still allocated {total / 1024:.1f} KiB "
+        f"in {sum(stat.count for stat in stats)} blocks; "
+        f"peak {peak / 1024:.1f} KiB",
+        "",
+        f"{'KiB':>10} {'blocks':>8}  line",
+    ]
+    for stat in stats[:MEMORY_TOP]:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size / 1024:>10.1f} {stat.count:>8}  "
+                     f"{_short_path(frame.filename)}:{frame.lineno}")
+    return "\n".join(lines) + "\n"
+
+
+#######################################
+# request hooks
+
+
+def _requested_kind():
+    kind = request.args.get(PARAM) or request.headers.get(HEADER)
+    if kind not in KINDS or not (g.get("user") and g.user.admin):
+        return None
+    return kind
+
+
+def _start_profile():
+    if PARAM not in request.args and HEADER not in request.headers:
+        return
+    kind = _requested_kind()
+    if kind == "cpu":
+        sampler = Sampler(threading.get_ident(),
+                          current_app.config["PROFILE_INTERVAL"])
+        sampler.start()
+        g.profile = ("cpu", sampler)
+    elif kind == "memory":
+        if not _memory_lock.acquire(blocking=False):
+            g.profile = ("busy", None)
+            return
+        tracemalloc.start(MEMORY_FRAMES)
+        g.profile = ("memory", time.perf_counter())
+
+
+def _attach_profile(response):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+
+    kind, state = profile
+    if kind == "busy":
+        response.headers[HEADER] = "busy: another memory profile is running"
+        return response
+
+    app = current_app._get_current_object()
+    name = (f"{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}-"
+            f"{request.endpoint or 'none'}-{kind}."
+            f"{'folded' if kind == 'cpu' else 'txt'}")
+    request_line = f"{request.method} {request.full_path.rstrip('?')}"
+
+    def finish():
+        if kind == "cpu":
+            state.stop()
+            content = state.folded()
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            _stop_memory()
+            content = memory_report(request_line, snapshot, peak,
+                                    time.perf_counter() - state)
+        save_profile(app, name, content)
+
+    response.call_on_close(finish)
+    response.headers[HEADER] = f"/admin/profiles/{name}"
+    return response
+
+
+def _abandon_profile(exc):
+    # after_request didn't run (the view raised): stop without saving
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    kind, state = profile
+    if kind == "cpu":
+        state.stop()
+    elif kind == "memory":
+        _stop_memory()
+
+
+def _stop_memory():
+    tracemalloc.stop()
+    _memory_lock.release()
+
+
+#######################################
+# storage and download
+
+
+def profile_dir(app):
+    return os.path.join(app.instance_path, app.config["PROFILE_DIR"])
+
+
+def save_profile(app, name, content):
+    directory = profile_dir(app)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), "w", encoding="utf8") as file:
+        file.write(content)
+
+    # keep only the latest PROFILE_KEEP
+    names = sorted(os.listdir(directory), reverse=True)
+    for old in names[app.config["PROFILE_KEEP"]:]:
+        try:
+            os.remove(os.path.join(directory, old))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles():
+    """Admin only. JSON list of stored profiles, newest first."""
+
+    if not g.user or not g.user.admin:
+        return jsonify({"error": "Access Denied"})
+
+    directory = profile_dir(current_app)
+    names = sorted(os.listdir(directory), reverse=True) if os.path.isdir(directory) else []
+    return jsonify({"profiles": [f"/admin/profiles/{name}" for name in names]})
+
+
+def download_profile(name):
+    """Admin only. One stored profile, as an attachment."""
+
+    if not g.user or not g.user.admin:
+        abort(404)
+    return send_from_directory(profile_dir(current_app), name, as_attachment=True,
+                               mimetype="text/plain")
+
+
+def init_profiling(app):
+    """Install the hooks. Call after the views are registered, so
+    g.user is set by the time they run."""
+
+    if not app.config["PROFILING"]:
+        return
+
+    app.before_request(_start_profile)
+    app.after_request(_attach_profile)
+    app.teardown_request(_abandon_profile)
+    app.add_url_rule("/admin/profiles", "list_profiles", list_profiles)
+    app.add_url_rule("/admin/profiles/<name>", "download_profile", download_profile)
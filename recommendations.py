@@ -0,0 +1,376 @@
+"""Related cafes: "people who liked this also liked".
+
+The likes table is a users x cafes matrix; two cafes are alike when the
+same people liked them. Similarity is the cosine
+
+    together(a, b) / sqrt(likes(a) * likes(b))
+
+and each cafe keeps its KEEP_NEIGHBORS best in cafe_neighbors, of which
+the cafe page shows a few.
+
+`flask build-recommendations` computes them all from scratch: with
+NumPy/SciPy as a sparse matrix product, a block of cafes at a time, or
+else in pure Python (fine for development data). From then on each like
+or unlike updates them, without a rebuild, once its transaction has
+committed: a background thread per process (NeighborUpdater) does it in
+a transaction of its own, so the like itself doesn't wait on the
+recount, which grows with the cafe's popularity:
+
+- every stored pair with the cafe is rescaled for its new like count
+  (whatever the other side, the cosine changes by the same factor);
+- the pairs with the user's other liked cafes are recounted and kept if
+  they make the top.
+
+Stored scores stay exact. What can go stale is which pairs are stored:
+one outside a cafe's top isn't tracked, so if the cafe's neighbours
+lose ground to it through likes elsewhere, it only gets in once a like
+touches it. Keeping more than we show hides most of that; rebuild now
+and then to clear it. Likes that skip the ORM session (deleting a user)
+aren't seen either, until the next rebuild, nor are changes still
+queued when a process exits, or beyond QUEUE_SIZE pending ones.
+"""
+
+import logging
+import math
+import os
+import queue
+import threading
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, func, insert, or_, select, tuple_, update
+from sqlalchemy.orm import aliased
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # pragma: no cover - optional
+    np = sparse = None
+
+from flask import current_app, has_app_context
+
+from models import db, changed_likes, upsert, Cafe, CafeNeighbor, Like
+
+logger = logging.getLogger(__name__)
+
+KEEP_NEIGHBORS = 20
+
+# committed transactions' like changes waiting for the updater; past
+# this they're dropped (and logged) until the next rebuild
+QUEUE_SIZE = 1000
+
+# the most of them the updater applies in one transaction
+UPDATE_BATCH = 100
+
+# cafes per sparse product; bounds memory to about this many rows of the
+# cafe x cafe co-occurrence matrix
+BLOCK_SIZE = 2000
+
+INSERT_BATCH = 10_000
+
+
+#######################################
+# building
+
+
+def _score(together, likes, other_likes):
+    return together / math.sqrt(likes * other_likes)
+
+
+def _best(neighbors, k):
+    """The k best (neighbor_id, together, score), best first."""
+
+    return sorted(neighbors, key=lambda n: (-n[2], n[0]))[:k]
+
+
+def compute_neighbors(user_ids, cafe_ids, k=KEEP_NEIGHBORS, block_size=BLOCK_SIZE):
+    """Yield (cafe_id, neighbor_id, together, score) for each cafe's k
+    best neighbours, from the likes `zip(user_ids, cafe_ids)`."""
+
+    if sparse is not None:
+        return _compute_sparse(np.asarray(user_ids), np.asarray(cafe_ids),
+                               k, block_size)
+    return _compute_python(user_ids, cafe_ids, k)
+
+
+def _compute_python(user_ids, cafe_ids, k):
+    by_user = {}
+    likes = {}
+    for user_id, cafe_id in zip(user_ids, cafe_ids):
+        by_user.setdefault(user_id, []).append(cafe_id)
+        likes[cafe_id] = likes.get(cafe_id, 0) + 1
+
+    together = {}
+    for cafes in by_user.values():
+        for cafe_id in cafes:
+            row = together.setdefault(cafe_id, {})
+            for other in cafes:
+                if other != cafe_id:
+                    row[other] = row.get(other, 0) + 1
+
+    for cafe_id in sorted(together):
+        neighbors = [(other, count, _score(count, likes[cafe_id], likes[other]))
+                     for other, count in together[cafe_id].items()]
+        for other, count, score in _best(neighbors, k):
+            yield cafe_id, other, count, score
+
+
+def _compute_sparse(user_ids, cafe_ids, k, block_size):
+    users, user_index = np.unique(user_ids, return_inverse=True)
+    cafes, cafe_index = np.unique(cafe_ids, return_inverse=True)
+    ones = np.ones(len(cafe_index), dtype=np.int32)
+
+    # users x cafes, and cafes x users to slice blocks of cafes from
+    by_user = sparse.csr_matrix((ones, (user_index, cafe_index)),
+                                shape=(len(users), len(cafes)))
+    by_cafe = by_user.T.tocsr()
+    del user_index, cafe_index, ones
+
+    likes = np.diff(by_cafe.indptr).astype(np.float64)
+
+    for start in range(0, len(cafes), block_size):
+        # block x cafes: how many users liked both
+        block = (by_cafe[start:start + block_size] @ by_user).tocsr()
+
+        for row in range(block.shape[0]):
+            cafe = start + row
+            span = slice(block.indptr[row], block.indptr[row + 1])
+            others, together = block.indices[span], block.data[span]
+            keep = others != cafe
+            others, together = others[keep], together[keep]
+            if not len(others):
+                continue
+
+            scores = together / np.sqrt(likes[cafe] * likes[others])
+            for i in np.lexsort((cafes[others], -scores))[:k]:
+                yield (int(cafes[cafe]), int(cafes[others[i]]),
+                       int(together[i]), float(scores[i]))
+
+
+def _load_likes(conn):
+    """Every like as (user_ids, cafe_ids), as arrays if NumPy is here."""
+
+    result = conn.execution_options(stream_results=True).execute(
+        select(Like.user_id, Like.cafe_id))
+
+    if np is None:
+        rows = result.all()
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    parts = [np.array(rows, dtype=np.int64).reshape(-1, 2)
+             for rows in result.partitions(100_000)]
+    likes = np.concatenate(parts) if parts else np.empty((0, 2), dtype=np.int64)
+    return likes[:, 0], likes[:, 1]
+
+
+def build_neighbors(conn, k=KEEP_NEIGHBORS, block_size=BLOCK_SIZE):
+    """Replace every cafe's neighbours with freshly computed ones; return
+    how many pairs were stored."""
+
+    user_ids, cafe_ids = _load_likes(conn)
+    conn.execute(delete(CafeNeighbor))
+
+    count = 0
+    batch = []
+    for cafe_id, neighbor_id, together, score in compute_neighbors(
+            user_ids, cafe_ids, k, block_size):
+        batch.append({"cafe_id": cafe_id, "neighbor_id": neighbor_id,
+                      "together": together, "score": score})
+        if len(batch) == INSERT_BATCH:
+            conn.execute(insert(CafeNeighbor), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.execute(insert(CafeNeighbor), batch)
+        count += len(batch)
+
+    return count
+
+
+#######################################
+# keeping up with likes
+
+
+def apply_like_changes(conn, changes):
+    """Update neighbours for `changes`, (user_id, cafe_id, +1 or -1) for
+    likes already written through `conn`."""
+
+    deltas = {}
+    for _, cafe_id, delta in changes:
+        deltas[cafe_id] = deltas.get(cafe_id, 0) + delta
+
+    users = {user_id for user_id, _, _ in changes}
+    liked = {}
+    for user_id, cafe_id in conn.execute(
+            select(Like.user_id, Like.cafe_id).where(Like.user_id.in_(users))):
+        liked.setdefault(user_id, set()).add(cafe_id)
+
+    # the pairs each change makes or breaks
+    pairs = {(cafe_id, other)
+             for user_id, cafe_id, _ in changes
+             for other in liked.get(user_id, ()) if other != cafe_id}
+    cafes = set(deltas) | {other for _, other in pairs}
+
+    likes = dict(conn.execute(
+        select(Like.cafe_id, func.count())
+        .where(Like.cafe_id.in_(cafes))
+        .group_by(Like.cafe_id)).all())
+
+    for cafe_id, delta in deltas.items():
+        if not delta:
+            continue
+        new, old = likes.get(cafe_id, 0), likes.get(cafe_id, 0) - delta
+        touching = or_(CafeNeighbor.cafe_id == cafe_id,
+                       CafeNeighbor.neighbor_id == cafe_id)
+        if not new:
+            conn.execute(delete(CafeNeighbor).where(touching))
+        elif old:
+            conn.execute(update(CafeNeighbor).where(touching).values(
+                score=CafeNeighbor.score * math.sqrt(old / new)))
+
+    if not pairs:
+        return
+
+    mine, theirs = aliased(Like), aliased(Like)
+    together = {
+        (cafe_id, other): count
+        for cafe_id, other, count in conn.execute(
+            select(mine.cafe_id, theirs.cafe_id, func.count())
+            .join(theirs, theirs.user_id == mine.user_id)
+            .where(mine.cafe_id.in_({cafe_id for cafe_id, _ in pairs}),
+                   theirs.cafe_id.in_({other for _, other in pairs}))
+            .group_by(mine.cafe_id, theirs.cafe_id))
+    }
+
+    # both ways round, once each (an upsert can't touch a row twice)
+    rows, gone = {}, set()
+    for cafe_id, other in pairs:
+        count = together.get((cafe_id, other), 0)
+        for key in ((cafe_id, other), (other, cafe_id)):
+            if count:
+                rows[key] = {"cafe_id": key[0], "neighbor_id": key[1],
+                             "together": count,
+                             "score": _score(count, likes[cafe_id], likes[other])}
+            else:
+                gone.add(key)
+
+    if gone:
+        conn.execute(delete(CafeNeighbor).where(
+            tuple_(CafeNeighbor.cafe_id, CafeNeighbor.neighbor_id).in_(gone)))
+    if rows:
+        upsert(conn, CafeNeighbor, list(rows.values()))
+        _trim(conn, cafes)
+
+
+def _trim(conn, cafes):
+    """Drop all but the KEEP_NEIGHBORS best neighbours of `cafes`."""
+
+    ranked = (
+        select(CafeNeighbor.cafe_id, CafeNeighbor.neighbor_id,
+               func.row_number().over(
+                   partition_by=CafeNeighbor.cafe_id,
+                   order_by=(CafeNeighbor.score.desc(), CafeNeighbor.neighbor_id),
+               ).label("rank"))
+        .where(CafeNeighbor.cafe_id.in_(cafes))
+        .subquery()
+    )
+    conn.execute(delete(CafeNeighbor).where(
+        tuple_(CafeNeighbor.cafe_id, CafeNeighbor.neighbor_id).in_(
+            select(ranked.c.cafe_id, ranked.c.neighbor_id)
+            .where(ranked.c.rank > KEEP_NEIGHBORS))))
+
+
+class NeighborUpdater:
+    """The thread applying one app's committed like changes."""
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def submit(self, changes):
+        with self._lock:
+            # a thread doesn't survive a fork; start one per process
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(QUEUE_SIZE)
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,),
+                                 name="related-cafes", daemon=True).start()
+        try:
+            self._queue.put_nowait(changes)
+        except queue.Full:
+            logger.warning("related cafes: too many pending updates; dropped "
+                           "%s like changes until the next rebuild", len(changes))
+
+    def wait(self):
+        """Block until every change submitted so far is applied."""
+
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def _run(self, pending):
+        while True:
+            batch = [pending.get()]
+            while len(batch) < UPDATE_BATCH:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with self.app.app_context(), db.engine.begin() as conn:
+                    apply_like_changes(conn, [change for changes in batch
+                                              for change in changes])
+            except Exception:
+                logger.exception("related cafes: update failed; rebuild to "
+                                 "catch up")
+            finally:
+                for _ in batch:
+                    pending.task_done()
+
+
+@event.listens_for(db.session, "after_flush")
+def _note_neighbor_changes(session, flush_context):
+    session.info.setdefault("neighbor_changes", []).extend(
+        (user_id, cafe_id, delta)
+        for user_id, cafe_id, delta, _ in changed_likes(session))
+
+    # a deleted cafe's pairs go with it, in the same transaction
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Cafe)]
+    if deleted:
+        session.connection().execute(delete(CafeNeighbor).where(or_(
+            CafeNeighbor.cafe_id.in_(deleted),
+            CafeNeighbor.neighbor_id.in_(deleted))))
+
+
+@event.listens_for(db.session, "after_commit")
+def _submit_neighbor_changes(session):
+    changes = session.info.pop("neighbor_changes", None)
+    if not changes or not has_app_context():
+        return
+
+    updater = current_app.extensions.get("recommendations")
+    if updater is not None:
+        updater.submit(changes)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_neighbor_changes(session):
+    session.info.pop("neighbor_changes", None)
+
+
+@click.command("build-recommendations")
+@with_appcontext
+def build_recommendations_command():
+    """Recompute every cafe's related cafes from the likes."""
+
+    with db.engine.begin() as conn:
+        count = build_neighbors(conn)
+    click.echo(f"Stored {count} related-cafe pairs"
+               f"{'' if sparse is not None else ' (without NumPy/SciPy)'}.")
+
+
+def init_recommendations(app):
+    app.extensions["recommendations"] = NeighborUpdater(app)
+    app.cli.add_command(build_recommendations_command)
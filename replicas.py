@@ -0,0 +1,176 @@
+"""Read-replica routing for Flask Cafe.
+
+Replica URLs go in `SQLALCHEMY_REPLICA_URIS`; each becomes a bind named
+`replica0`, `replica1`, ... Views marked `@read_only` send their SELECTs
+to a replica, unless:
+
+- this request has already written (the session has flushed), or
+- this client wrote within the last `REPLICA_STICKY_SECONDS`, so a like
+  followed by a redirect still reads its own write from the primary, or
+- every replica is lagging more than `REPLICA_MAX_LAG` seconds.
+"""
+
+import itertools
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.sql import Select
+
+
+PRIMARY_UNTIL_KEY = "_primary_until"
+
+# set on the request (not g) so streamed responses keep reading replicas
+READ_ONLY_KEY = "flask_cafe.read_only"
+
+
+class RoutingSession(Session):
+    """Session that sends read-only SELECTs to a healthy replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and isinstance(clause, Select) and self._reads_from_replica():
+            replica_set = current_app.extensions.get("replicas")
+            engine = replica_set and replica_set.pick(self._db.engines)
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_from_replica(self):
+        return (has_request_context() and
+                request.environ.get(READ_ONLY_KEY, False) and
+                not self._flushing and
+                not self.info.get("wrote"))
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _mark_wrote(session, flush_context):
+    session.info["wrote"] = True
+
+
+class ReplicaSet:
+    """The replica binds of one app, with cached lag checks."""
+
+    def __init__(self, keys, max_lag, lag_check_interval):
+        self.keys = keys
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.lags = {}
+        self._checked_at = {}
+        self._next = itertools.cycle(keys)
+        self._lock = threading.Lock()
+
+    def pick(self, engines):
+        """Round-robin over replicas not lagging too far; None if none are."""
+
+        for _ in self.keys:
+            with self._lock:
+                key = next(self._next)
+            if self.lag(key, engines[key]) <= self.max_lag:
+                return engines[key]
+
+        return None
+
+    def lag(self, key, engine):
+        """Replica lag in seconds, re-checked every `lag_check_interval`.
+
+        An unreachable replica counts as infinitely far behind.
+        """
+
+        now = time.monotonic()
+        if now - self._checked_at.get(key, -self.lag_check_interval) >= self.lag_check_interval:
+            self._checked_at[key] = now
+            try:
+                self.lags[key] = replica_lag(engine)
+            except Exception:
+                self.lags[key] = float("inf")
+
+        return self.lags[key]
+
+
+def replica_lag(engine):
+    """Seconds this replica is behind its primary (0 for non-Postgres
+    stand-ins, or a Postgres server that isn't replaying WAL)."""
+
+    if engine.dialect.name != "postgresql":
+        return 0.0
+
+    with engine.connect() as conn:
+        lag = conn.execute(text(
+            "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+        )).scalar()
+
+    return float(lag or 0.0)
+
+
+def configure_replicas(app):
+    """Add a bind per replica URI. Call before `db.init_app`."""
+
+    uris = app.config.get("SQLALCHEMY_REPLICA_URIS") or []
+    if not uris:
+        return
+
+    binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+    keys = []
+    for i, uri in enumerate(uris):
+        key = f"replica{i}"
+        binds[key] = uri
+        keys.append(key)
+
+    app.extensions["replicas"] = ReplicaSet(
+        keys,
+        max_lag=app.config.get("REPLICA_MAX_LAG", 5),
+        lag_check_interval=app.config.get("REPLICA_LAG_CHECK_INTERVAL", 1),
+    )
+    app.after_request(_stick_to_primary_after_write)
+
+
+def _stick_to_primary_after_write(response):
+    """After a write, pin this client's reads to the primary for a while."""
+
+    db = current_app.extensions["sqlalchemy"]
+
+    if db.session.info.pop("wrote", False):
+        session[PRIMARY_UNTIL_KEY] = (
+            time.time() + current_app.config.get("REPLICA_STICKY_SECONDS", 5))
+
+    return response
+
+
+def read_only(view):
+    """Route this view's reads to a replica, for clients that haven't
+    written recently."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if session.get(PRIMARY_UNTIL_KEY, 0) < time.time():
+            if PRIMARY_UNTIL_KEY in session:
+                del session[PRIMARY_UNTIL_KEY]
+            request.environ[READ_ONLY_KEY] = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def pool_stats():
+    """Pool usage and replica lag for every bind of the current app."""
+
+    db = current_app.extensions["sqlalchemy"]
+    replica_set = current_app.extensions.get("replicas")
+    stats = {}
+
+    for key, engine in db.engines.items():
+        pool = engine.pool
+        name = key or "primary"
+        stats[name] = {
+            "status": pool.status(),
+            "checked_out": getattr(pool, "checkedout", lambda: None)(),
+            "size": getattr(pool, "size", lambda: None)(),
+        }
+        if replica_set and key in replica_set.lags:
+            stats[name]["lag"] = replica_set.lags[key]
+
+    return stats
@@ -0,0 +1,219 @@
+"""Capture of individual slow SQL statements, with their plans.
+
+/metrics says how much time each endpoint spends in SQL; this says which
+statements. Every statement taking longer than SLOW_QUERY_THRESHOLD
+seconds, on any bind, is recorded with
+
+- the endpoint and URL rule it ran under (or none, outside a request),
+- its parameters, redacted: numbers, booleans and None are kept (they
+  decide plans), anything else becomes a placeholder like "<str:12>",
+- its plan, captured afterwards on a background thread, so the request
+  that hit it doesn't wait: `EXPLAIN (ANALYZE, BUFFERS)` for SELECTs on
+  Postgres (which runs the query again, in a rolled-back transaction
+  with a SLOW_QUERY_EXPLAIN_TIMEOUT statement timeout), a plain EXPLAIN
+  for anything that writes, and EXPLAIN QUERY PLAN on SQLite. The same
+  statement is explained at most once per SLOW_QUERY_EXPLAIN_INTERVAL;
+  records in between reuse that plan.
+
+Records are kept in a ring buffer of the latest SLOW_QUERY_BUFFER per
+process, which admins read as JSON at /admin/slow-queries (from
+whichever worker serves the request). The real parameters are only
+held until the EXPLAIN runs, never stored.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from flask import current_app, g, has_request_context, jsonify, request
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# pending EXPLAINs beyond this are dropped
+QUEUE_SIZE = 100
+
+# statements whose last plan is remembered; past this they're forgotten
+MAX_PLANS = 1000
+
+MAX_STATEMENT = 10_000
+
+
+def redact(parameters):
+    """`parameters` with only the values that are safe to keep."""
+
+    if isinstance(parameters, dict):
+        return {key: _redact_value(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_redact_value(value) for value in parameters]
+    return _redact_value(parameters)
+
+
+def _redact_value(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__}:{len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def explain(engine, statement, parameters, timeout):
+    """The plan of `statement` as text, or None for a dialect we don't
+    explain."""
+
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        reads = statement.lstrip()[:6].upper() == "SELECT" and \
+            "FOR UPDATE" not in statement.upper()
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if reads else "EXPLAIN "
+    elif dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        return None
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if dialect == "postgresql":
+            cursor.execute(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        # ANALYZE ran the statement; keep nothing it did
+        conn.rollback()
+        conn.close()
+
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+class SlowQueryLog:
+    """The latest slow statements of one app, and the thread explaining
+    them."""
+
+    def __init__(self, threshold, size, explain=True, explain_interval=60,
+                 explain_timeout=5):
+        self.threshold = threshold
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.explain_timeout = explain_timeout
+        self.records = deque(maxlen=size)
+        # statement -> (when explained, plan)
+        self.plans = {}
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def record(self, engine, statement, parameters, duration, executemany):
+        entry = {
+            "at": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "duration_ms": round(duration * 1000, 2),
+            "endpoint": None,
+            "rule": None,
+            "statement": statement[:MAX_STATEMENT],
+            "parameters": redact(parameters) if not executemany else
+                          f"<{len(parameters)} parameter sets>",
+            "plan": None,
+        }
+        if has_request_context():
+            entry["endpoint"] = request.endpoint
+            entry["rule"] = request.url_rule.rule if request.url_rule else request.path
+
+        with self._lock:
+            self.records.append(entry)
+            explained = self.plans.get(statement)
+        if explained and time.monotonic() - explained[0] < self.explain_interval:
+            entry["plan"] = explained[1]
+        elif self.explain and not executemany:
+            self._submit(engine, statement, parameters, entry)
+
+    def snapshot(self):
+        """The records, newest first."""
+
+        with self._lock:
+            return [dict(entry) for entry in reversed(self.records)]
+
+    def _submit(self, engine, statement, parameters, entry):
+        with self._lock:
+            # a thread doesn't survive a fork; start one per process
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(QUEUE_SIZE)
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,),
+                                 name="slow-query-explain", daemon=True).start()
+            # stop a burst of the same statement from queueing more
+            if len(self.plans) >= MAX_PLANS:
+                self.plans.clear()
+            self.plans[statement] = (time.monotonic(), None)
+        try:
+            self._queue.put_nowait((engine, statement, parameters, entry))
+        except queue.Full:
+            with self._lock:
+                self.plans.pop(statement, None)
+            entry["plan"] = "(not explained: too many pending)"
+
+    def _run(self, pending):
+        while True:
+            engine, statement, parameters, entry = pending.get()
+            try:
+                plan = explain(engine, statement, parameters, self.explain_timeout)
+            except Exception as e:
+                logger.info("couldn't explain a slow query: %s", e)
+                plan = f"(EXPLAIN failed: {e})"
+            with self._lock:
+                entry["plan"] = plan
+                self.plans[statement] = (time.monotonic(), plan)
+                for other in self.records:
+                    if other["statement"] == statement and other["plan"] is None:
+                        other["plan"] = plan
+
+
+#######################################
+# hooks
+
+
+def _watch(engine, log):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["slow_query_start"].pop()
+        if duration >= log.threshold:
+            log.record(engine, statement, parameters, duration, executemany)
+
+
+def show_slow_queries():
+    """Admin only. JSON of this process's latest slow statements, newest
+    first."""
+
+    if not g.user or not g.user.admin:
+        return jsonify({"error": "Access Denied"})
+
+    log = current_app.extensions["slow_queries"]
+    return jsonify({"threshold_ms": log.threshold * 1000,
+                    "pid": os.getpid(),
+                    "queries": log.snapshot()})
+
+
+def init_slow_queries(app):
+    if not app.config["SLOW_QUERIES"]:
+        return
+
+    log = app.extensions["slow_queries"] = SlowQueryLog(
+        app.config["SLOW_QUERY_THRESHOLD"],
+        app.config["SLOW_QUERY_BUFFER"],
+        app.config["SLOW_QUERY_EXPLAIN"],
+        app.config["SLOW_QUERY_EXPLAIN_INTERVAL"],
+        app.config["SLOW_QUERY_EXPLAIN_TIMEOUT"],
+    )
+    with app.app_context():
+        for engine in db.engines.values():
+            _watch(engine, log)
+    app.add_url_rule("/admin/slow-queries", "slow_queries", show_slow_queries)
@@ -0,0 +1,33 @@
+"use strict";
+const $cafeSearch = $("#cafe-search");
+const $cafeSuggestions = $("#cafe-suggestions");
+
+let suggestTimer = null;
+
+
+async function showSuggestions() {
+  const prefix = $cafeSearch.val().trim();
+  if(!prefix) {
+    $cafeSuggestions.empty();
+    return;
+  }
+
+  const params = new URLSearchParams({"prefix" : prefix});
+  const response = await fetch(`/api/cafes/suggest?${params}`);
+  const suggestions = await response.json();
+
+  // a later keystroke may have changed the box while this was in flight
+  if($cafeSearch.val().trim() !== prefix) return;
+
+  $cafeSuggestions.empty();
+  for(const cafe of suggestions.cafes) {
+    $cafeSuggestions.append($("<option>").val(cafe.name).text(cafe.city));
+  }
+}
+
+function suggestSoon() {
+  clearTimeout(suggestTimer);
+  suggestTimer = setTimeout(showSuggestions, 100);
+}
+
+$cafeSearch.on("input", suggestSoon)
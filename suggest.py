@@ -0,0 +1,342 @@
+"""Type-ahead suggestions for the cafe search box, from memory.
+
+    GET /api/cafes/suggest?prefix=blu
+
+returns the most liked cafes, and the cities with the most liked cafes,
+with a word starting with the prefix:
+
+    {"cafes": [{"id": 3, "name": "Blue Perch", "city": "Oakland, CA"}],
+     "cities": [{"code": "oak", "name": "Oakland", "state": "CA"}]}
+
+Each process keeps a PrefixIndex of cafe names and one of city names:
+every word of a name starts a key, so "perch" finds "Blue Perch". The
+keys sit in one sorted list and a prefix is the range bisect finds in
+it. When that range is too big to rank (a letter or two typed), the
+entries are walked in popularity order instead, until enough of them
+match; either way it's well under a millisecond.
+
+The index is loaded on first use (or by warm_up) and kept current from
+the session: cafes added, renamed, moved or deleted, and likes, change
+it when their transaction commits. Bulk inserts and updates (the
+importer) mark it for a reload on next use instead. Other processes'
+cafes, added, changed or deleted, arrive over the invalidation bus (a
+bulk insert as the whole table, so a reload); their likes don't, so
+rankings there can trail until the next reload.
+"""
+
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from heapq import nsmallest
+
+from flask import current_app, has_app_context, jsonify, request
+from sqlalchemy import event, func, inspect, select
+
+from invalidation import invalidated
+from models import db, changed_likes, city_registry, Cafe, City, Like
+
+# keys are cut to this many characters; longer prefixes are checked
+# against the whole name
+KEY_LENGTH = 24
+
+# ranges longer than this are answered from the popularity order
+SCAN_LIMIT = 2000
+
+LIMIT = 8
+MAX_LIMIT = 20
+
+
+def normalize(text):
+    """'Café  Noir!' -> 'cafe noir': lowercase words without accents."""
+
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c if c.isalnum() else " " for c in text
+                   if not unicodedata.combining(c))
+    return " ".join(text.lower().split())
+
+
+def word_keys(name):
+    """Every key for `name`: from the start of each word on."""
+
+    words = name.split(" ")
+    return {" ".join(words[i:])[:KEY_LENGTH] for i in range(len(words))}
+
+
+class PrefixIndex:
+    """Names by id, found by a prefix of any word, most popular first.
+    Not thread-safe; SuggestIndex locks around it."""
+
+    def __init__(self, entries=()):
+        """`entries`: (id, name, score)"""
+
+        self.names = {}
+        self.scores = {}
+        keys = []
+        for id, name, score in entries:
+            self.names[id] = normalize(name)
+            self.scores[id] = score
+            keys.extend((key, id) for key in word_keys(self.names[id]))
+
+        keys.sort()
+        self.keys = [key for key, _ in keys]
+        self.ids = [id for _, id in keys]
+        self.ranked = sorted(self._rank(id) for id in self.names)
+
+    def _rank(self, id):
+        return (-self.scores[id], self.names[id], id)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, id, name, score=0):
+        if id in self.names:
+            self.remove(id)
+        self.names[id] = normalize(name)
+        self.scores[id] = score
+        for key in word_keys(self.names[id]):
+            i = bisect_left(self.keys, key)
+            self.keys.insert(i, key)
+            self.ids.insert(i, id)
+        insort(self.ranked, self._rank(id))
+
+    def remove(self, id):
+        if id not in self.names:
+            return
+        for key in word_keys(self.names[id]):
+            i = bisect_left(self.keys, key)
+            while self.ids[i] != id:
+                i += 1
+            del self.keys[i], self.ids[i]
+        del self.ranked[bisect_left(self.ranked, self._rank(id))]
+        del self.names[id], self.scores[id]
+
+    def add_score(self, id, delta):
+        if id not in self.names:
+            return
+        del self.ranked[bisect_left(self.ranked, self._rank(id))]
+        self.scores[id] += delta
+        insort(self.ranked, self._rank(id))
+
+    def matches(self, id, prefix):
+        name = self.names[id]
+        return name.startswith(prefix) or f" {prefix}" in name
+
+    def top(self, prefix, limit):
+        """Ids of the `limit` most popular names with a word starting
+        with normalized `prefix`."""
+
+        key = prefix[:KEY_LENGTH]
+        lo = bisect_left(self.keys, key)
+        hi = bisect_left(self.keys, key + "\uffff", lo)
+
+        if hi - lo > SCAN_LIMIT:
+            found = []
+            for _, _, id in self.ranked:
+                if self.matches(id, prefix):
+                    found.append(id)
+                    if len(found) == limit:
+                        break
+            return found
+
+        ids = set(self.ids[lo:hi])
+        if len(prefix) > KEY_LENGTH:
+            ids = {id for id in ids if self.matches(id, prefix)}
+        return [rank[2] for rank in nsmallest(limit, map(self._rank, ids))]
+
+
+class SuggestIndex:
+    """Cafe and city names of one app, with their likes."""
+
+    def __init__(self):
+        self.cafes = PrefixIndex()
+        self.cities = PrefixIndex()
+        # cafe id -> (display name, city code)
+        self.cafe_info = {}
+        self.stale = True
+        self._lock = threading.Lock()
+
+    def load(self):
+        """(Re)build from the database. Needs an app context."""
+
+        with db.engine.connect() as conn:
+            rows = conn.execute(_cafes_with_likes()).all()
+
+        city_likes = {}
+        for _, _, city_code, count in rows:
+            city_likes[city_code] = city_likes.get(city_code, 0) + count
+
+        cafes = PrefixIndex((id, name, count) for id, name, _, count in rows)
+        cities = PrefixIndex((code, name, city_likes.get(code, 0))
+                             for code, name in city_registry.choices)
+
+        with self._lock:
+            self.cafes, self.cities = cafes, cities
+            self.cafe_info = {id: (name, city_code) for id, name, city_code, _ in rows}
+            self.stale = False
+
+    def refresh_cafes(self, ids):
+        """Reread cafes `ids`, and their likes, from the database."""
+
+        with db.engine.connect() as conn:
+            rows = conn.execute(_cafes_with_likes().where(Cafe.id.in_(ids))).all()
+
+        for id in set(ids) - {row[0] for row in rows}:
+            self.remove_cafe(id)
+        for id, name, city_code, count in rows:
+            self.put_cafe(id, name, city_code)
+            self.add_likes(id, count - self.cafes.scores[id])
+
+    def suggest(self, prefix, limit=LIMIT):
+        if self.stale:
+            self.load()
+
+        prefix = normalize(prefix)
+        if not prefix:
+            return {"cafes": [], "cities": []}
+
+        with self._lock:
+            cafes = [(id, *self.cafe_info[id]) for id in self.cafes.top(prefix, limit)]
+            city_codes = self.cities.top(prefix, limit)
+
+        return {
+            "cafes": [{"id": id, "name": name, "city": _city_state(city_code)}
+                      for id, name, city_code in cafes],
+            "cities": [{"code": city.code, "name": city.name, "state": city.state}
+                       for city in map(city_registry.get, city_codes) if city],
+        }
+
+    def put_cafe(self, id, name, city_code):
+        """Add cafe `id`, or update its name and city."""
+
+        with self._lock:
+            likes = self.cafes.scores.get(id, 0)
+            old = self.cafe_info.get(id)
+            if old and old[1] != city_code:
+                self.cities.add_score(old[1], -likes)
+                self.cities.add_score(city_code, likes)
+            self.cafes.add(id, name, likes)
+            self.cafe_info[id] = (name, city_code)
+
+    def remove_cafe(self, id):
+        with self._lock:
+            info = self.cafe_info.pop(id, None)
+            if info:
+                self.cities.add_score(info[1], -self.cafes.scores[id])
+                self.cafes.remove(id)
+
+    def add_likes(self, id, delta):
+        with self._lock:
+            info = self.cafe_info.get(id)
+            if info:
+                self.cafes.add_score(id, delta)
+                self.cities.add_score(info[1], delta)
+
+
+def _cafes_with_likes():
+    likes = (select(Like.cafe_id, func.count().label("likes"))
+             .group_by(Like.cafe_id).subquery())
+    return (select(Cafe.id, Cafe.name, Cafe.city_code,
+                   func.coalesce(likes.c.likes, 0))
+            .outerjoin(likes, likes.c.cafe_id == Cafe.id))
+
+
+def _city_state(city_code):
+    city = city_registry.get(city_code)
+    return f"{city.name}, {city.state}" if city else ""
+
+
+#######################################
+# keeping up with commits
+
+
+@event.listens_for(db.session, "after_flush")
+def _note_suggest_changes(session, flush_context):
+    changes = session.info.setdefault("suggest_changes", [])
+    for obj in session.new:
+        if isinstance(obj, Cafe):
+            changes.append(("put", obj.id, obj.name, obj.city_code))
+    for obj in session.dirty:
+        if isinstance(obj, Cafe) and (
+                inspect(obj).attrs.name.history.has_changes() or
+                inspect(obj).attrs.city_code.history.has_changes()):
+            changes.append(("put", obj.id, obj.name, obj.city_code))
+    changes.extend(("remove", obj.id) for obj in session.deleted
+                   if isinstance(obj, Cafe))
+    changes.extend(("likes", cafe_id, delta)
+                   for _, cafe_id, delta, _ in changed_likes(session))
+
+    if any(isinstance(obj, City)
+           for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info["suggest_reload"] = True
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _note_suggest_bulk_changes(orm_execute_state):
+    if orm_execute_state.is_select:
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ in (Cafe, City, Like):
+        orm_execute_state.session.info["suggest_reload"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def _apply_suggest_changes(session):
+    changes = session.info.pop("suggest_changes", None)
+    reload = session.info.pop("suggest_reload", False)
+    if not (changes or reload) or not has_app_context():
+        return
+
+    index = current_app.extensions.get("suggest")
+    if index is None or index.stale:
+        return
+    if reload:
+        index.stale = True
+        return
+
+    for change in changes:
+        if change[0] == "put":
+            index.put_cafe(*change[1:])
+        elif change[0] == "remove":
+            index.remove_cafe(change[1])
+        else:
+            index.add_likes(*change[1:])
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_suggest_changes(session):
+    session.info.pop("suggest_changes", None)
+    session.info.pop("suggest_reload", None)
+
+
+def _on_invalidated(app, keys, tables):
+    # another process committed these
+    index = app.extensions.get("suggest")
+    if index is None or index.stale:
+        return
+    if {"cafes", "cities"} & set(tables) or any(
+            key.startswith("cities:") for key in keys):
+        index.stale = True
+        return
+
+    ids = [int(key.split(":")[1]) for key in keys if key.startswith("cafes:")]
+    if ids:
+        with app.app_context():
+            index.refresh_cafes(ids)
+
+
+def suggest_cafes():
+    """Type-ahead for the cafe search: JSON of the most liked cafes and
+    cities with a word starting with ?prefix=."""
+
+    prefix = request.args.get("prefix", "")
+    limit = max(1, min(request.args.get("limit", LIMIT, type=int), MAX_LIMIT))
+
+    response = jsonify(current_app.extensions["suggest"].suggest(prefix, limit))
+    response.headers["Cache-Control"] = "public, max-age=60"
+    return response
+
+
+def init_suggest(app):
+    app.extensions["suggest"] = SuggestIndex()
+    invalidated.connect(_on_invalidated, app)
+    app.add_url_rule("/api/cafes/suggest", "suggest_cafes", suggest_cafes)
@@ -0,0 +1,176 @@
+"""Per-city homepage summaries: cafe count, total likes, top cafes.
+
+They live in the city_summaries table, so the homepage reads them all
+with one query instead of aggregating cafes and likes on every hit.
+
+They're kept current in the same transaction as the change:
+
+- a like or unlike adjusts its city's row in place (its count, and the
+  top cafes when this cafe is or becomes one of them);
+- adding, deleting, renaming or moving a cafe, or adding a city,
+  recomputes the affected cities from scratch.
+
+Changes that skip the ORM session (bulk UPDATE/DELETE, ON DELETE
+CASCADE) aren't seen; `flask refresh-summaries`, run
+on a schedule, recomputes every city. Rows are upserted, so readers
+keep seeing the old ones until it commits.
+"""
+
+import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, inspect, select, true
+
+from models import db, changed_likes, upsert, City, Cafe, Like, CitySummary
+
+TOP_CAFES = 3
+
+
+def _top_key(cafe):
+    return (-cafe["likes"], cafe["name"])
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def refresh_city_summaries(conn, codes=None):
+    """Recompute the summaries of cities `codes` (default: every city)."""
+
+    where = Cafe.city_code.in_(codes) if codes is not None else true()
+    rows = conn.execute(
+        select(Cafe.city_code, Cafe.id, Cafe.name,
+               func.count(Like.user_id).label("likes"))
+        .outerjoin(Like, Like.cafe_id == Cafe.id)
+        .where(where)
+        .group_by(Cafe.id)
+    ).all()
+
+    if codes is None:
+        codes = conn.execute(select(City.code)).scalars().all()
+
+    now = _now()
+    summaries = {code: {"city_code": code, "cafe_count": 0, "like_count": 0,
+                        "top_cafes": [], "updated_at": now}
+                 for code in codes}
+
+    for row in rows:
+        summary = summaries[row.city_code]
+        summary["cafe_count"] += 1
+        summary["like_count"] += row.likes
+        if row.likes:
+            summary["top_cafes"].append(
+                {"id": row.id, "name": row.name, "likes": row.likes})
+
+    for summary in summaries.values():
+        summary["top_cafes"] = sorted(summary["top_cafes"], key=_top_key)[:TOP_CAFES]
+
+    if summaries:
+        upsert(conn, CitySummary, list(summaries.values()))
+
+
+def apply_like_change(conn, cafe_id, name, city_code, delta):
+    """Adjust a city's summary for `delta` likes on a cafe; return False
+    if only a full recompute of the city will do."""
+
+    summary = conn.execute(
+        select(CitySummary.top_cafes)
+        .where(CitySummary.city_code == city_code)
+        .with_for_update()
+    ).first()
+    if summary is None:
+        return False
+
+    top = list(summary.top_cafes)
+    entry = next((cafe for cafe in top if cafe["id"] == cafe_id), None)
+
+    if entry is None and delta < 0:
+        # a cafe outside the top losing likes can't enter it
+        top = None
+    elif entry is not None and delta < 0 and len(top) == TOP_CAFES:
+        # it may have dropped below a cafe we don't keep track of
+        return False
+    else:
+        likes = conn.execute(
+            select(func.count()).select_from(Like).where(Like.cafe_id == cafe_id)
+        ).scalar()
+        top = [cafe for cafe in top if cafe["id"] != cafe_id]
+        if likes:
+            top.append({"id": cafe_id, "name": name, "likes": likes})
+        top = sorted(top, key=_top_key)[:TOP_CAFES]
+
+    values = {"like_count": CitySummary.like_count + delta, "updated_at": _now()}
+    if top is not None:
+        values["top_cafes"] = top
+    conn.execute(CitySummary.__table__.update()
+                 .where(CitySummary.city_code == city_code)
+                 .values(**values))
+    return True
+
+
+@event.listens_for(Cafe.city_code, "set", active_history=True)
+def _load_old_city(target, value, oldvalue, initiator):
+    """A cafe moving city changes both cities' summaries; this has its
+    history keep the old one even when it wasn't loaded yet."""
+
+
+@event.listens_for(db.session, "after_flush")
+def _update_summaries(session, flush_context):
+    recompute = set()
+    # cafe id -> net change in likes; cafe id -> (name, city code)
+    likes, cafes = {}, {}
+
+    for _, cafe_id, delta, cafe in changed_likes(session):
+        likes[cafe_id] = likes.get(cafe_id, 0) + delta
+        if cafe is not None:
+            cafes[cafe_id] = (cafe.name, cafe.city_code)
+
+    for obj in (*session.new, *session.deleted):
+        if isinstance(obj, Cafe):
+            recompute.add(obj.city_code)
+        elif isinstance(obj, City) and obj in session.new:
+            recompute.add(obj.code)
+
+    for obj in session.dirty:
+        if isinstance(obj, Cafe):
+            state = inspect(obj)
+            city = state.attrs.city_code.history
+            if city.has_changes():
+                recompute.update(code for code in (*city.added, *city.deleted) if code)
+            if state.attrs.name.history.has_changes():
+                recompute.add(obj.city_code)
+
+    likes = {cafe_id: delta for cafe_id, delta in likes.items() if delta}
+    if not recompute and not likes:
+        return
+
+    conn = session.connection()
+
+    missing = [cafe_id for cafe_id in likes if cafe_id not in cafes]
+    if missing:
+        for cafe in conn.execute(select(Cafe.id, Cafe.name, Cafe.city_code)
+                                 .where(Cafe.id.in_(missing))):
+            cafes[cafe.id] = (cafe.name, cafe.city_code)
+
+    for cafe_id, delta in likes.items():
+        if cafe_id not in cafes:
+            continue
+        name, city_code = cafes[cafe_id]
+        if city_code in recompute:
+            continue
+        if not apply_like_change(conn, cafe_id, name, city_code, delta):
+            recompute.add(city_code)
+
+    if recompute:
+        refresh_city_summaries(conn, sorted(recompute))
+
+
+@click.command("refresh-summaries")
+@with_appcontext
+def refresh_summaries_command():
+    """Recompute every city's homepage summary (run on a schedule)."""
+
+    with db.engine.begin() as conn:
+        refresh_city_summaries(conn)
+    click.echo("Refreshed city summaries.")
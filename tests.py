@@ -5,20 +5,67 @@ import os
 
 os.environ["DATABASE_URL"] = "postgresql:///flaskcafe_test"
 os.environ["FLASK_DEBUG"] = "0"
-
+# the app asgi.py builds on import
+os.environ["FLASK_CAFE_CONFIG"] = "testing"
+
+import asyncio
+import base64
+import datetime
+import decimal
+import gzip
+import hashlib
+import io
+import json
+import pickle
+import random
 import re
-from unittest import TestCase
+import select
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import Column, DateTime, Integer, Numeric, event, text
+from sqlalchemy.orm import declarative_base
 
 # from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, connect_db, User, Like
+from app import create_app, after_fork, CURR_USER_KEY
+from config import TestingConfig
+from metrics import Metrics, QueryBudgetExceeded, current_stats, mark_process_dead
+import compression
+from compression import CompressionMiddleware
+import assets
+from benchmarks import plans
+from caching import cache_purged
+from summaries import refresh_city_summaries
+import recommendations
+import importer
+import entity_cache
+import suggest
+import slow_queries
+import images
+import invalidation
+import mapquest
+try:
+    import asgi
+except ImportError:  # the async extras aren't installed
+    asgi = None
+from models import (
+    db, Cafe, City, connect_db, User, Like, CitySummary, CafeNeighbor,
+    DEFAULT_CAFE_IMAGE,
+    city_registry, create_missing_indexes, DuplicateKeysError)
+from mapquest import (
+    MapQuestClient, CircuitBreaker, MapQuestError,
+    CircuitOpenError)
 from flask import session
 
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+# Make Flask errors be real errors, rather than HTML pages with error info,
+# and don't req CSRF for testing
+app = create_app("testing")
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -109,6 +156,79 @@ ADMIN_USER_DATA = dict(
 )
 
 
+#######################################
+# app factory
+
+
+class AppFactoryTestCase(TestCase):
+    """Tests for config profiles."""
+
+    def test_production_profile(self):
+        prod = create_app("production")
+
+        self.assertNotIn("debugtoolbar", prod.blueprints)
+        self.assertFalse(prod.config.get("SQLALCHEMY_ECHO"))
+        self.assertTrue(prod.config["WARM_UP"])
+
+    def test_warm_up_compiles_templates(self):
+        prod = create_app("production")
+
+        # jinja's cache is keyed on (loader weakref, name)
+        cached = {name for _, name in prod.jinja_env.cache.keys()}
+        self.assertIn("cafe/list.html", cached)
+
+    def test_compile_templates(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            class CachedConfig(TestingConfig):
+                TEMPLATE_CACHE_DIR = cache_dir
+
+            cached_app = create_app(CachedConfig)
+            with cached_app.app_context():
+                result = cached_app.test_cli_runner().invoke(
+                    args=["compile-templates"])
+
+            self.assertIn("Compiled", result.output)
+            self.assertEqual(len(os.listdir(cache_dir)),
+                             len(cached_app.jinja_env.list_templates()))
+
+    def test_compile_templates_without_cache(self):
+        result = app.test_cli_runner().invoke(args=["compile-templates"])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_after_fork(self):
+        db.session.execute(text("SELECT 1"))
+        db.session.commit()
+        self.assertGreater(db.engine.pool.checkedin(), 0)
+        session = mapquest.client.session
+
+        after_fork(app)
+
+        self.assertEqual(db.engine.pool.checkedin(), 0)
+        self.assertIsNot(mapquest.client.session, session)
+
+    @skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_forked_worker(self):
+        """A worker gets its own connections; the parent's still work."""
+
+        db.session.execute(text("SELECT 1"))
+        db.session.commit()
+
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover - the child
+            status = 1
+            try:
+                after_fork(app)
+                db.session.execute(text("SELECT 1"))
+                db.session.remove()
+                status = 0
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(db.session.execute(text("SELECT 1")).scalar(), 1)
+
+
 #######################################
 # homepage
 
@@ -156,6 +276,32 @@ class CityModelTestCase(TestCase):
     # depending on how you solve exercise, you may have things to test on
     # the City model, so here's a good place to put that stuff.
 
+    def test_registry(self):
+        sf = city_registry.get("sf")
+        self.assertEqual((sf.name, sf.state), ("San Francisco", "CA"))
+        self.assertIsNone(city_registry.get("nope"))
+        self.assertEqual(city_registry.choices, [("sf", "San Francisco")])
+
+    def test_registry_reloads_on_commit(self):
+        version = city_registry.version
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+
+        self.assertGreater(city_registry.version, version)
+        self.assertEqual(city_registry.choices,
+                         [("oak", "Oakland"), ("sf", "San Francisco")])
+
+    def test_registry_skips_db(self):
+        # load the cafe itself (expired by the commit) before counting
+        self.cafe.city_code
+
+        with app.test_request_context():
+            app.preprocess_request()
+            city_registry.choices
+            self.cafe.get_city_state()
+            self.assertEqual(current_stats().sql_count, 0)
+
 
 #######################################
 # cafes
@@ -225,6 +371,32 @@ class CafeViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Test Cafe", resp.data)
 
+    def test_list_streamed(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertTrue(resp.is_streamed)
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_list_search(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes?q=test")
+            self.assertIn(b"Test Cafe", resp.data)
+
+            resp = client.get("/cafes?q=nope_100%")
+            self.assertNotIn(b"Test Cafe", resp.data)
+            self.assertIn(b"No cafes found.", resp.data)
+
+    def test_list_flashes_once(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Flashed!")]
+
+            resp = client.get("/cafes")
+            self.assertIn(b"Flashed!", resp.data)
+
+            resp = client.get("/cafes")
+            self.assertNotIn(b"Flashed!", resp.data)
+
     def test_detail(self):
         with app.test_client() as client:
             resp = client.get(f"/cafes/{self.cafe_id}")
@@ -748,3 +920,2030 @@ class LikeViewsTestCase(TestCase):
             resp = client.post(f"/api/unlike", json=json)
             self.assertEqual(resp.json, {"unliked": self.cafe_id})
 
+
+#######################################
+# async like API
+
+
+async def asgi_call(api, method, path, body=None, query="", user_id=None):
+    """Send one request to ASGI `api`; return (status, JSON body)."""
+
+    headers = []
+    if user_id is not None:
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie = serializer.dumps({CURR_USER_KEY: user_id})
+        headers.append((b"cookie",
+                        f"{app.config['SESSION_COOKIE_NAME']}={cookie}".encode()))
+
+    scope = {"type": "http", "http_version": "1.1", "scheme": "http",
+             "method": method, "path": path, "root_path": "",
+             "query_string": query.encode(), "headers": headers,
+             "server": ("localhost", 80), "client": ("127.0.0.1", 1234)}
+    incoming = [{"type": "http.request",
+                 "body": json.dumps(body).encode() if body is not None else b""}]
+    sent = []
+
+    async def receive():
+        return incoming.pop(0) if incoming else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await api(scope, receive, send)
+    body = b"".join(message.get("body", b"") for message in sent[1:])
+    return sent[0]["status"], json.loads(body) if body.startswith(b"{") else body
+
+
+async def asgi_lifespan(api, requests):
+    """Start `api` up, await `requests(api)`, shut it down; return what
+    `requests` returned."""
+
+    incoming, sent = asyncio.Queue(), asyncio.Queue()
+    task = asyncio.create_task(api({"type": "lifespan"}, incoming.get, sent.put))
+
+    await incoming.put({"type": "lifespan.startup"})
+    assert (await sent.get())["type"] == "lifespan.startup.complete"
+    try:
+        return await requests(api)
+    finally:
+        await incoming.put({"type": "lifespan.shutdown"})
+        assert (await sent.get())["type"] == "lifespan.shutdown.complete"
+        await task
+
+
+@skipUnless(asgi, "needs the async extras")
+class AsyncAPITestCase(TestCase):
+    """The ASGI like API, driven end to end."""
+
+    def setUp(self):
+        app.extensions["recommendations"].wait()
+        db.session.rollback()
+        Like.query.delete()
+        CafeNeighbor.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        self.cafes = [Cafe(**dict(CAFE_DATA, name=f"Cafe {i}")) for i in range(2)]
+        db.session.add_all(self.cafes)
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_ids = [cafe.id for cafe in self.cafes]
+        app.extensions["suggest"].load()
+        # nothing of ours holds the database while the API writes
+        db.session.rollback()
+
+        self.api = asgi.AsyncAPI(app, asgi.WsgiToAsgi(app))
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def run_api(self, requests):
+        return asyncio.run(asgi_lifespan(self.api, requests))
+
+    def test_like_and_unlike(self):
+        first, second = self.cafe_ids
+
+        async def requests(api):
+            user = {"user_id": self.user_id}
+            return [
+                await asgi_call(api, "GET", "/api/likes", query=f"cafe_id={first}", **user),
+                await asgi_call(api, "POST", "/api/like", {"cafe_id": first}, **user),
+                await asgi_call(api, "POST", "/api/like", {"cafe_id": first}, **user),
+                await asgi_call(api, "POST", "/api/like", {"cafe_id": second}, **user),
+                await asgi_call(api, "GET", "/api/likes", query=f"cafe_id={first}", **user),
+                await asgi_call(api, "POST", "/api/unlike", {"cafe_id": second}, **user),
+            ]
+
+        self.assertEqual(self.run_api(requests), [
+            (200, {"likes": False}),
+            (200, {"liked": first}),
+            (200, {"liked": first}),
+            (200, {"liked": second}),
+            (200, {"likes": True}),
+            (200, {"unliked": second}),
+        ])
+        self.assertEqual([(like.user_id, like.cafe_id) for like in Like.query.all()],
+                         [(self.user_id, first)])
+
+        # the session hooks saw every change
+        summary = db.session.get(CitySummary, "sf")
+        self.assertEqual(summary.like_count, 1)
+        self.assertEqual([cafe["likes"] for cafe in summary.top_cafes], [1])
+        self.assertEqual(app.extensions["suggest"].cafes.scores,
+                         {first: 1, second: 0})
+        app.extensions["recommendations"].wait()
+        self.assertEqual(CafeNeighbor.query.count(), 0)
+
+    def test_errors(self):
+        async def requests(api):
+            user = {"user_id": self.user_id}
+            return [
+                await asgi_call(api, "POST", "/api/like", {"cafe_id": self.cafe_ids[0]}),
+                await asgi_call(api, "POST", "/api/like", {"cafe_id": 0}, **user),
+                await asgi_call(api, "POST", "/api/unlike", {"cafe_id": 0}, **user),
+                await asgi_call(api, "POST", "/api/like", {"cafe": 1}, **user),
+                await asgi_call(api, "GET", "/api/likes", query="cafe_id=x", **user),
+                await asgi_call(api, "GET", "/api/likes", query="cafe_id=0", **user),
+            ]
+
+        self.assertEqual(self.run_api(requests), [
+            (200, {"error": "Not logged in"}),
+            (404, {"error": "Not Found"}),
+            (404, {"error": "Not Found"}),
+            (400, {"error": "Bad Request"}),
+            (400, {"error": "Bad Request"}),
+            (404, {"error": "Not Found"}),
+        ])
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_other_paths_go_to_flask(self):
+        async def requests(api):
+            return await asgi_call(api, "GET", "/api/pools")
+
+        self.assertEqual(self.run_api(requests), (200, {"error": "Access Denied"}))
+
+
+#######################################
+# city summaries
+
+
+class CitySummaryTestCase(TestCase):
+    """The homepage's per-city summaries follow likes and cafe changes."""
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Cafe.query.delete()
+        CitySummary.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        self.cafes = [Cafe(**dict(CAFE_DATA, name=f"Cafe {i}")) for i in range(4)]
+        db.session.add_all(self.cafes)
+        self.users = [User.register(**dict(TEST_USER_DATA, username=f"u{i}",
+                                           email=f"u{i}@test.com"))
+                      for i in range(3)]
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def summary(self, code="sf"):
+        summary = db.session.get(CitySummary, code)
+        db.session.refresh(summary)
+        return (summary.cafe_count, summary.like_count,
+                [(cafe["name"], cafe["likes"]) for cafe in summary.top_cafes])
+
+    def like(self, user, *cafes):
+        user.liked_cafes.extend(cafes)
+        db.session.commit()
+
+    def assertMatchesRefresh(self):
+        incremental = {code: self.summary(code) for code in ("sf", "oak")}
+        with db.engine.begin() as conn:
+            refresh_city_summaries(conn)
+        db.session.expire_all()
+        self.assertEqual({code: self.summary(code) for code in ("sf", "oak")},
+                         incremental)
+
+    def test_cafes_counted(self):
+        self.assertEqual(self.summary("sf"), (4, 0, []))
+        self.assertEqual(self.summary("oak"), (0, 0, []))
+
+        self.cafes[0].city_code = "oak"
+        db.session.commit()
+
+        self.assertEqual(self.summary("sf"), (3, 0, []))
+        self.assertEqual(self.summary("oak"), (1, 0, []))
+
+    def test_likes(self):
+        a, b, c, d = self.cafes
+        self.like(self.users[0], a, b, c, d)
+        self.like(self.users[1], b, c)
+        self.like(self.users[2], c)
+
+        self.assertEqual(self.summary(), (
+            4, 7, [("Cafe 2", 3), ("Cafe 1", 2), ("Cafe 0", 1)]))
+
+        # a top cafe drops below one we weren't keeping track of
+        self.users[1].liked_cafes.remove(b)
+        self.users[2].liked_cafes.remove(c)
+        db.session.commit()
+
+        self.assertEqual(self.summary(), (
+            4, 5, [("Cafe 2", 2), ("Cafe 0", 1), ("Cafe 1", 1)]))
+        self.assertMatchesRefresh()
+
+    def test_unlike_outside_top(self):
+        self.like(self.users[0], *self.cafes)
+        self.like(self.users[1], *self.cafes[:3])
+
+        self.users[0].liked_cafes.remove(self.cafes[3])
+        db.session.commit()
+
+        self.assertEqual(self.summary(), (
+            4, 6, [("Cafe 0", 2), ("Cafe 1", 2), ("Cafe 2", 2)]))
+        self.assertMatchesRefresh()
+
+    def test_like_rows_and_renames(self):
+        db.session.add(Like(user_id=self.users[0].id, cafe_id=self.cafes[1].id))
+        db.session.commit()
+        self.cafes[1].name = "Renamed"
+        db.session.commit()
+
+        self.assertEqual(self.summary(), (4, 1, [("Renamed", 1)]))
+        self.assertMatchesRefresh()
+
+    def test_homepage(self):
+        self.like(self.users[0], self.cafes[2])
+
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+
+        self.assertIn("San Francisco, CA", html)
+        self.assertIn("4 cafes,", html)
+        self.assertIn(f'<a href="/cafes/{self.cafes[2].id}">Cafe 2</a> (1)', html)
+        self.assertLess(html.index("San Francisco"), html.index("Oakland"))
+
+
+#######################################
+# related cafes
+
+
+class RecommendationsTestCase(TestCase):
+    """Related cafes are built from the likes and follow new ones."""
+
+    def setUp(self):
+        self.updater = app.extensions["recommendations"]
+        self.updater.wait()
+        db.session.rollback()
+        Like.query.delete()
+        CafeNeighbor.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        self.cafes = [Cafe(**dict(CAFE_DATA, name=f"Cafe {i}")) for i in range(5)]
+        db.session.add_all(self.cafes)
+        self.users = [User.register(**dict(TEST_USER_DATA, username=f"u{i}",
+                                           email=f"u{i}@test.com"))
+                      for i in range(4)]
+        db.session.commit()
+
+        a, b, c = self.cafes[:3]
+        self.users[0].liked_cafes.extend([a, b])
+        self.users[1].liked_cafes.extend([a, b, c])
+        self.users[2].liked_cafes.extend([c])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def build(self):
+        # the likes from setUp are applied by now; don't apply them twice
+        self.updater.wait()
+        with db.engine.begin() as conn:
+            return recommendations.build_neighbors(conn)
+
+    def neighbors(self):
+        """{cafe index: [(neighbor index, together, score)]}, best first"""
+
+        self.updater.wait()
+        index = {cafe.id: i for i, cafe in enumerate(self.cafes)}
+        found = {}
+        for row in CafeNeighbor.query.all():
+            found.setdefault(index[row.cafe_id], []).append(
+                (index[row.neighbor_id], row.together, round(row.score, 9)))
+        # rescaled scores can be a rounding error off recomputed ones
+        return {cafe: sorted(rows, key=lambda row: (-row[2], row[0]))
+                for cafe, rows in found.items()}
+
+    def test_build(self):
+        self.assertEqual(self.build(), 6)
+        self.assertEqual(self.neighbors(), {
+            0: [(1, 2, 1.0), (2, 1, 0.5)],
+            1: [(0, 2, 1.0), (2, 1, 0.5)],
+            2: [(0, 1, 0.5), (1, 1, 0.5)],
+        })
+
+    def test_likes_update_incrementally(self):
+        self.build()
+        a, b, c, d, e = self.cafes
+
+        self.users[3].liked_cafes.extend([c, d])
+        db.session.commit()
+        self.users[2].liked_cafes.append(e)
+        db.session.commit()
+        self.users[1].liked_cafes.remove(b)
+        db.session.add(Like(user_id=self.users[0].id, cafe_id=d.id))
+        db.session.commit()
+        self.users[2].liked_cafes.remove(c)
+        db.session.commit()
+
+        incremental = self.neighbors()
+        self.build()
+        self.assertEqual(self.neighbors(), incremental)
+
+    def test_applied_after_commit(self):
+        self.build()
+        a, b, c, d, e = self.cafes
+
+        self.users[3].liked_cafes.extend([a, d])
+        db.session.flush()
+        # nothing yet: the like may still roll back
+        self.assertFalse(CafeNeighbor.query.filter_by(cafe_id=d.id).count())
+        db.session.rollback()
+        self.updater.wait()
+        self.assertFalse(CafeNeighbor.query.filter_by(cafe_id=d.id).count())
+
+        self.users[3].liked_cafes.extend([a, d])
+        db.session.commit()
+        self.assertEqual([row[:2] for row in self.neighbors()[3]], [(0, 1)])
+
+    def test_deleted_cafe(self):
+        self.build()
+        db.session.delete(self.cafes[1])
+        db.session.commit()
+
+        self.assertEqual(self.neighbors(), {0: [(2, 1, 0.5)], 2: [(0, 1, 0.5)]})
+
+    @skipUnless(recommendations.sparse, "needs numpy and scipy")
+    def test_sparse_matches_python(self):
+        rng = random.Random(1)
+        likes = {(rng.randrange(50), rng.randrange(30)) for _ in range(400)}
+        user_ids, cafe_ids = zip(*sorted(likes))
+
+        self.assertEqual(
+            list(recommendations._compute_sparse(
+                recommendations.np.array(user_ids),
+                recommendations.np.array(cafe_ids), k=5, block_size=7)),
+            list(recommendations._compute_python(user_ids, cafe_ids, k=5)))
+
+    def test_detail_page(self):
+        self.build()
+
+        with app.test_client() as client:
+            html = client.get(f"/cafes/{self.cafes[0].id}").get_data(as_text=True)
+
+        self.assertIn("People who liked this also liked", html)
+        self.assertLess(html.index(f'<a href="/cafes/{self.cafes[1].id}">'),
+                        html.index(f'<a href="/cafes/{self.cafes[2].id}">'))
+
+
+#######################################
+# bulk import
+
+
+IMPORT_CSV = b"""name,description,url,address,city_code,image_url,extra
+Cafe One,First,http://one.com/,1 Main St,sf,,ignored
+,No name,,2 Main St,sf,,
+Cafe Three,Bad city,,3 Main St,nowhere,,
+Cafe Four,Bad url,not a url,4 Main St,sf,,
+Cafe Five,,,5 Main St,sf,http://five.com/img.jpg,
+"""
+
+IMPORT_JSONL = b"""{"name": "Cafe One", "address": "1 Main St", "city_code": "sf"}
+
+{"name": "Cafe Two", "address":
+["not", "an", "object"]
+{"name": "Cafe Four", "address": "4 Main St", "city_code": "sf", "url": null}
+"""
+
+
+class ImportTestCase(TestCase):
+    """Bulk import of cafes from CSV/JSONL."""
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+
+        # fail map fetches fast instead of calling MapQuest
+        self.mapquest_client = mapquest.client
+        mapquest.client = MapQuestClient(base_url="http://127.0.0.1:9/",
+                                         max_retries=0)
+
+    def tearDown(self):
+        mapquest.client = self.mapquest_client
+        db.session.rollback()
+
+    def test_csv(self):
+        result = importer.import_cafes(io.BytesIO(IMPORT_CSV), "csv", batch_size=1)
+
+        self.assertEqual((result.rows, result.imported), (5, 2))
+        self.assertEqual([line for line, _ in result.errors], [3, 4, 5])
+        self.assertIn("name:", result.errors[0][1])
+        self.assertIn("city_code:", result.errors[1][1])
+        self.assertIn("url:", result.errors[2][1])
+
+        cafes = Cafe.query.order_by(Cafe.name).all()
+        self.assertEqual([cafe.name for cafe in cafes], ["Cafe Five", "Cafe One"])
+        self.assertEqual(cafes[1].image_url, DEFAULT_CAFE_IMAGE)
+        self.assertEqual(db.session.get(CitySummary, "sf").cafe_count, 2)
+
+    def test_jsonl(self):
+        result = importer.import_cafes(io.BytesIO(IMPORT_JSONL), "jsonl")
+
+        self.assertEqual((result.rows, result.imported), (4, 2))
+        self.assertEqual([line for line, _ in result.errors], [3, 4])
+        self.assertIn("invalid JSON", result.errors[0][1])
+
+    def test_maps_in_pool(self):
+        pool = importer.MapPool(2)
+        result = importer.import_cafes(io.BytesIO(IMPORT_CSV), "csv", maps=pool)
+        pool.wait()
+
+        self.assertEqual(pool.saved + pool.failed, result.imported)
+
+    def test_upload(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get("/cafes/import", follow_redirects=True)
+            self.assertIn(b"Access Denied", resp.data)
+
+            login_for_test(client, self.admin_id)
+            resp = client.post("/cafes/import", data={
+                "file": (io.BytesIO(IMPORT_CSV), "cafes.csv"),
+            })
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Imported 2 of 5 cafes (3 errors)", html)
+        self.assertIn("<td>4</td>", html)
+        self.assertEqual(Cafe.query.count(), 2)
+
+    def test_cli(self):
+        with tempfile.NamedTemporaryFile(suffix=".jsonl") as file:
+            file.write(IMPORT_JSONL)
+            file.flush()
+            result = app.test_cli_runner().invoke(
+                args=["import-cafes", file.name, "--no-maps"])
+
+        self.assertIn("Imported 2 of 4 cafes", result.output)
+        self.assertIn("line 4: not a JSON object", result.output)
+
+
+#######################################
+# entity cache
+
+
+class FakeMemcachedHandler(StreamRequestHandler):
+    """Just the memcached commands the entity cache uses, on `store`."""
+
+    store = {}
+
+    def handle(self):
+        while line := self.rfile.readline():
+            command, *args = line.decode().split()
+            if command == "get":
+                for key in args:
+                    if key in self.store:
+                        value = self.store[key]
+                        self.wfile.write(f"VALUE {key} 0 {len(value)}\r\n".encode()
+                                         + value + b"\r\n")
+                self.wfile.write(b"END\r\n")
+            elif command in ("set", "add"):
+                key, _, _, length = args
+                value = self.rfile.read(int(length) + 2)[:-2]
+                if command == "add" and key in self.store:
+                    self.wfile.write(b"NOT_STORED\r\n")
+                else:
+                    self.store[key] = value
+                    self.wfile.write(b"STORED\r\n")
+            elif command == "incr":
+                key, by = args
+                if key not in self.store:
+                    self.wfile.write(b"NOT_FOUND\r\n")
+                else:
+                    self.store[key] = str(int(self.store[key]) + int(by)).encode()
+                    self.wfile.write(self.store[key] + b"\r\n")
+
+
+class EntityCacheTestCase(TestCase):
+    """Cafe/City/User rows come from the cache until they change."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingTCPServer(("127.0.0.1", 0), FakeMemcachedHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.address = "127.0.0.1:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+        self.cafe_id = cafe.id
+
+        FakeMemcachedHandler.store.clear()
+        self.cache = app.extensions["entity_cache"]
+        self.shared = self.cache.shared
+        self.cache.shared = None
+
+    def tearDown(self):
+        self.cache.shared = self.shared
+        db.session.rollback()
+
+    def make_cache(self, shared=True):
+        return entity_cache.EntityCache(
+            entity_cache.LocalTier(100, ttl=60),
+            entity_cache.MemcacheTier(self.address, 60, 1) if shared else None)
+
+    def get(self, cache, model=Cafe, ident=None):
+        db.session.remove()
+        return cache.get(db.session, model, ident or self.cafe_id)
+
+    def rename(self, name):
+        db.session.get(Cafe, self.cafe_id).name = name
+        db.session.commit()
+
+    def test_local_hit(self):
+        cache = self.make_cache(shared=False)
+        self.get(cache)
+        cafe = self.get(cache)
+
+        self.assertEqual((cache.hits["local"], cache.misses), (1, 1))
+        self.assertEqual(cafe.name, "Test Cafe")
+        # attached to the session like any loaded row
+        self.assertIn(cafe, db.session)
+        self.assertEqual(cafe.city.name, "San Francisco")
+
+    def test_invalidated_on_commit(self):
+        self.get(self.cache)
+        self.rename("Renamed")
+
+        self.assertEqual(self.get(self.cache).name, "Renamed")
+
+    def test_bulk_change_invalidates(self):
+        self.get(self.cache)
+        Cafe.query.update({"name": "Bulk"})
+        db.session.commit()
+
+        self.assertEqual(self.get(self.cache).name, "Bulk")
+
+    def test_stale_fill_rejected(self):
+        cache = self.make_cache(shared=False)
+        key = f"cafes:{self.cafe_id}"
+        stamp = cache.local.stamp("cafes", key)
+        # a commit lands between reading the row and caching it
+        cache.invalidate([key])
+        cache.local.set(key, stamp, {"id": self.cafe_id, "name": "Stale"})
+
+        self.assertEqual(self.get(cache).name, "Test Cafe")
+
+    def test_shared_tier(self):
+        one, two = self.make_cache(), self.make_cache()
+        self.get(one)
+        self.assertEqual(self.get(two).name, "Test Cafe")
+        self.assertEqual(two.hits["shared"], 1)
+
+        # a commit in one process rejects the other's shared entry
+        self.cache.shared = one.shared
+        self.rename("Renamed")
+        two.local.entries.clear()
+
+        self.assertEqual(self.get(two).name, "Renamed")
+        self.assertEqual(two.misses, 1)
+
+    def test_credentials_not_cached(self):
+        user = User.register(**dict(TEST_USER_DATA, username="credentials",
+                                    email="credentials@test.com"))
+        db.session.commit()
+        one, two = self.make_cache(), self.make_cache()
+        self.get(one, User, user.id)
+
+        self.assertNotIn(b"hashed_password", b"".join(FakeMemcachedHandler.store.values()))
+        self.assertNotIn("hashed_password", one.local.entries[f"users:{user.id}"][2])
+
+        # a hit loads it when it's needed
+        cached = self.get(two, User, user.id)
+        self.assertEqual(two.hits["shared"], 1)
+        self.assertTrue(cached.hashed_password.startswith("$2"))
+
+    def test_shared_entries_are_json(self):
+        one, two = self.make_cache(), self.make_cache()
+        self.get(one)
+        key = f"flask_cafe:e:cafes:{self.cafe_id}"
+        stamp, data = json.loads(FakeMemcachedHandler.store[key])
+        self.assertEqual(data["name"], "Test Cafe")
+
+        # anything else in the entry is ignored, not unpickled
+        FakeMemcachedHandler.store[key] = pickle.dumps((stamp, data))
+        self.assertEqual(self.get(two).name, "Test Cafe")
+        self.assertEqual((two.hits["shared"], two.misses), (0, 1))
+
+    def test_json_conversion(self):
+        class Row(declarative_base()):
+            __tablename__ = "rows"
+            id = Column(Integer, primary_key=True)
+            at = Column(DateTime)
+            price = Column(Numeric)
+
+        data = {"id": 1, "at": datetime.datetime(2024, 1, 2, 3, 4, 5),
+                "price": decimal.Decimal("1.50")}
+        encoded = json.loads(json.dumps(entity_cache._to_json(Row, data)))
+
+        self.assertEqual(encoded["at"], "2024-01-02T03:04:05")
+        self.assertEqual(entity_cache._from_json(Row, encoded), data)
+
+    def test_shared_tier_down(self):
+        cache = entity_cache.EntityCache(
+            entity_cache.LocalTier(100, ttl=60),
+            entity_cache.MemcacheTier("127.0.0.1:9", 60, 0.1))
+
+        self.assertEqual(self.get(cache).name, "Test Cafe")
+
+    def test_views(self):
+        user = User.register(**dict(TEST_USER_DATA, username="cached",
+                                    email="cached@test.com"))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, user.id)
+            for _ in range(2):
+                resp = client.post("/api/like", json={"cafe_id": self.cafe_id})
+                self.assertEqual(resp.json, {"liked": self.cafe_id})
+                resp = client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+                self.assertEqual(resp.json, {"unliked": self.cafe_id})
+
+
+#######################################
+# search suggestions
+
+
+class PrefixIndexTestCase(TestCase):
+    """Names found by a prefix of any word, most popular first."""
+
+    def setUp(self):
+        self.index = suggest.PrefixIndex([
+            (1, "Blue Bottle", 5),
+            (2, "Café Blume", 9),
+            (3, "Sightglass", 1),
+            (4, "Bluestone Lane Coffee Roasters of Brooklyn", 0),
+        ])
+
+    def test_top(self):
+        self.assertEqual(self.index.top("blu", 10), [2, 1, 4])
+        self.assertEqual(self.index.top("blu", 2), [2, 1])
+        # any word, accents dropped
+        self.assertEqual(self.index.top("cafe", 10), [2])
+        self.assertEqual(self.index.top("coffee ro", 10), [4])
+        self.assertEqual(self.index.top("lane coffee roasters of brook", 10), [4])
+        self.assertEqual(self.index.top("lane coffee roasters of bronx", 10), [])
+
+    def test_changes(self):
+        self.index.add_score(4, 10)
+        self.index.remove(2)
+        self.index.add(5, "Blunt Instrument", 7)
+
+        self.assertEqual(self.index.top("blu", 10), [4, 5, 1])
+
+    def test_popularity_order_scan(self):
+        """Ranges too big to rank give the same answers."""
+
+        ranked = {prefix: self.index.top(prefix, 2) for prefix in ("b", "blu", "s")}
+        old, suggest.SCAN_LIMIT = suggest.SCAN_LIMIT, 0
+        try:
+            self.assertEqual(
+                {prefix: self.index.top(prefix, 2) for prefix in ranked}, ranked)
+        finally:
+            suggest.SCAN_LIMIT = old
+
+
+class SuggestViewsTestCase(TestCase):
+    """/api/cafes/suggest, kept current as cafes and likes change."""
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.add(City(**CITY_DATA))
+        self.cafe = Cafe(**CAFE_DATA)
+        self.other = Cafe(**dict(CAFE_DATA, name="Tested Beans"))
+        self.user = User.register(**TEST_USER_DATA)
+        db.session.add_all([self.cafe, self.other])
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.index = app.extensions["suggest"]
+        self.index.load()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def suggested(self, prefix):
+        resp = self.client.get("/api/cafes/suggest", query_string={"prefix": prefix})
+        return [cafe["name"] for cafe in resp.json["cafes"]]
+
+    def test_suggest(self):
+        resp = self.client.get("/api/cafes/suggest?prefix=san")
+        self.assertEqual(resp.json, {
+            "cafes": [],
+            "cities": [{"code": "sf", "name": "San Francisco", "state": "CA"}],
+        })
+        self.assertEqual(self.suggested("te"), ["Test Cafe", "Tested Beans"])
+        self.assertEqual(self.suggested("bea"), ["Tested Beans"])
+        self.assertEqual(self.suggested(""), [])
+
+    def test_limit(self):
+        for limit, expected in ((1, 1), (0, 1), (-5, 1), (100, 2)):
+            resp = self.client.get("/api/cafes/suggest",
+                                   query_string={"prefix": "te", "limit": limit})
+            self.assertEqual(len(resp.json["cafes"]), expected)
+
+        # the popularity-order walk too
+        index = suggest.PrefixIndex((id, "tea", 0) for id in range(suggest.SCAN_LIMIT + 1))
+        self.assertEqual(len(index.top("t", 3)), 3)
+
+    def test_kept_current(self):
+        self.user.liked_cafes.append(self.other)
+        db.session.commit()
+        self.assertEqual(self.suggested("te"), ["Tested Beans", "Test Cafe"])
+
+        self.other.name = "Roasted Beans"
+        db.session.add(Cafe(**dict(CAFE_DATA, name="Tea House")))
+        db.session.commit()
+        self.assertEqual(self.suggested("te"), ["Tea House", "Test Cafe"])
+
+        db.session.delete(self.cafe)
+        db.session.commit()
+        self.assertEqual(self.suggested("te"), ["Tea House"])
+        self.assertFalse(self.index.stale)
+
+    def test_other_process_change(self):
+        db.session.execute(
+            text("UPDATE cafes SET name = 'Renamed' WHERE id = :id"),
+            {"id": self.cafe.id})
+        db.session.commit()
+        invalidation.invalidated.send(app, keys=[f"cafes:{self.cafe.id}"], tables=[])
+
+        self.assertEqual(self.suggested("ren"), ["Renamed"])
+
+    def test_other_process_insert(self):
+        committed = []
+
+        def note(session):
+            committed.append((set(session.info.get("entity_cache_keys", ())),
+                              set(session.info.get("entity_cache_tables", ()))))
+
+        event.listen(db.session, "before_commit", note)
+        try:
+            cafe = Cafe(**dict(CAFE_DATA, name="Teapot"))
+            db.session.add(cafe)
+            # (the bus flushes before publishing)
+            db.session.flush()
+            db.session.commit()
+            importer.import_cafes(io.BytesIO(IMPORT_JSONL), "jsonl")
+        finally:
+            event.remove(db.session, "before_commit", note)
+
+        (keys, _), (_, tables) = committed[0], committed[-1]
+        self.assertIn(f"cafes:{cafe.id}", keys)
+        self.assertIn("cafes", tables)
+
+        # another process's index, which hadn't seen the new cafe
+        self.index.remove_cafe(cafe.id)
+        listener = invalidation.Listener(app)
+        listener.handle(json.dumps({"origin": "elsewhere:1", "keys": sorted(keys),
+                                    "tables": []}))
+        self.assertEqual(self.suggested("tea"), ["Teapot"])
+
+        listener.handle(json.dumps({"origin": "elsewhere:1", "keys": [],
+                                    "tables": sorted(tables)}))
+        self.assertTrue(self.index.stale)
+        self.assertEqual(self.suggested("cafe o"), ["Cafe One"])
+
+
+#######################################
+# invalidation bus
+
+
+class InvalidationBusTestCase(TestCase):
+    """Other processes' commits evict what this one has cached."""
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+        self.cafe_id = cafe.id
+        self.key = f"cafes:{cafe.id}"
+
+        self.cache = app.extensions["entity_cache"]
+        self.listener = invalidation.Listener(app)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def from_elsewhere(self, keys=(), tables=()):
+        payload = json.loads(invalidation.message(keys, tables))
+        payload["origin"] = "elsewhere:1"
+        return json.dumps(payload)
+
+    def cached(self):
+        return self.cache.local.entries.get(self.key)
+
+    def test_message(self):
+        data = json.loads(invalidation.message(
+            ["cafes:1", "users:2"], ["cafes"]))
+        self.assertEqual((data["keys"], data["tables"]), (["users:2"], ["cafes"]))
+
+        # too big for a NOTIFY: whole tables instead
+        data = json.loads(invalidation.message(
+            [f"cafes:{i}" for i in range(2000)]))
+        self.assertEqual((data["keys"], data["tables"]), ([], ["cafes"]))
+
+    def test_evicts(self):
+        entity_cache.cached_get(Cafe, self.cafe_id)
+        self.assertIsNotNone(self.cached())
+
+        sent = []
+        with invalidation.invalidated.connected_to(
+                lambda sender, **kw: sent.append(kw), app):
+            self.listener.handle(self.from_elsewhere([self.key]))
+
+        self.assertIsNone(self.cached())
+        self.assertEqual(sent, [{"keys": [self.key], "tables": []}])
+
+    def test_own_messages_ignored(self):
+        entity_cache.cached_get(Cafe, self.cafe_id)
+        self.listener.handle(invalidation.message([self.key]))
+
+        self.assertIsNotNone(self.cached())
+
+    def test_city_change_reloads_registry(self):
+        db.session.execute(text(
+            "INSERT INTO cities (code, name, state) VALUES ('oak', 'Oakland', 'CA')"))
+        db.session.commit()
+        self.listener.handle(self.from_elsewhere(tables=["cities"]))
+
+        self.assertEqual(city_registry.get("oak").name, "Oakland")
+
+    def test_resync(self):
+        entity_cache.cached_get(Cafe, self.cafe_id)
+        self.listener.resync()
+
+        self.assertIsNone(self.cached())
+        self.assertEqual(self.listener.resyncs, 1)
+
+    @skipUnless(db.engine.dialect.name == "postgresql", "needs Postgres")
+    def test_commit_notifies(self):
+        conn = db.engine.raw_connection()
+        try:
+            conn.driver_connection.autocommit = True
+            conn.driver_connection.cursor().execute(f"LISTEN {invalidation.CHANNEL}")
+
+            app.config["INVALIDATION_BUS"] = True
+            try:
+                db.session.get(Cafe, self.cafe_id).name = "Rolled back"
+                db.session.flush()
+                db.session.rollback()
+                db.session.get(Cafe, self.cafe_id).name = "Renamed"
+                db.session.commit()
+            finally:
+                app.config["INVALIDATION_BUS"] = False
+
+            select.select([conn.driver_connection], [], [], 5)
+            conn.driver_connection.poll()
+            notifies = conn.driver_connection.notifies
+        finally:
+            conn.invalidate()
+
+        # one for the commit, none for the rollback
+        self.assertEqual(len(notifies), 1)
+        self.assertEqual(json.loads(notifies[0].payload)["keys"], [self.key])
+
+
+#######################################
+# image proxy
+
+
+# 1x1 transparent PNG
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+
+class FakeImageHandler(BaseHTTPRequestHandler):
+    """Serves PNG, or the next status in `statuses`."""
+
+    statuses = []
+    hits = 0
+
+    def do_GET(self):
+        FakeImageHandler.hits += 1
+        status = self.statuses.pop(0) if self.statuses else 200
+        body = PNG if status == 200 else b"oops"
+
+        self.send_response(status)
+        self.send_header("Content-Type", "image/png" if status == 200 else "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """/images fetches each image once and serves it from disk."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeImageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/cafe.png"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeImageHandler.statuses = []
+        FakeImageHandler.hits = 0
+        self.tmp = tempfile.TemporaryDirectory()
+        self.proxy = app.extensions["images"]
+        app.extensions["images"] = images.ImageProxy(
+            images.DiskCache(self.tmp.name, 10 ** 6), self.proxy.fetcher)
+        app.config["IMAGE_PROXY_ALLOW_PRIVATE"] = True
+
+    def tearDown(self):
+        app.config["IMAGE_PROXY_ALLOW_PRIVATE"] = False
+        app.extensions["images"] = self.proxy
+        self.tmp.cleanup()
+
+    def thumbnail_url(self, url=None, width=400):
+        with app.test_request_context():
+            return images.thumbnail_url(url or self.url, width)
+
+    def test_fetched_once(self):
+        with app.test_client() as client:
+            for _ in range(2):
+                resp = client.get(self.thumbnail_url())
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.data, PNG)
+                self.assertEqual(resp.mimetype, "image/png")
+                self.assertEqual(resp.headers["Cache-Control"], images.IMMUTABLE)
+                resp.close()
+
+        self.assertEqual(FakeImageHandler.hits, 1)
+
+    def test_only_signed_urls(self):
+        url = self.thumbnail_url()
+        with app.test_client() as client:
+            # each gets the not-found page
+            for bad in (url.replace("cafe.png", "other.png"),
+                        url.replace("/400/", "/401/"),
+                        self.thumbnail_url(width=123)):
+                self.assertEqual(client.get(bad).mimetype, "text/html")
+
+        self.assertEqual(FakeImageHandler.hits, 0)
+
+    def test_failure_redirects_to_original(self):
+        FakeImageHandler.statuses = [404]
+        with app.test_client() as client:
+            resp = client.get(self.thumbnail_url())
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, self.url)
+
+    def test_private_hosts_refused(self):
+        app.config["IMAGE_PROXY_ALLOW_PRIVATE"] = False
+        with app.test_client() as client:
+            resp = client.get(self.thumbnail_url())
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(FakeImageHandler.hits, 0)
+
+    def test_private_peer_refused(self):
+        # what a host that passed check_public and then resolved to a
+        # private address (DNS rebinding) gets
+        app.config["IMAGE_PROXY_ALLOW_PRIVATE"] = False
+        with app.test_request_context(), self.assertRaises(images.ImageError):
+            self.proxy.fetcher.session.get(self.url)
+
+        self.assertEqual(FakeImageHandler.hits, 0)
+
+    def test_disk_lru(self):
+        cache = images.DiskCache(self.tmp.name, 250)
+        for i, key in enumerate(["a", "b", "c"]):
+            path = cache.put(key, b"x" * 100, "png")
+            os.utime(path, (i, i))
+        cache.get("b")
+
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+
+    def test_templates(self):
+        db.session.rollback()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.add(Cafe(**CAFE_DATA))
+        db.session.commit()
+
+        with app.test_client() as client:
+            html = client.get("/cafes").get_data(as_text=True)
+
+        self.assertIn("/images/400/", html)
+
+
+#######################################
+# mapquest
+
+
+class FakeMapQuestHandler(BaseHTTPRequestHandler):
+    """Replies with the next status in `statuses` (200 once they run out)."""
+
+    statuses = []
+    hits = 0
+
+    def do_GET(self):
+        FakeMapQuestHandler.hits += 1
+        status = self.statuses.pop(0) if self.statuses else 200
+        body = b"fake-jpg" if status == 200 else b"oops"
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MapQuestClientTestCase(TestCase):
+    """Tests for the pooled MapQuest client against a local fake server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeMapQuestHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/map"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeMapQuestHandler.statuses = []
+        FakeMapQuestHandler.hits = 0
+
+    def make_client(self, **kwargs):
+        return MapQuestClient(base_url=self.url, api_key="k", backoff=0, **kwargs)
+
+    def test_get_map(self):
+        client = self.make_client()
+        self.assertEqual(client.get_map("500 Sansome St", "SF", "CA"), b"fake-jpg")
+
+        stats = client.stats()
+        self.assertEqual(stats["calls"], 1)
+        self.assertEqual(stats["errors"], 0)
+        self.assertEqual(stats["breaker_state"], "closed")
+
+    def test_retries_transient_errors(self):
+        FakeMapQuestHandler.statuses = [503, 502]
+        client = self.make_client(max_retries=2)
+
+        self.assertEqual(client.get_map("a", "b", "c"), b"fake-jpg")
+        self.assertEqual(FakeMapQuestHandler.hits, 3)
+        self.assertEqual(client.stats()["retries"], 2)
+
+    def test_no_retry_on_client_error(self):
+        FakeMapQuestHandler.statuses = [400]
+        client = self.make_client(max_retries=2)
+
+        with self.assertRaises(MapQuestError):
+            client.get_map("a", "b", "c")
+        self.assertEqual(FakeMapQuestHandler.hits, 1)
+        self.assertEqual(client.stats()["error_rate"], 1.0)
+
+    def test_client_error_doesnt_trip_breaker(self):
+        FakeMapQuestHandler.statuses = [400, 400]
+        client = self.make_client(max_retries=0,
+                                  breaker=CircuitBreaker(failure_threshold=2))
+
+        for _ in range(2):
+            with self.assertRaises(MapQuestError):
+                client.get_map("a", "b", "c")
+        self.assertEqual(client.breaker.state, "closed")
+
+    def test_breaker_fails_fast(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30,
+                                 clock=lambda: now[0])
+        client = self.make_client(max_retries=0, breaker=breaker)
+
+        FakeMapQuestHandler.statuses = [500, 500]
+        for _ in range(2):
+            with self.assertRaises(MapQuestError):
+                client.get_map("a", "b", "c")
+
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpenError):
+            client.get_map("a", "b", "c")
+        self.assertEqual(FakeMapQuestHandler.hits, 2)
+
+        # after the timeout one trial call closes the breaker again
+        now[0] = 31
+        self.assertEqual(breaker.state, "half-open")
+        self.assertEqual(client.get_map("a", "b", "c"), b"fake-jpg")
+        self.assertEqual(breaker.state, "closed")
+
+    def test_breaker_one_trial_call(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30,
+                                 clock=lambda: now[0])
+        breaker.record_failure()
+        now[0] = 31
+
+        # only the first caller gets the trial; the rest wait for it
+        self.assertEqual([breaker.allow() for _ in range(3)], [True, False, False])
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+
+        now[0] = 62
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual([breaker.allow() for _ in range(2)], [True, True])
+
+    def test_timeout(self):
+        client = MapQuestClient(base_url="http://10.255.255.1/map",
+                                connect_timeout=0.05, read_timeout=0.05,
+                                max_retries=0, backoff=0)
+        with self.assertRaises(MapQuestError):
+            client.get_map("a", "b", "c")
+
+
+#######################################
+# read replicas
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests for sending read-only views to a (SQLite stand-in) replica.
+
+    The stand-in replica is empty, so reads that reach it find nothing.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_file = tempfile.NamedTemporaryFile(suffix=".db")
+
+        class ReplicaConfig(TestingConfig):
+            SQLALCHEMY_REPLICA_URIS = [f"sqlite:///{cls.replica_file.name}"]
+
+        cls.app = create_app(ReplicaConfig)
+        with cls.app.app_context():
+            db.metadata.create_all(db.engines["replica0"])
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+        cls.replica_file.close()
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        Like.query.delete()
+        db.session.commit()
+
+    def test_read_only_view_uses_replica(self):
+        with self.app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+            # not marked read-only: still the primary
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/{self.cafe_id}/edit")
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_read_your_writes(self):
+        with self.app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.get("/profile")
+            self.assertIn(b"no liked cafes", resp.data)
+
+            resp = client.post("/api/like", json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.json, {"liked": self.cafe_id})
+
+            resp = client.get("/profile")
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        replicas = self.app.extensions["replicas"]
+        replicas.lags["replica0"] = 60
+        replicas._checked_at["replica0"] = float("inf")
+
+        try:
+            with self.app.test_client() as client:
+                resp = client.get("/cafes")
+                self.assertIn(b"Test Cafe", resp.data)
+        finally:
+            replicas._checked_at.clear()
+
+    def test_pool_stats(self):
+        with self.app.test_client() as client:
+            resp = client.get("/api/pools")
+            self.assertEqual(resp.json, {"error": "Access Denied"})
+
+            login_for_test(client, self.admin_id)
+            client.get("/cafes").get_data()
+            resp = client.get("/api/pools")
+            self.assertIn("primary", resp.json)
+            self.assertEqual(resp.json["replica0"]["lag"], 0.0)
+
+
+#######################################
+# indexes
+
+
+class QueryPlanTestCase(TestCase):
+    """Every hot query can be answered with an index."""
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(Cafe(**CAFE_DATA))
+        User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def explain_all(self, queries):
+        with db.engine.connect() as conn:
+            if conn.dialect.name == "postgresql":
+                # tables this small are cheaper to scan; only a missing
+                # index should make the planner do it here
+                conn.execute(text("SET enable_seqscan = off"))
+            return plans.check(conn, queries(conn), log=lambda message: None)
+
+    def test_hot_queries_use_indexes(self):
+        self.assertEqual(self.explain_all(plans.hot_queries), [])
+
+    def test_detects_scan(self):
+        unindexed = lambda conn: [("by description", Cafe.query.filter(
+            Cafe.description == "x").statement)]
+        self.assertEqual(self.explain_all(unindexed), ["by description"])
+
+    def test_create_missing_indexes(self):
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_likes_cafe_id"))
+
+        self.assertEqual(create_missing_indexes(db.engine), ["ix_likes_cafe_id"])
+        self.assertEqual(create_missing_indexes(db.engine), [])
+
+    def test_login_any_case(self):
+        self.assertTrue(User.authenticate("TEST", "secret"))
+
+    def test_usernames_differing_in_case(self):
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_users_username_lower"))
+        try:
+            other = User.register(**dict(TEST_USER_DATA, username="Test",
+                                         email="other@test.com"))
+            db.session.commit()
+
+            with self.assertRaises(DuplicateKeysError) as raised:
+                create_missing_indexes(db.engine)
+            self.assertEqual(raised.exception.duplicates,
+                             {"ix_users_username_lower": [("Test",), ("test",)]})
+
+            # the exact username wins; any other case is ambiguous
+            self.assertEqual(User.authenticate("Test", "secret").id, other.id)
+            self.assertFalse(User.authenticate("TEST", "secret"))
+
+            db.session.delete(other)
+            db.session.commit()
+        finally:
+            self.assertEqual(create_missing_indexes(db.engine),
+                             ["ix_users_username_lower"])
+
+    @skipUnless(db.engine.dialect.name == "postgresql", "Postgres only")
+    def test_rebuilds_invalid_index(self):
+        db.session.add(Like(user_id=User.query.one().id, cafe_id=Cafe.query.one().id))
+        db.session.commit()
+        with db.engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("DROP INDEX ix_likes_cafe_id"))
+            # a CONCURRENTLY build that fails leaves an invalid index
+            with self.assertRaises(Exception):
+                conn.execute(text("CREATE INDEX CONCURRENTLY ix_likes_cafe_id "
+                                  "ON likes ((cafe_id / 0))"))
+
+        self.assertEqual(create_missing_indexes(db.engine), ["ix_likes_cafe_id"])
+        self.assertEqual(create_missing_indexes(db.engine), [])
+
+
+#######################################
+# metrics
+
+
+class MetricsTestCase(TestCase):
+    """Tests for Server-Timing and /metrics."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_server_timing(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+
+            timing = resp.headers["Server-Timing"]
+            self.assertRegex(timing, r'sql;dur=[\d.]+;desc="[1-9]\d* queries"')
+            self.assertIn("tpl;dur=", timing)
+            self.assertIn("total;dur=", timing)
+
+    def test_metrics_endpoint(self):
+        with app.test_client() as client:
+            client.get("/cafes")
+            resp = client.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(
+                'flask_cafe_request_duration_seconds_bucket{endpoint="views.cafe_list",le="+Inf"}',
+                text)
+            self.assertIn('flask_cafe_sql_statements_total{endpoint="views.cafe_list"}', text)
+            self.assertIn("flask_cafe_mapquest_calls_total ", text)
+            self.assertIn('flask_cafe_mapquest_breaker{state="closed"} 1', text)
+
+    def test_metrics_across_processes(self):
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            with open(os.path.join(metrics_dir, "999999.json"), "w") as file:
+                file.write(json.dumps({
+                    "endpoints": {"views.cafe_list": {
+                        "count": 5, "duration": 1.0, "buckets": [5] * 11,
+                        "sql_count": 10, "sql": 0.1, "tpl": 0.2, "mapquest": 0.0,
+                    }},
+                    "mapquest": {"calls": 3, "errors": 1, "retries": 2,
+                                 "latency_total": 1.5, "breaker_closed": 0,
+                                 "breaker_open": 1, "breaker_half-open": 0},
+                }))
+
+            metrics = Metrics(metrics_dir)
+            metrics.observe("views.cafe_list", 0.5, 2,
+                            {"sql": 0.1, "tpl": 0.1, "mapquest": 0.0})
+
+            totals = metrics.collect()
+            self.assertEqual(totals["endpoints"]["views.cafe_list"]["count"], 6)
+            self.assertEqual(totals["endpoints"]["views.cafe_list"]["sql_count"], 12)
+            self.assertGreaterEqual(totals["mapquest"]["calls"], 3)
+            self.assertEqual(totals["mapquest"]["breaker_open"], 1)
+            self.assertEqual(totals["mapquest"]["breaker_closed"], 1)
+
+    def test_dead_process_forgotten(self):
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            metrics = Metrics(metrics_dir)
+            metrics.flush()
+            with open(os.path.join(metrics_dir, "999999.json"), "w") as file:
+                file.write(json.dumps(metrics.snapshot()))
+
+            mark_process_dead(metrics_dir, 999999)
+            mark_process_dead(metrics_dir, 999999)
+
+            self.assertEqual(os.listdir(metrics_dir), [f"{os.getpid()}.json"])
+
+    def test_failed_statement_timer_popped(self):
+        with db.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.execute(text("SELECT * FROM no_such_table"))
+            self.assertEqual(conn.info["query_start"], [])
+
+
+#######################################
+# profiling
+
+
+class ProfilingTestCase(TestCase):
+    """Admins can profile a single request."""
+
+    def setUp(self):
+        db.session.rollback()
+        Like.query.delete()
+        Cafe.query.delete()
+        User.query.delete()
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.commit()
+        self.user_id, self.admin_id = user.id, admin.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = dict(app.config)
+        app.config.update(PROFILE_DIR=self.tmp.name, PROFILE_INTERVAL=0.0005,
+                          PROFILE_KEEP=2)
+
+    def tearDown(self):
+        app.config.update(self.config)
+        self.tmp.cleanup()
+        db.session.rollback()
+
+    def profile(self, user_id, kind, path="/cafes"):
+        with app.test_client() as client:
+            login_for_test(client, user_id)
+            resp = client.get(path, query_string={"_profile": kind})
+            resp.close()
+            return resp
+
+    def download(self, client, url):
+        login_for_test(client, self.admin_id)
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return resp.get_data(as_text=True)
+
+    def test_cpu(self):
+        resp = self.profile(self.admin_id, "cpu")
+
+        with app.test_client() as client:
+            folded = self.download(client, resp.headers["X-Profile"])
+        for line in folded.splitlines():
+            self.assertRegex(line, r"^\S.*;.* \d+$")
+
+    def test_memory(self):
+        resp = self.profile(self.admin_id, "memory")
+
+        with app.test_client() as client:
+            report = self.download(client, resp.headers["X-Profile"])
+        self.assertTrue(report.startswith("GET /cafes?_profile=memory\n"))
+        self.assertIn("peak", report)
+
+    def test_admin_only(self):
+        resp = self.profile(self.user_id, "cpu")
+        self.assertNotIn("X-Profile", resp.headers)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+        name = self.profile(self.admin_id, "cpu").headers["X-Profile"]
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            self.assertNotEqual(client.get(name).mimetype, "text/plain")
+
+    def test_keeps_latest(self):
+        for _ in range(3):
+            self.profile(self.admin_id, "cpu")
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            self.assertEqual(len(client.get("/admin/profiles").json["profiles"]), 2)
+
+
+#######################################
+# slow queries
+
+
+class SlowQueriesTestCase(TestCase):
+    """Slow statements are kept, redacted, with their plans."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.commit()
+        self.admin_id = admin.id
+
+        self.log = app.extensions["slow_queries"]
+        self.log.records.clear()
+        self.log.plans.clear()
+
+    def tearDown(self):
+        self.log.threshold = app.config["SLOW_QUERY_THRESHOLD"]
+        db.session.rollback()
+
+    def test_redact(self):
+        self.assertEqual(
+            slow_queries.redact({"id": 3, "name": "secret", "ok": True, "x": None}),
+            {"id": 3, "name": "<str:6>", "ok": True, "x": None})
+        self.assertEqual(slow_queries.redact((1.5, b"ab")), [1.5, "<bytes:2>"])
+
+    def test_recorded_with_plan(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            self.log.threshold = 0
+            client.get("/cafes?q=test")
+            self.log.threshold = app.config["SLOW_QUERY_THRESHOLD"]
+
+            for _ in range(100):
+                queries = client.get("/admin/slow-queries").json["queries"]
+                listing = [query for query in queries
+                           if query["endpoint"] == "views.cafe_list"]
+                if listing and all(query["plan"] for query in listing):
+                    break
+                time.sleep(0.05)
+
+        self.assertTrue(listing)
+        self.assertEqual(listing[0]["rule"], "/cafes")
+        self.assertNotIn("test", json.dumps(listing[0]["parameters"]))
+        self.assertTrue(listing[0]["plan"])
+
+    def test_ring_buffer(self):
+        log = slow_queries.SlowQueryLog(0, 2, explain=False)
+        for i in range(3):
+            log.record(db.engine, f"SELECT {i}", (), 0.5, False)
+
+        self.assertEqual([query["statement"] for query in log.snapshot()],
+                         ["SELECT 2", "SELECT 1"])
+
+    def test_admin_only(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get("/admin/slow-queries").json,
+                             {"error": "Access Denied"})
+
+
+#######################################
+# query budgets
+
+
+class QueryBudgetTestCase(TestCase):
+    """Every route stays within its SQL statement budget.
+
+    The dataset is big enough that a per-row query (N+1) blows the budget,
+    and the session is cleared before each request so nothing is served
+    from a previous request's identity map.
+    """
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        cities = [City(code=f"c{i}", name=f"City {i}", state="CA") for i in range(3)]
+        cafes = [
+            Cafe(name=f"Cafe {i}", description="desc", url="http://cafe.com/",
+                 address=f"{i} Main St", city_code=f"c{i % 3}")
+            for i in range(30)
+        ]
+        db.session.add_all(cities + cafes)
+
+        user = User.register(**TEST_USER_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.flush()
+        user.liked_cafes.extend(cafes[:20])
+        admin.liked_cafes.extend(cafes[:10])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.admin_id = admin.id
+        self.cafe_ids = [cafe.id for cafe in cafes]
+
+        # fail map fetches fast instead of calling MapQuest
+        self.mapquest_client = mapquest.client
+        mapquest.client = MapQuestClient(base_url="http://127.0.0.1:9/",
+                                         max_retries=0)
+
+    def tearDown(self):
+        mapquest.client = self.mapquest_client
+        db.session.rollback()
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def request(self, method, url, user_id=None, **kwargs):
+        db.session.remove()
+        with app.test_client() as client:
+            if user_id:
+                login_for_test(client, user_id)
+            resp = client.open(url, method=method, **kwargs)
+            # streamed pages are checked once their body has been read
+            resp.get_data()
+            self.assertLess(resp.status_code, 400, url)
+            return resp
+
+    def test_read_routes(self):
+        cafe_id = self.cafe_ids[0]
+
+        for user_id in (None, self.user_id, self.admin_id):
+            self.request("GET", "/", user_id)
+            self.request("GET", "/cafes", user_id)
+            self.request("GET", f"/cafes/{cafe_id}", user_id)
+            self.request("GET", "/cafes/add", user_id)
+            self.request("GET", f"/cafes/{cafe_id}/edit", user_id)
+            self.request("GET", "/profile", user_id)
+            self.request("GET", "/profile/edit", user_id)
+            self.request("GET", f"/api/likes?cafe_id={cafe_id}", user_id)
+            self.request("GET", "/signup", user_id)
+            self.request("GET", "/login", user_id)
+            self.request("GET", "/api/pools", user_id)
+
+    def test_write_routes(self):
+        cafe_id = self.cafe_ids[25]
+
+        self.request("POST", "/login", data={"username": "test", "password": "secret"})
+        self.request("POST", "/signup", data=TEST_USER_DATA_NEW)
+        self.request("POST", "/logout", self.user_id)
+        self.request("POST", "/profile/edit", self.user_id, data=TEST_USER_DATA_EDIT)
+        self.request("POST", "/api/like", self.user_id, json={"cafe_id": cafe_id})
+        self.request("POST", "/api/unlike", self.user_id, json={"cafe_id": cafe_id})
+        self.request("POST", "/cafes/add", self.admin_id, data=CAFE_DATA_EDIT | {"city_code": "c0"})
+        self.request("POST", f"/cafes/{cafe_id}/edit", self.admin_id,
+                     data=CAFE_DATA_EDIT | {"city_code": "c1"})
+        self.request("POST", f"/cafes/{self.cafe_ids[0]}/delete", self.admin_id)
+
+    def test_over_budget_raises(self):
+        app.config["QUERY_BUDGETS"] = {"views.cafe_list": 0}
+        try:
+            with self.assertRaises(QueryBudgetExceeded):
+                self.request("GET", "/cafes")
+        finally:
+            app.config["QUERY_BUDGETS"] = {}
+
+    def test_over_budget_logs_in_production(self):
+        app.config["QUERY_BUDGETS"] = {"views.cafe_list": 0}
+        app.config["QUERY_BUDGET_RAISE"] = False
+        try:
+            with self.assertLogs("metrics", "WARNING"):
+                self.request("GET", "/cafes")
+        finally:
+            app.config["QUERY_BUDGETS"] = {}
+            app.config["QUERY_BUDGET_RAISE"] = True
+
+
+#######################################
+# shared caching
+
+
+class SharedCacheConfig(TestingConfig):
+    SHARED_CACHE = True
+
+
+class SharedCacheTestCase(TestCase):
+    """Tests for public cache headers on anonymous pages, and purges."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(SharedCacheConfig)
+
+    def setUp(self):
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.admin_id = admin.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_anonymous_is_public(self):
+        with self.app.test_client() as client:
+            for url in ("/", "/cafes", f"/cafes/{self.cafe_id}"):
+                resp = client.get(url)
+                resp.get_data()
+
+                self.assertIn("public", resp.headers["Cache-Control"])
+                self.assertIn("s-maxage=60", resp.headers["Cache-Control"])
+                self.assertIn("stale-while-revalidate=300", resp.headers["Cache-Control"])
+                self.assertIn("Cookie", resp.headers["Vary"])
+                self.assertNotIn("Set-Cookie", resp.headers)
+
+    def test_logged_in_is_private(self):
+        with self.app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+    def test_flash_is_private(self):
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Flashed!")]
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"Flashed!", resp.data)
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+    def test_not_marked(self):
+        with self.app.test_client() as client:
+            resp = client.get("/login")
+            self.assertNotIn("Cache-Control", resp.headers)
+
+    def test_delete_purges(self):
+        purged = []
+
+        def receiver(sender, paths):
+            purged.extend(paths)
+
+        with cache_purged.connected_to(receiver), self.app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            client.post(f"/cafes/{self.cafe_id}/delete")
+
+        # the homepage's city summaries changed too
+        self.assertEqual(purged, ["/", "/cafes", f"/cafes/{self.cafe_id}"])
+
+
+#######################################
+# compression
+
+
+class CompressionTestCase(TestCase):
+    """Tests for gzip negotiation and streaming compression."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(Cafe(**CAFE_DATA))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_gzip(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes", headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+            self.assertIn(b"Test Cafe", gzip.decompress(resp.data))
+
+    def test_not_accepted(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+            resp = client.get("/cafes", headers={"Accept-Encoding": "gzip;q=0"})
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_choose_encoding(self):
+        wsgi = CompressionMiddleware(None)
+        choose = lambda accept: wsgi.choose_encoding({"HTTP_ACCEPT_ENCODING": accept})
+        best = "br" if "br" in compression.ENCODERS else "gzip"
+
+        # the client's q-values first, ours only to break ties
+        self.assertEqual(choose("br;q=0.5, gzip;q=1"), "gzip")
+        self.assertEqual(choose("gzip, br"), best)
+        self.assertEqual(choose("*"), best)
+        self.assertIsNone(choose("identity"))
+
+    def test_small_and_excluded(self):
+        with app.test_client() as client:
+            resp = client.get("/api/likes?cafe_id=1",
+                              headers={"Accept-Encoding": "gzip"})
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+            resp = client.get("/static/maps/1.jpg",
+                              headers={"Accept-Encoding": "gzip"})
+            self.assertNotIn("Content-Encoding", resp.headers)
+            resp.close()
+
+    def test_streaming(self):
+        produced = []
+
+        def streaming_app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/html")])
+            for i in range(3):
+                produced.append(i)
+                yield f"<p>row {i}</p>".encode() * 100
+
+        wsgi = CompressionMiddleware(streaming_app)
+        body = wsgi({"HTTP_ACCEPT_ENCODING": "gzip"}, lambda *args: None)
+
+        # the first compressed chunk is ready before the app is done
+        first = next(body)
+        self.assertEqual(produced, [0])
+
+        data = first + b"".join(body)
+        self.assertEqual(gzip.decompress(data),
+                         b"".join(f"<p>row {i}</p>".encode() * 100 for i in range(3)))
+
+
+#######################################
+# static assets
+
+
+class FakeCDNHandler(BaseHTTPRequestHandler):
+    """Serves `files`, by path."""
+
+    files = {}
+
+    def do_GET(self):
+        body = self.files.get(self.path)
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        self.wfile.write(body or b"")
+
+    def log_message(self, *args):
+        pass
+
+
+class AssetsTestCase(TestCase):
+    """Tests for the asset build and fingerprinted URLs."""
+
+    def test_build(self):
+        with tempfile.TemporaryDirectory() as static:
+            os.makedirs(f"{static}/vendor/fonts")
+            with open(f"{static}/vendor/fonts/icons.woff2", "wb") as file:
+                file.write(b"font")
+            with open(f"{static}/vendor/icons.css", "w") as file:
+                file.write('/*! license */\n.i { src: url("./fonts/icons.woff2?v=1"); }')
+            with open(f"{static}/style.css", "w") as file:
+                file.write('@import url("https://fonts.example.com/a.css");\n'
+                           '/* ours */\n.a,\n.b {\n  content: "x ,  y";\n}\n')
+
+            manifest = assets.build(static, {"app.css": ["vendor/icons.css", "style.css"]},
+                                    log=lambda message: None)
+
+            [bundle] = manifest["app.css"]
+            self.assertRegex(bundle, r"^app\.[0-9a-f]{12}\.css$")
+            with open(f"{static}/dist/{bundle}") as file:
+                css = file.read()
+
+            font = assets.fingerprint("icons.woff2", b"font")
+            self.assertTrue(os.path.exists(f"{static}/dist/{font}"))
+            self.assertEqual(
+                css,
+                '@import url("https://fonts.example.com/a.css");/*! license */ '
+                f'.i{{src: url("{font}");}} .a,.b{{content: "x ,  y";}}')
+
+    def test_vendor_integrity(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeMapQuestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/"
+        digest = base64.b64encode(hashlib.sha256(b"fake-jpg").digest()).decode()
+
+        try:
+            with tempfile.TemporaryDirectory() as static:
+                with self.assertRaises(assets.IntegrityError) as raised:
+                    assets.vendor(static,
+                                  {"vendor/good.js": url, "vendor/bad.js": url,
+                                   "vendor/unpinned.js": url},
+                                  {"vendor/good.js": f"sha256-{digest}",
+                                   "vendor/bad.js": "sha256-AAAA"},
+                                  log=lambda message: None)
+
+                self.assertEqual(os.listdir(f"{static}/vendor"), ["good.js"])
+                self.assertIn("vendor/bad.js: expected sha256-AAAA", str(raised.exception))
+                self.assertIn("vendor/unpinned.js: no digest", str(raised.exception))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_vendor_and_build(self):
+        # everything BUNDLES needs, with stand-ins for the vendored files
+        fixtures = {
+            "vendor/bootswatch-lux.min.css": b".btn{color:red}",
+            "vendor/bootstrap-icons/bootstrap-icons.min.css":
+                b'@font-face{src:url("./fonts/bootstrap-icons.woff2?1")}',
+            "vendor/bootstrap-icons/fonts/bootstrap-icons.woff2": b"woff2",
+            "vendor/bootstrap-icons/fonts/bootstrap-icons.woff": b"woff",
+            "vendor/jquery.min.js": b"window.$=1",
+            "vendor/bootstrap.bundle.min.js": b"window.bs=1",
+        }
+        FakeCDNHandler.files = {f"/{path}": content for path, content in fixtures.items()}
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCDNHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}/"
+        pins = {path: "sha256-" + base64.b64encode(hashlib.sha256(content).digest()).decode()
+                for path, content in fixtures.items()}
+        # left unpinned, like a file whose digest nobody has checked yet
+        del pins["vendor/bootswatch-lux.min.css"]
+
+        try:
+            with tempfile.TemporaryDirectory() as static:
+                for name in ("style.css", "likes.js", "suggest.js"):
+                    shutil.copy(os.path.join(app.static_folder, name), static)
+
+                with self.assertRaises(assets.IntegrityError):
+                    assets.vendor(static, {path: base + path for path in assets.VENDOR},
+                                  pins, log=lambda message: None)
+                messages = []
+                manifest = assets.build(static, log=messages.append)
+
+                # the refused file comes from its CDN, ahead of the rest
+                css_cdn, css_bundle = manifest["app.css"]
+                self.assertEqual(css_cdn, assets.VENDOR["vendor/bootswatch-lux.min.css"])
+                self.assertIn("vendor/bootswatch-lux.min.css is missing", messages[0])
+                with open(f"{static}/dist/{css_bundle}") as file:
+                    css = file.read()
+                font = assets.fingerprint("bootstrap-icons.woff2", b"woff2")
+                self.assertIn(f'url("{font}")', css)
+                self.assertNotIn(".btn", css)
+
+                [js_bundle] = manifest["app.js"]
+                with open(f"{static}/dist/{js_bundle}") as file:
+                    self.assertTrue(file.read().startswith("window.$=1\n;\nwindow.bs=1"))
+
+                app.extensions["assets"] = manifest
+                try:
+                    with app.test_request_context():
+                        self.assertEqual(assets.asset_urls("app.css"),
+                                         [css_cdn, f"/static/dist/{css_bundle}"])
+                finally:
+                    app.extensions["assets"] = {}
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_unbundled(self):
+        with app.test_request_context():
+            urls = assets.asset_urls("app.css")
+
+        self.assertIn("/static/style.css", urls)
+        # not vendored here, so it comes from the CDN
+        self.assertIn(assets.VENDOR["vendor/bootswatch-lux.min.css"], urls)
+
+    def test_bundled(self):
+        dist = os.path.join(app.static_folder, assets.DIST)
+        os.makedirs(dist, exist_ok=True)
+        with open(f"{dist}/app.0123456789ab.css", "w") as file:
+            file.write("body{}")
+
+        app.extensions["assets"] = {"app.css": ["app.0123456789ab.css"]}
+        try:
+            with app.test_client() as client:
+                resp = client.get("/")
+                self.assertIn(b'href="/static/dist/app.0123456789ab.css"', resp.data)
+                self.assertIn("</static/dist/app.0123456789ab.css>; rel=preload; as=style",
+                              resp.headers["Link"])
+
+                resp = client.get("/static/dist/app.0123456789ab.css")
+                self.assertEqual(resp.headers["Cache-Control"], assets.IMMUTABLE)
+                resp.close()
+
+                resp = client.get("/static/style.css")
+                self.assertNotIn("immutable", resp.headers.get("Cache-Control", ""))
+                resp.close()
+        finally:
+            app.extensions["assets"] = {}
+            os.remove(f"{dist}/app.0123456789ab.css")
@@ -0,0 +1,22 @@
+"""Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+builds the app once in gunicorn's parent process (preload_app), so the
+code, compiled templates, ORM mappers and city registry are loaded once
+and shared copy-on-write by every worker instead of each worker loading
+its own copy. gunicorn.conf.py calls `before_fork` in the parent and
+`after_fork` in each worker, so no worker serves on a database or
+MapQuest connection inherited from the parent.
+
+Under another preforking server, call those two the same way (for
+uWSGI, `uwsgidecorators.postfork`), or don't preload.
+
+FLASK_CAFE_CONFIG picks the profile (default "production").
+"""
+
+import os
+
+from app import create_app
+
+app = create_app(os.environ.get("FLASK_CAFE_CONFIG", "production"))